@@ -18,19 +18,28 @@ author: matsumoto
 
 
 # 相対パスからimport
-from .gpt.gpt_handler import GPTHandler, JsonGPTHandler
+from .gpt.gpt_handler import GPTHandler, JsonGPTHandler, CancelToken
+from .dialog_store import DialogStore
+from .dialog_journal import DialogJournal, load_journal
+from .conversation_db import ConversationDB
+from .long_term_memory import LongTermMemory, format_turn
+from .speech.speech_pipeline import SpeechPipeline
+from .speech.filler_cache import FillerCache
+from .speculation import Speculation, SpeculationStats
 
 import logging
 import threading
 import queue
 import time
+import uuid
+from collections import deque
 
 class AIAgent:
     """
     会話AIとして最低限の個性を維持するためのクラス
     """
 
-    def __init__(self, name="アイ", profile=None, speakers=[],log_title:str="",log_directory=""):
+    def __init__(self, name="アイ", profile=None, speakers=[],log_title:str="",log_directory="",autosave=True,conversation_db:ConversationDB=None,user_id="default",long_term_memory:LongTermMemory=None,memory_top_k=3,history_limit=12,filler_cache:FillerCache=None,synthesis_executor=None):
         """
         コンストラクタ
 
@@ -40,25 +49,62 @@ class AIAgent:
             speakers (list): 音声合成用のスピーカーリスト。空リストの場合は音声合成は行われない。
             log_title (str): ログファイルのタイトル。
             log_directory (str): ログファイルの出力ディレクトリ。例: "./path/to/log/directory"。
+            autosave (bool): 会話ログの変更をジャーナル(.jsonl)に自動で追記するかどうか。
+            conversation_db (ConversationDB): 会話の保存先。指定するとターンごとに保存され、resume()で直近の会話を思い出せる。
+            user_id (str): conversation_dbに保存するときのuserのID。
+            long_term_memory (LongTermMemory): 長期記憶。指定すると過去の会話から関係ありそうなものをプロンプトに差し込む。
+            memory_top_k (int): 長期記憶から差し込む最大件数。
+            history_limit (int): long_term_memoryがあるとき、GPTに送る会話ログの最大件数(古い分は長期記憶から関係ありそうなものだけ思い出す)。Noneなら全部送る。
+            filler_cache (FillerCache): 相槌のキャッシュ。指定するとターンの開始と同時に相槌を再生してGPTの待ち時間を埋める。
+            synthesis_executor (Executor): 音声合成に使うスレッドプール。複数のエージェントで共有する場合に指定する。
         """
         self.name = name
         self.profile = profile
         self.speakers = speakers
         self.recent_response = ""
-        self.chatting_thread = None
-        self.dialog = []
+        self.dialog_store = DialogStore()  # 会話ログ(assistantの出力は辞書のまま持つ)
         self.is_speaking = False
-        self.interrupt_event = threading.Event()  # 中断イベントを初期化
+        self.interrupt_event = CancelToken()  # 中断用のトークンを初期化
         self.end_event = threading.Event()  # チャット終了イベントを初期化
         self.response_queue = queue.Queue()  # gpt出力を保存するキューを初期化
         self.characters=[]
         self.date=time.strftime('%Y%m%d_%H%M')
         self.log_title=log_title
         self.log_directory=log_directory
-        self._log_lock = threading.Lock() # dialogのアクセス競合防止用のlock
+        self._log_lock = self.dialog_store.lock # dialogへの書き込み同士の競合防止用のlock(読み込みはスナップショットなのでlock不要)
+        # 自動バックアップ: 変更点だけを専用スレッドで追記する(load_dialogで復元できる)
+        # self.dateは分単位なので、同じ分に作った別のエージェント(再起動を含む)と同じファイルに混ざらないように固有のIDもつける
+        self.journal_id = uuid.uuid4().hex[:8]
+        self.journal = DialogJournal(self.get_log_path(f"autosave_{self.journal_id}", ext="jsonl")) if autosave else None
 
         self.init_GPT()
 
+        # 会話の永続化(セッションはreset()のたびに切り替わる)
+        self.conversation_db = conversation_db
+        self.user_id = user_id
+        self.session_id = conversation_db.start_session(user_id, self.name) if conversation_db else None
+        # 長期記憶(会話ログを全部送る代わりに，関係ありそうな過去の会話だけ差し込む)
+        self.long_term_memory = long_term_memory
+        self.memory_top_k = memory_top_k
+        self.history_limit = history_limit
+        self._turn_times = deque()  # 会話ログに入っている(長期記憶にもある)ターンの時刻。古い順。GPTに送る分を思い出さないように使う
+
+        # 音声合成は先読みして並列に、再生は順番通りに行うパイプライン
+        self.speech_pipeline = SpeechPipeline(executor=synthesis_executor)
+        self.filler_cache = filler_cache
+
+        # ターンを最後まで話し終えた時に呼ぶ関数(end_eventを見張らずに済むように)
+        self.turn_end_callbacks = []
+
+        # 音声認識の途中結果での投機実行
+        self.speculation = None
+        self.speculation_stats = SpeculationStats()
+
+        # 応答用のワーカースレッド(ターンごとにスレッドを立てず、1本のスレッドがジョブキューから順に処理する)
+        self.job_queue = queue.Queue()
+        self.chatting_thread = threading.Thread(target=self.worker_loop, name=f"chatter_{self.name}", daemon=True)
+        self.chatting_thread.start()
+
     def init_GPT(self):
         """
         GPTの初期設定を行うメソッド
@@ -129,6 +175,32 @@ class AIAgent:
         except Exception as e:
             logging.debug("Failed to synthesize speech: %s", e)  # 音声合成に失敗した場合のエラーログ
         print(text)  # 合成された音声テキストをコンソールに出力
+
+    def play_filler(self):
+        """
+        キャッシュ済みの相槌を再生するメソッド(合成済みなのですぐ鳴る。応答はその後に順番通り続く)
+        """
+        if self.filler_cache is None:
+            return
+        filler = self.filler_cache.pick()
+        if filler is None:  # まだ合成が終わっていない
+            return
+        speaker_index, text, data = filler
+        self.speech_pipeline.submit_synthesized(self.speakers[speaker_index], text, data)
+        logging.debug(f"相槌: {text}")
+
+    def speak_async(self, text, speaker_index=0):
+        """
+        テキストを音声合成のパイプラインに投げるメソッド(合成はすぐ始まり、再生は前のセリフの後に行われる)
+        speak()と違って再生を待たないので、その間にGPTの次のセリフを読める
+
+        Parameters:
+            text (str): 音声合成するテキスト
+            speaker_index (int): 使用するスピーカーのインデックス
+        """
+        if speaker_index < len(self.speakers):
+            self.speech_pipeline.submit(self.speakers[speaker_index], text)
+        print(text)  # 音声テキストをコンソールに出力
     
 
     def put_dialog(self,role:str,content)->bool:
@@ -142,85 +214,63 @@ class AIAgent:
         Returns:
             bool: メッセージが追加された場合はTrue、そうでない場合はFalse。
         """
-        with self._log_lock:
-            logging.debug("dialog updated: %s,%s", role, content)  # ダイアログが更新されたことをデバッグログに出力
-            if self.dialog and self.dialog[-1]['role'] == role:
-                # roleが同一の場合、最後の要素のcontentを取得
-                last_content = self.dialog[-1]['content']
-                # contentが辞書形式の文字列であるか確認し、辞書に変換
-                last_dict = eval(last_content) if last_content.startswith('{') and last_content.endswith('}') else {}
-                if last_dict and isinstance(content, dict):
-                    # 最後の要素が辞書型で、messageも辞書型の場合、既存の辞書にmessageを追加
-                    last_dict.update(content)
-                    self.dialog[-1]['content'] = str(last_dict)
-                elif not last_dict and isinstance(content, str):
-                    # 最後の要素が辞書型ではなく、messageが文字列型の場合、既存の文字列にmessageを追加
-                    self.dialog[-1]['content'] += content
-                else:
-                    # 上記以外の場合、新しい要素として追加
-                    self.dialog.append({'role': role, 'content': str(content)})
-            else:
-                # ダイアログにアシスタントの応答を追加
-                self.dialog.append({'role': role, 'content': str(content)})
-        # 自動バックアップ
-        self.save_dialog(log_title="autosave")
+        logging.debug("dialog updated: %s,%s", role, content)  # ダイアログが更新されたことをデバッグログに出力
+        # 同じroleが続く場合はマージ(辞書同士はupdate，文字列同士は連結)，それ以外は新しい要素として追加
+        self.dialog_store.put(role, content)
+        # 自動バックアップ(キューに積むだけで，書き込みは別スレッド)
+        self._journal("put", role=role, content=content)
         return bool(content)
+
+    def _journal(self, op, **payload):
+        """会話ログの変更をジャーナルに記録する"""
+        if self.journal is not None:
+            self.journal.append(op, **payload)
     
     def get_dialog(self, contain_sys=False) -> list:
         """
         現在の会話ログを取得するメソッド
 
         Returns:
-            list: 現在の会話ログ
+            list: 現在の会話ログ(API形式の辞書のリスト．毎回新しく作るので呼び出し元でいじってよい)
         """
-        dialog=[]
-        with self._log_lock:
-            if contain_sys:
-                dialog = self.sys_message + self.dialog
-            else:
-                dialog = self.dialog
-        return dialog
+        return self.dialog_store.to_api_messages(self.sys_message if contain_sys else None)
     
-    def get_recent_output(self)->str:
+    def get_recent_output(self):
         """
         self.dialogの中で、roleが"assistant"である要素のうち、最新のものを返すメソッド。
 
         Returns:
             dict: 最新のassistantの出力。要素が存在しない場合はNoneを返す。
         """
-        with self._log_lock:
-            for i in range(len(self.dialog)-1,-1,-1):
-                if self.dialog[i]['role'] == 'assistant':
-                    return self.dialog[i]['content']
-            return None
+        return self.dialog_store.last_content('assistant')
     
+    def get_log_path(self, title="", directory="", ext="txt"):
+        """
+        ログファイルのパスを決めるメソッド
+
+        Parameters:
+            title (str): ファイル名のタイトル。省略時はself.log_title、それもなければ"NoTitle"
+            directory (str): 保存先。省略時はself.log_directory、それもなければ".user_data/log"
+            ext (str): 拡張子
+
+        Returns:
+            str: ログファイルのパス
+        """
+        title = title or self.log_title or "NoTitle"
+        directory = directory or self.log_directory or ".user_data/log"
+        return f"{directory}/{self.date}_{title}.{ext}"
+
     def save_dialog(self,log_title="",log_directory=""):
         """
         現在の会話ログを.txtファイルに保存するメソッド
+        (自動バックアップはジャーナルで行っているので、これは人が読む用の書き出し)
         """
         import os
         try:
-            # ファイル名決定
-            if log_title:
-                title=log_title
-            elif self.log_title:
-                title=self.log_title
-            else:
-                title="NoTitle"
-            
-            # 保存先決定
-            if log_directory:
-                directory = log_directory
-            elif self.log_directory:
-                directory=self.log_directory
-            else:
-                directory = ".user_data/log"
-            
-            if not os.path.exists(directory):
-                os.makedirs(directory, exist_ok=True)
+            file_path = self.get_log_path(log_title, log_directory)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
             
             # 現在の日時とタイトルを使ってファイルパスを作成し、書き込みモードで開く
-            file_path = f"{directory}/{self.date}_{title}.txt"
             with open(file_path, "w", encoding="utf-8") as file:
                 # ダイアログの各エントリをファイルに書き込む
                 for entry in self.get_dialog(contain_sys=True):
@@ -229,22 +279,147 @@ class AIAgent:
         except Exception as e:
             logging.debug("ダイアログの保存に失敗しました: %s", e)  # 保存失敗のエラーログ
 
+    def load_dialog(self, journal_path):
+        """
+        ジャーナル(.jsonl)から会話ログを復元するメソッド
+
+        Parameters:
+            journal_path (str): 復元するジャーナルのパス
+        """
+        self.dialog_store.clear()
+        load_journal(journal_path, self.dialog_store)
+        # 復元した内容を今のジャーナルにも残しておく
+        self._journal("clear")
+        for message in self.dialog_store.snapshot():
+            self._journal("put", role=message.role, content=message.content)
+
+    def close(self):
+        """
+        ワーカースレッドと再生スレッドを止め、ジャーナルの残りを書き出して閉じるメソッド(conversation_dbのセッションも終了する)
+        """
+        self.interrupt_event.cancel()
+        self.job_queue.put(None)
+        self.chatting_thread.join(timeout=5.0)
+        self.speech_pipeline.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.conversation_db is not None:
+            self.conversation_db.end_session(self.session_id)
+
     def start_chatting(self, message: str):
         """
         userの言葉に対するchatGPTの応答を取得するメソッド
         Parameters:
             message (str): userのメッセージ
         """
-        self.put_dialog('user', message)  # ダイアログにユーザーのメッセージを追加
-        self.save_dialog(log_title="autosave") # 更新したダイアログをログファイルにも反映
+        self.put_dialog('user', message)  # ダイアログにユーザーのメッセージを追加(ジャーナルにも自動で反映される)
+        self._submit_job(self.build_messages(message))
+
+    def build_messages(self, message, pending_user_message=None):
+        """
+        GPTに送るメッセージリストを作るメソッド
+
+        Parameters:
+            message (str): userのメッセージ(長期記憶の検索に使う)
+            pending_user_message (str): まだ会話ログに入れていないuserのメッセージ(投機実行用)。末尾に付ける
+        """
+        messages = self.get_dialog(contain_sys=True)  # メッセージリストを作成(ここで1回だけ文字列化)
+        n_sys = len(self.sys_message)
+        if self.long_term_memory is not None and self.history_limit is not None and len(messages) - n_sys > self.history_limit:
+            # 長期記憶があるなら会話ログは直近の分だけ送り、古い分は関係ありそうなものだけ思い出す
+            messages = messages[:n_sys] + messages[len(messages) - self.history_limit:]
+        if pending_user_message is not None:
+            # 会話ログの最後がuserなら、put_dialogと同じように連結する
+            if len(messages) > len(self.sys_message) and messages[-1]['role'] == 'user':
+                messages[-1] = {'role': 'user', 'content': messages[-1]['content'] + pending_user_message}
+            else:
+                messages.append({'role': 'user', 'content': pending_user_message})
+        memory_message = self.recall(message, messages[n_sys:])  # 長期記憶から関係ありそうな過去の会話を引く
+        if memory_message:
+            messages.insert(n_sys, memory_message)
+        return messages
 
-        gpt_handler = JsonGPTHandler()  # GPTハンドラーを初期化
-        messages = self.sys_message + self.dialog  # メッセージリストを作成
-        self.interrupt_event = threading.Event()  # 中断イベントを初期化
+    def _submit_job(self, messages, speculation=None):
+        """
+        前のジョブが残っていたら中断して、新しいジョブをワーカーに渡すメソッド
+        """
+        self.interrupt_event.cancel()
+        self.interrupt_event = CancelToken()  # 中断用のトークンを初期化
         self.end_event = threading.Event()  # 応答終了イベントを初期化
-        # チャットスレッドを開始
-        self.chatting_thread = threading.Thread(target=self.chatting_loop, name="chatter", args=(messages, gpt_handler, self.interrupt_event, self.end_event))
-        self.chatting_thread.start()
+        self.job_queue.put((messages, self.interrupt_event, self.end_event, speculation))
+
+    def speculate(self, message: str):
+        """
+        音声認識の途中結果でGPTへのリクエストを先に送っておくメソッド
+        応答はcommit_speculation()されるまで話さずに止めておく。会話ログにもまだ入れない
+
+        Parameters:
+            message (str): 音声認識の途中結果
+        """
+        self.cancel_speculation()
+        self.speculation = Speculation(message)
+        self.speculation_stats.add_attempt()
+        self._submit_job(self.build_messages(message, pending_user_message=message), self.speculation)
+        logging.debug(f"投機実行開始: {message}")
+
+    def commit_speculation(self, message: str) -> bool:
+        """
+        確定したuserの発話が投機実行の途中結果と同じなら、止めておいた応答をそのまま話し始めるメソッド
+
+        Parameters:
+            message (str): 確定したuserの発話
+
+        Returns:
+            bool: commitできたらTrue。できなかったら(投機実行していない、発話が違う)False。その場合はstart_chattingすること
+        """
+        speculation = self.speculation
+        if speculation is None or self.interrupt_event.is_set() or self.end_event.is_set():
+            # 投機実行のリクエストが失敗して終わっていたら、commitしても話すものがない
+            self.speculation = None
+            return False
+        if not speculation.matches(message):
+            self.cancel_speculation()
+            return False
+        self.speculation = None
+        self.put_dialog('user', speculation.message)
+        speculation.committed_at = time.perf_counter()
+        speculation.gate.set()
+        self.speculation_stats.add_commit()
+        logging.debug(f"投機実行をcommit: {self.speculation_stats.summary()}")
+        return True
+
+    def cancel_speculation(self):
+        """
+        投機実行中のリクエストがあれば中断するメソッド
+        """
+        if self.speculation is None:
+            return
+        self.speculation = None
+        self.interrupt_event.cancel()
+        self.speculation_stats.add_cancel()
+        logging.debug(f"投機実行を中断: {self.speculation_stats.summary()}")
+
+    def worker_loop(self):
+        """
+        ワーカースレッド: ジョブキューからジョブを取り出してchatting_loopを実行する
+        中断済みのジョブ(連続で割り込まれて、始まる前に次のジョブが来たもの)は飛ばす
+        """
+        while True:
+            job = self.job_queue.get()
+            if job is None:  # close()の合図
+                return
+            messages, interrupt_event, end_event, speculation = job
+            if interrupt_event.is_set():
+                continue
+            try:
+                self.chatting_loop(messages, self.gpt_handler, interrupt_event, end_event, speculation)
+            except Exception as e:
+                # 中断でストリームを閉じた時の例外は想定内
+                if interrupt_event.is_set():
+                    continue
+                # それ以外の失敗でもターンは終わらせる(end_eventを待っている側や、応答中のままのChatRuntimeが止まらないように)
+                logging.warning("応答の取得に失敗しました: %s", e)
+                self._end_turn(end_event, {})
 
     def parse_and_respond(self, item):
         """
@@ -257,55 +432,194 @@ class AIAgent:
         for i, key in enumerate(self.characters):
             if key in item:
                 self.put_dialog('assistant',item)
-                self.speak(item[key], speaker_index=i)  # 応答を音声合成して出力
+                self.speak_async(item[key], speaker_index=i)  # 応答を音声合成して出力(再生は待たない)
 
-    def chatting_loop(self, messages, gpt_handler, interrupt_event, end_event):
+    def chatting_loop(self, messages, gpt_handler, interrupt_event, end_event, speculation=None):
         """
         並列処理メソッド: GPTの応答を処理し、スピーカーに出力する
 
         Parameters:
             messages (list): GPTに送信するメッセージのリスト
             gpt_handler (JsonGPTHandler): GPTハンドラー
-            interrupt_event (threading.Event): 中断イベント
+            interrupt_event (CancelToken): 中断用のトークン(中断されたらストリームも閉じる)
             end_event (threading.Event): 応答終了イベント
+            speculation (Speculation): 投機実行の場合に指定。commitされるまで応答を話さずに待つ
         """
         start_time = time.time()  # 処理開始時間を記録
-        response = gpt_handler.chat(messages, self.model)  # ストリーミングレスポンスを取得
-        for item in response:  # 疑似ループでレスポンスを処理
-            if interrupt_event.is_set():  # 中断イベントがセットされているか確認
-                return
-            self.parse_and_respond(item)  # 応答アイテムをパースして返答
-            if interrupt_event.is_set():  # 中断イベントがセットされているか確認
+        usage = {}
+        turn_output = {}  # このターンの出力をまとめたもの(DB保存用)
+        if speculation is None:
+            self.speech_pipeline.start_turn()  # 話者間の無音などの計測を開始
+            self.play_filler()  # GPTの応答が来るまでの間を相槌で埋める
+        response = gpt_handler.chat(messages, self.model, on_usage=usage.update, cancel_token=interrupt_event)  # ストリーミングレスポンスを取得
+        try:
+            for item in response:  # 疑似ループでレスポンスを処理
+                if interrupt_event.is_set():  # 中断イベントがセットされているか確認
+                    return
+                if speculation is not None and speculation.first_item_at is None:
+                    # 投機実行: 最初の応答が届いた時点で、commitされるまで待つ
+                    speculation.first_item_at = time.perf_counter()
+                    if not self._wait_commit(speculation, interrupt_event):
+                        return
+                self.parse_and_respond(item)  # 応答アイテムをパースして返答
+                if interrupt_event.is_set():  # 中断イベントがセットされているか確認
+                    return
+                turn_output.update(item)
+                self.response_queue.put(item)  # 応答アイテムをキューに追加
+        finally:
+            response.close()  # 途中で抜けてもストリームの接続を残さない
+            self.dialog_store.seal()  # ストリーミング中は可変で持っていた出力を不変のメッセージに固める
+        if speculation is not None and speculation.committed_at is None:
+            # 応答が空だった場合も、commitされるまではターンを終わらせない
+            speculation.first_item_at = speculation.first_item_at or time.perf_counter()
+            if not self._wait_commit(speculation, interrupt_event):
                 return
-            self.response_queue.put(item)  # 応答アイテムをキューに追加
-        end_event.set()  # 応答終了イベントをセット
+        # 全部話し終わるまで待ってからターン終了とする
+        speech_metrics = self.speech_pipeline.finish_turn(interrupt_event)
+        if interrupt_event.is_set():
+            return
+        self._end_turn(end_event, turn_output)
+        logging.debug(f"話者間の無音: {speech_metrics.summary()}")
         response_time = time.time() - start_time  # 応答時間を計算
         logging.debug(f"応答時間: {response_time}秒")  # 応答時間をデバッグログに出力
+        self.record_turn(messages[-1]['content'], turn_output, response_time, usage)
+
+    def _end_turn(self, end_event, turn_output):
+        """
+        ターンの終了を知らせるメソッド(失敗したターンはturn_outputを空にして呼ぶ)
+        """
+        end_event.set()  # 応答終了イベントをセット
+        for callback in self.turn_end_callbacks:
+            try:
+                callback(turn_output)
+            except Exception as e:
+                logging.debug("ターン終了時のコールバックに失敗しました: %s", e)
+
+    def _wait_commit(self, speculation, interrupt_event) -> bool:
+        """
+        投機実行の応答をcommitされるまで止めておくメソッド
+
+        Returns:
+            bool: commitされたらTrue、中断されたらFalse
+        """
+        # 中断されたときもgateを開けてもらうので、ポーリングせずにgateだけを待てばよい(commitの時点ですぐに話し始める)
+        interrupt_event.add_callback(speculation.gate.set)
+        speculation.gate.wait()
+        if interrupt_event.is_set():
+            return False
+        self.speech_pipeline.start_turn()  # userから見たターンの開始はcommitの時点
+        self.speculation_stats.add_saved_latency(speculation.saved_latency())
+        return True
+
+    def record_turn(self, user_message, output, latency=None, usage=None):
+        """
+        最後まで話し終えたターンをconversation_dbと長期記憶に保存するメソッド(中断されたターンは保存しない)
+
+        Parameters:
+            user_message (str): userのメッセージ
+            output (dict): このターンのassistantの出力
+            latency (float): 応答にかかった秒数
+            usage (dict): GPTHandlerのon_usageで受け取ったトークン数
+        """
+        created_at = time.time()  # 長期記憶とDBで同じ時刻にしておく(resume()で読み込んだターンを思い出さないように)
+        if self.long_term_memory is not None:
+            # インデックスの更新は長期記憶のスレッドでやるので，ここでは積むだけ
+            self.long_term_memory.add(format_turn(user_message, output), self.session_id, created_at)
+            self._turn_times.append(created_at)
+        if self.conversation_db is None:
+            return
+        usage = usage or {}
+        try:
+            self.conversation_db.add_turn(self.session_id, self.user_id, 'user', user_message, created_at=created_at)
+            self.conversation_db.add_turn(
+                self.session_id, self.user_id, 'assistant', output, latency=latency,
+                prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"),
+                emotion=output.get("emotion"),
+            )
+        except Exception as e:
+            logging.debug("会話の保存に失敗しました: %s", e)
+
+    def recall(self, message, history=None):
+        """
+        長期記憶からmessageに関係ありそうな過去の会話を引いて、プロンプトに差し込むシステムメッセージを作るメソッド
+
+        Parameters:
+            message (str): userのメッセージ
+            history (list): 一緒にGPTに送る会話ログ(システムメッセージを除く)。ここに入っているターンは思い出さない。省略時は会話ログ全部
+
+        Returns:
+            dict: システムメッセージ。何も見つからなければNone
+        """
+        if self.long_term_memory is None:
+            return None
+        start_time = time.perf_counter()
+        # 送る会話ログに入っているターン(今のセッションの直近の分とresume()で読み込んだ分)は除く。
+        # 末尾のuserはまだ保存していない今の発話なので数えない。途中で中断されたターンがあると多めに除くことになるが、二重に送るよりはよい
+        turn_times = list(self._turn_times)
+        if history is None:
+            n_turns = len(turn_times)
+        else:
+            n_turns = sum(1 for entry in history if entry['role'] == 'user') - (1 if history and history[-1]['role'] == 'user' else 0)
+        exclude_since = turn_times[-min(n_turns, len(turn_times))] if n_turns > 0 and turn_times else None
+        documents = self.long_term_memory.search(message, top_k=self.memory_top_k, exclude_since=exclude_since)
+        logging.debug(f"長期記憶から{len(documents)}件取得({(time.perf_counter() - start_time) * 1000:.2f}ms)")
+        if not documents:
+            return None
+        snippets = "\n".join(f"- {document.text}" for document in documents)
+        return {'role': 'system', 'content': f"# Memory\n過去のuserとの会話のうち、今の話に関係ありそうなもの：\n{snippets}"}
+
+    def resume(self, limit=20, since=None):
+        """
+        conversation_dbから、このuserとの直近の会話を会話ログに読み込むメソッド(寝起きにuserを思い出す用)
+
+        Parameters:
+            limit (int): 読み込む最大ターン数
+            since (float): これより前の会話は読み込まない(UNIX時間)
+
+        Returns:
+            int: 読み込んだターン数
+        """
+        if self.conversation_db is None:
+            return 0
+        start_time = time.perf_counter()
+        turns = self.conversation_db.recent_turns(self.user_id, limit=limit, since=since, exclude_session=self.session_id)
+        # 読み込んだターンの時刻(長期記憶の文書と同じ時刻)を今のセッションのものより前に入れる
+        resumed_times = [turn['created_at'] for turn in turns if turn['role'] == 'user']
+        self._turn_times.extendleft(reversed(resumed_times))
+        for turn in turns:
+            self.put_dialog(turn['role'], turn['content'])
+        logging.debug(f"{len(turns)}ターン分の会話を思い出しました({(time.perf_counter() - start_time) * 1000:.1f}ms)")
+        return len(turns)
 
     def stop_chat_thread(self):
         """
-        チャットを停止するメソッド
+        チャットを停止するメソッド(ワーカースレッド自体は止めず、今のジョブを中断するだけ)
         """
-        if self.chatting_thread and self.chatting_thread.is_alive():
-            self.interrupt_event.set()  # スレッド終了イベントをセット
-            self.chatting_thread = None  # スレッドオブジェクトをクリアして次に進む
-            self.response_queue.queue.clear() 
+        self.cancel_speculation()
+        if not self.interrupt_event.is_set():
+            self.interrupt_event.cancel()  # 今のジョブを中断(ストリームも閉じる)
+            self.response_queue.queue.clear()
+        self.speech_pipeline.cancel()  # 合成待ち・再生待ちのセリフも捨てる
 
     def cancel_chatting(self):
         """
         ユーザーの指示をキャンセルするメソッド
         """
-        with self._log_lock:
-            if self.dialog and self.dialog[-1].get("role") == "user":
-                self.dialog.pop()
-            self.stop_chat_thread()
+        if self.dialog_store.pop_if("user"):
+            self._journal("pop", role="user")
+        self.stop_chat_thread()
 
     def reset(self):
         """
         会話ログなどをリセット
         """
-        self.put_dialog()
-        self.dialog=[]
+        self.dialog_store.clear()
+        self._turn_times.clear()
+        self._journal("clear")
+        # DBの方は消さずに、新しいセッションに切り替える
+        if self.conversation_db is not None:
+            self.conversation_db.end_session(self.session_id)
+            self.session_id = self.conversation_db.start_session(self.user_id, self.name)
 
 
 # 複数エージェントでも動かせるよって例
@@ -406,11 +720,7 @@ assistant: {"zundamon": "それは辛いのだ", "metan": "ちゃんと寝てる
         Returns:
             bool: 最後の応答がアシスタントによるものであればTrue、そうでなければFalse
         """
-        self._log_lock.acquire()
-        try:
-            return bool(self.dialog) and self.dialog[-1]['role'] == 'assistant'
-        finally:
-            self._log_lock.release()
+        return self.dialog_store.last_role() == 'assistant'
 
     def update_chatting(self, message: str):
         """
@@ -430,3 +740,72 @@ assistant: {"zundamon": "それは辛いのだ", "metan": "ちゃんと寝てる
     #     """
     #     self.put_dialog()
     #     return super().cancel_chatting()
+
+
+class _FakeStreamingHandler(JsonGPTHandler):
+    """
+    test_rapid_interruptions用: APIを叩かずに、ゆっくり辞書を流すだけのハンドラー
+    開いている「接続」の数を数えておき、中断されたら(本物と同じく)すぐに閉じる
+    """
+
+    def __init__(self, item_interval=0.05, n_items=20):
+        super().__init__()
+        self.item_interval = item_interval
+        self.n_items = n_items
+        self.open_connections = 0
+        self.max_open_connections = 0
+        self._lock = threading.Lock()
+
+    def chat(self, messages, model="gpt-4o-mini", temperature=0.7, on_usage=None, cancel_token=None):
+        closed = threading.Event()
+        if cancel_token is not None:
+            cancel_token.add_callback(closed.set)
+        with self._lock:
+            self.open_connections += 1
+            self.max_open_connections = max(self.max_open_connections, self.open_connections)
+        try:
+            for i in range(self.n_items):
+                # チャンク待ちのブロッキング読み込みの代わり(閉じられたらすぐ抜ける)
+                if closed.wait(self.item_interval):
+                    return
+                yield {"アイ": f"{i}"}
+        finally:
+            with self._lock:
+                self.open_connections -= 1
+
+
+def test_rapid_interruptions(n_turns=300, interval=0.005):
+    """
+    割り込みを連打しても、スレッド数と開きっぱなしの接続数が増えないことを確認するストレステスト
+    (APIもスピーカーも使わないのでどこでも動く)
+    """
+    agent = AIAgent(autosave=False)
+    handler = _FakeStreamingHandler()
+    agent.gpt_handler = handler
+    base_threads = threading.active_count()
+    max_threads = base_threads
+    start_time = time.perf_counter()
+    for i in range(n_turns):
+        agent.stop_chat_thread()
+        agent.start_chatting(f"割り込み{i}")
+        max_threads = max(max_threads, threading.active_count())
+        time.sleep(interval)
+    # 最後のターンは最後まで話させる
+    finished = agent.end_event.wait(timeout=handler.item_interval * handler.n_items + 5)
+    elapsed = time.perf_counter() - start_time
+    agent.close()
+    print(f"{n_turns}回割り込み: {elapsed:.2f}秒, スレッド数 {base_threads} -> 最大 {max_threads}, "
+          f"同時接続数 最大 {handler.max_open_connections}, 残り {handler.open_connections}")
+    assert finished, "最後のターンが終わらなかった"
+    assert max_threads <= base_threads, "ターンごとにスレッドが増えている"
+    assert handler.max_open_connections <= 1, "中断したストリームが閉じられていない"
+    assert handler.open_connections == 0
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    test_rapid_interruptions()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+ChatBotの会話の進行(いつ応答を始めるか・いつ割り込まれたか)をasyncioのイベントで回すランタイム
+
+以前のChatBotは time.sleep(0.01) のループで音声認識のタイムアウトと agent.end_event を見に行っていたので，
+判断は最大10ms遅れ，何も起きていなくても毎秒100回起きていた．
+ここでは音声認識の結果とターンの終了をスレッドからイベントとして受け取り，
+次に判断すべき時刻(投機実行・応答開始・無言リセットのしきい値)まではイベントが来ない限り眠る．
+
+イベントは「起きる合図」で，音声認識の中身はrecognizerから読み直す(リセット前に届いた古い結果で応答しないように)．
+
+割り込み: 認識結果が変わるのを待つとクラウドの往復の分(数百ms)だけuserに被せて話し続けてしまうので，
+recognizer.vadがあれば，応答中に声が出た時点で(1フレーム以内に)スピーカーを一時停止する．
+その後，認識結果が変われば割り込みとして応答を中断し，声が止んでもbarge_in_confirm_seconds以内に認識結果が変わらなければ
+(咳や物音だった)一時停止したところから再開する．
+
+author: matsumoto
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Optional
+
+try:
+    from .speculation import normalize_transcript
+except ImportError:
+    from talk.speculation import normalize_transcript
+
+
+class RuntimeStats:
+    """ランタイムの計測値"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.wakeups = 0  # ループが起きた回数(イベント+しきい値)
+        self.events = 0  # 受け取ったイベント数
+        self.deadlines = 0  # しきい値で起きた回数
+        self.dispatch_delays = []  # イベントが発生してから処理されるまで(秒)
+        self.barge_in_pauses = 0  # 応答中の声でスピーカーを一時停止した回数
+        self.barge_ins_confirmed = 0  # そのうち認識結果が変わって割り込みになった回数
+        self.barge_ins_cancelled = 0  # そのうち認識結果が変わらず再開した回数
+        self.barge_in_confirm_delays = []  # 一時停止してから認識結果で割り込みと確定するまで(秒)．これだけ早く止められた
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        delays = sorted(self.dispatch_delays)
+        return {
+            "elapsed": elapsed,
+            "wakeups": self.wakeups,
+            "wakeups_per_sec": self.wakeups / elapsed if elapsed > 0 else None,
+            "events": self.events,
+            "deadlines": self.deadlines,
+            "max_dispatch_delay": delays[-1] if delays else None,
+            "p50_dispatch_delay": delays[len(delays) // 2] if delays else None,
+            "barge_in_pauses": self.barge_in_pauses,
+            "barge_ins_confirmed": self.barge_ins_confirmed,
+            "barge_ins_cancelled": self.barge_ins_cancelled,
+            "mean_barge_in_confirm_delay": (sum(self.barge_in_confirm_delays) / len(self.barge_in_confirm_delays)
+                                            if self.barge_in_confirm_delays else None),
+        }
+
+
+class ChatRuntime:
+    """
+    ChatBotの会話ループ．ChatBot.start_chattingから asyncio.run(ChatRuntime(bot).run()) で使う
+    botにはrecognizer, agent, speakers, response_start_threshold, speculation_threshold, idle_reset_seconds,
+    handle_user_input, handle_agent_output, respond, speculate, reset_conversation があればよい
+    bot.endpointer(endpointing.Endpointer)があれば，話し終わりの判断はresponse_start_thresholdの代わりにそれを使う
+    bot.recognizer.vadがあり，bot.barge_in_confirm_secondsがNoneでなければ，声で割り込みを検出する(speakersにpause/resumeが必要)
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.stats = RuntimeStats()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._events: Optional[asyncio.Queue] = None
+        self._stop_requested = threading.Event()
+
+    # --- 他のスレッドから呼ばれるもの ---
+
+    def _post(self, kind: str, payload=None) -> None:
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._events.put_nowait, (kind, payload, time.monotonic()))
+        except RuntimeError:
+            pass  # ループが閉じた直後
+
+    def _on_transcript(self, text: str) -> None:
+        """音声認識のスレッドから呼ばれる"""
+        self._post("transcript", text)
+
+    def _on_voice(self, is_speech: bool, at: float) -> None:
+        """VADから音声のスレッドで呼ばれる"""
+        if is_speech:
+            self._post("voice", at)
+
+    def _on_turn_end(self, output: dict) -> None:
+        """AIAgentのワーカースレッドから呼ばれる"""
+        self._post("turn_end", output)
+
+    def stop(self) -> None:
+        """run()を終わらせる(どのスレッドから呼んでもよい)"""
+        self._stop_requested.set()
+        self._post("stop")
+
+    def _response_deadline(self, last_transcript_at: float) -> float:
+        """応答を始める(userが話し終わったと判断する)時刻"""
+        endpointer = getattr(self.bot, "endpointer", None)
+        if endpointer is None:
+            return last_transcript_at + self.bot.response_start_threshold
+        recognizer = self.bot.recognizer
+        return endpointer.deadline(recognizer.get_latest_recognized(), last_transcript_at,
+                                   getattr(recognizer, "last_result_final", False))
+
+    def _barge_in_deadline(self, paused_at: float) -> float:
+        """一時停止を割り込みではなかったとみなして再開する時刻．声が続いている間は延ばす"""
+        vad = getattr(self.bot.recognizer, "vad", None)
+        if vad is not None and vad.is_speech:
+            return time.monotonic() + self.bot.barge_in_confirm_seconds
+        last_voice_at = vad.last_voice_at if vad is not None and vad.last_voice_at is not None else paused_at
+        return max(paused_at, last_voice_at) + self.bot.barge_in_confirm_seconds
+
+    # --- イベントループ ---
+
+    async def run(self) -> None:
+        bot = self.bot
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        bot.recognizer.add_listener(self._on_transcript)
+        bot.agent.turn_end_callbacks.append(self._on_turn_end)
+        vad = getattr(bot.recognizer, "vad", None)
+        if vad is not None:
+            vad.add_listener(self._on_voice)
+        try:
+            await self._run()
+        finally:
+            if vad is not None:
+                vad.remove_listener(self._on_voice)
+            bot.recognizer.remove_listener(self._on_transcript)
+            bot.agent.turn_end_callbacks.remove(self._on_turn_end)
+            self._loop = None
+            logging.debug(f"runtime stats: {self.stats.summary()}")
+            echo = getattr(bot.recognizer, "echo", None)
+            if echo is not None:
+                logging.debug(f"echo suppression stats: {echo.stats()}")
+            gate = getattr(bot.recognizer, "gate", None)
+            if gate is not None:
+                logging.debug(f"audio gate stats: {gate.stats()}")
+            frontend = getattr(bot.recognizer, "frontend", None)
+            if frontend is not None:
+                logging.debug(f"audio front-end stats: {frontend.stats()}")
+            if hasattr(bot.recognizer, "stats"):
+                logging.debug(f"speech recognition stats: {bot.recognizer.stats()}")
+
+    async def _run(self) -> None:
+        bot = self.bot
+        agent = bot.agent
+        recognizer = bot.recognizer
+        stats = self.stats
+        endpointer = getattr(bot, "endpointer", None)
+        vad = getattr(recognizer, "vad", None)
+        paused_at = None  # 応答中の声でスピーカーを一時停止した時刻(割り込みか確かめている間)
+        last_conversation_time = time.monotonic()
+        last_transcript_at = None  # 最後に認識結果が届いた時刻(monotonic)
+        responding = None  # 応答中の認識結果(これと違う結果が届いたら割り込み)
+        decided = True  # 今の認識結果で応答を始めたか
+        speculated = True  # 今の認識結果で投機実行したか
+        speculated_input = None  # 投機実行した(認識結果, handle_user_inputの結果)．commitとそろえるため，同じ認識結果ならこれを使う
+        bot.is_recognition_updated = False
+
+        while not self._stop_requested.is_set():
+            # 次に判断すべき時刻を決めて，それまではイベントを待つ
+            deadlines = [last_conversation_time + bot.idle_reset_seconds]
+            if last_transcript_at is not None and responding is None:
+                if not decided:
+                    deadlines.append(self._response_deadline(last_transcript_at))
+                if not speculated and bot.speculation_threshold is not None and not bot.is_recognition_updated:
+                    deadlines.append(last_transcript_at + bot.speculation_threshold)
+            if paused_at is not None:
+                deadlines.append(self._barge_in_deadline(paused_at))
+            timeout = max(0.0, min(deadlines) - time.monotonic())
+            try:
+                kind, payload, posted_at = await asyncio.wait_for(self._events.get(), timeout)
+                stats.events += 1
+                stats.dispatch_delays.append(time.monotonic() - posted_at)
+            except asyncio.TimeoutError:
+                kind, payload, posted_at = "deadline", None, None
+                stats.deadlines += 1
+            stats.wakeups += 1
+            now = time.monotonic()
+
+            if kind == "stop":
+                break
+
+            if kind == "transcript":
+                text = recognizer.get_latest_recognized()
+                if not text:
+                    continue  # リセット前に届いた古い結果
+                last_transcript_at = posted_at
+                decided = False
+                speculated = False
+                if endpointer is not None:
+                    endpointer.observe_transcript(posted_at)
+                speculation = getattr(agent, "speculation", None)
+                if speculation is not None and (speculated_input is None or
+                                                normalize_transcript(speculated_input[0]) != normalize_transcript(text)):
+                    agent.cancel_speculation()  # 話し続けているので，古い途中結果での投機実行は捨てる
+                if responding is not None and text != responding:
+                    # 再び話し始めたっぽかったら(言葉に詰まったあと再び話し始めたら)応答を中断
+                    logging.debug("大変だ！また話し始めたぞ！")
+                    if paused_at is not None:
+                        stats.barge_ins_confirmed += 1
+                        stats.barge_in_confirm_delays.append(posted_at - paused_at)
+                        paused_at = None
+                    if endpointer is not None:
+                        endpointer.record_continuation(posted_at, text)  # 話し終わりの判断が早すぎたなら学習する
+                    for speaker in bot.speakers:
+                        speaker.interrupt()
+                    agent.cancel_chatting()
+                    bot.is_recognition_updated = True
+                    responding = None
+                continue
+
+            if kind == "voice":
+                if responding is None or paused_at is not None or bot.barge_in_confirm_seconds is None:
+                    continue
+                # 応答中に声が出た．認識結果を待たずにまず止める
+                logging.debug("声がしたので応答を一時停止")
+                for speaker in bot.speakers:
+                    speaker.pause()
+                paused_at = posted_at
+                stats.barge_in_pauses += 1
+                continue
+
+            if kind == "turn_end":
+                if responding is None:
+                    continue  # 割り込んだ後に届いた，中断前のターンの終了
+                logging.debug("agent turn end!")
+                paused_at = None
+                bot.handle_agent_output(agent.get_recent_output())  # agentが話したことについて何か処理する
+                if endpointer is not None:
+                    endpointer.end_turn()
+                last_conversation_time = now
+                recognizer.reset_recognition()  # 音声認識をリセット
+                bot.is_recognition_updated = False
+                responding = None
+                last_transcript_at = None
+                continue
+
+            # しきい値の時刻になった
+            if paused_at is not None and now >= self._barge_in_deadline(paused_at):
+                # 声はしたが認識結果が変わらなかった(咳・物音など)ので，止めたところから話し続ける
+                logging.debug("割り込みではなかったので応答を再開")
+                for speaker in bot.speakers:
+                    speaker.resume()
+                paused_at = None
+                stats.barge_ins_cancelled += 1
+            if now - last_conversation_time > bot.idle_reset_seconds:
+                # キャッシュが無限にたまると困るので、一定時間ごとに初期化
+                logging.debug(f"最後の会話から{bot.idle_reset_seconds}秒経過したのでいろいろ初期化")
+                last_conversation_time = now
+                bot.reset_conversation()
+                last_transcript_at = None
+                continue
+            if last_transcript_at is None or responding is not None:
+                continue
+            text = recognizer.get_latest_recognized()
+            if not decided and now >= self._response_deadline(last_transcript_at):
+                decided = True
+                if endpointer is not None:
+                    endpointer.record_decision(now, last_transcript_at, text)
+                if speculated_input is not None and speculated_input[0] == text:
+                    gpt_input = speculated_input[1]  # 投機実行のときに処理済み(同じ入力を2回処理しない)
+                else:
+                    gpt_input = bot.handle_user_input(text)  # 手動処理
+                speculated_input = None
+                if gpt_input and gpt_input.strip():  # 反応すべきテキストが存在するかの確認
+                    bot.respond(gpt_input)  # AI応答(話し終わりはturn_endで受け取る)
+                    responding = text
+            elif (not speculated and bot.speculation_threshold is not None and not bot.is_recognition_updated
+                  and now - last_transcript_at >= bot.speculation_threshold):
+                speculated = True
+                if text and text.strip() and getattr(agent, "speculation", None) is None:
+                    # respondでcommitするのはhandle_user_inputの結果なので，投機実行もそれで送る
+                    gpt_input = bot.handle_user_input(text)
+                    speculated_input = (text, gpt_input)
+                    if gpt_input and gpt_input.strip():
+                        bot.speculate(gpt_input)  # 確定を待つ間に、途中結果でリクエストを先に送っておく
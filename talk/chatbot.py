@@ -1,95 +1,143 @@
 try:
     # talkパッケージ外からの参照
-    from .gpt.ai_agent import AIAgent, MultiAIAgent
-    from .speech.speech_wrapper import VoiceVoxSpeaker, AivisSpeechSpeaker
-    from .speech.google_stt import SpeechRecognizer
+    from .ai_agent import AIAgent, MultiAIAgent
+    from .conversation_db import ConversationDB
+    from .long_term_memory import LongTermMemory
+    from .speech.filler_cache import FillerCache
+    from .chat_runtime import ChatRuntime
+    from .endpointing import Endpointer
 except ImportError:
     # 内部からの参照
-    from talk.gpt.ai_agent import AIAgent, MultiAIAgent
-    from speech.speech_wrapper import VoiceVoxSpeaker, AivisSpeechSpeaker
-    from speech.google_stt import SpeechRecognizer
-
+    from talk.ai_agent import AIAgent, MultiAIAgent
+    from talk.conversation_db import ConversationDB
+    from talk.long_term_memory import LongTermMemory
+    from speech.filler_cache import FillerCache
+    from talk.chat_runtime import ChatRuntime
+    from talk.endpointing import Endpointer
+
+import asyncio
 import logging
-import time
 import random
 
 
 
 class ChatBot():
-    def __init__(self) -> None:
+    def __init__(self, recognizer=None, speakers=None, conversation_db: ConversationDB = None, autosave=True, agent: AIAgent = None, endpointer: Endpointer = None) -> None:
+        """
+        Parameters:
+            recognizer: 音声認識(google_stt.SpeechRecognizerと同じメソッドを持つもの)。Noneならマイク+Google STT
+            speakers (list): スピーカーのリスト。NoneならAivisSpeech
+            conversation_db (ConversationDB): 会話の保存先。Noneなら.user_data/conversation.db
+            autosave (bool): 会話ログをジャーナルに自動保存するかどうか
+            agent (AIAgent): 会話するエージェント。NoneならDB・長期記憶・相槌つきのMultiAIAgent(diary_makerのように別のエージェントで動かす用)
+            endpointer (Endpointer): 話し終わりの推定器。Noneなら音声認識のVADを使い、userごとの学習結果を.user_data/に保存するもの
+        (replay.pyのように、マイクやAPIの代わりに偽物を渡して動かすための引数。普段は全部省略でよい)
+        """
 
         # ロギングの設定
         logging.basicConfig(level=logging.DEBUG)
 
 
         # 音声認識関係の設定
-        self.recognizer = SpeechRecognizer(sensitivity=1)  # 音声認識インスタンスの生成
-        self.response_start_threshold = 1  # 反応を開始する音声認識の間隙のしきい値の設定
+        if recognizer is None:
+            # マイクとGoogle STTが要るので、使うときだけimportする
+            try:
+                from .speech.google_stt import SpeechRecognizer
+            except ImportError:
+                from speech.google_stt import SpeechRecognizer
+            recognizer = SpeechRecognizer(sensitivity=1)  # 音声認識インスタンスの生成
+        self.recognizer = recognizer
+        self.response_start_threshold = 1  # 反応を開始する音声認識の間隙のしきい値の設定(endpointerがNoneのとき)
+        self.speculation_threshold = 0.3  # 途中結果でGPTへのリクエストを先に送っておく(投機実行)間隙のしきい値。Noneで無効
+        self.idle_reset_seconds = 240  # 互いに無言のままこの秒数が経ったら会話ログと音声認識をリセットする
+        self.barge_in_confirm_seconds = 1.0  # 応答中の声で一時停止してから，声が止んで何秒認識結果が変わらなければ再開するか。Noneで声による割り込み検出を無効
 
         # スピーカーの設定
-        # self.speakers=[VoiceVoxSpeaker(speaker_id=43)]  # VoiceVoxスピーカーの設定
-        self.speakers=[AivisSpeechSpeaker(speaker_id=888753761),AivisSpeechSpeaker(speaker_id=888753761)]  # AivisSpeechスピーカーの設定
+        if speakers is None:
+            try:
+                from .speech.speech_wrapper import VoiceVoxSpeaker, AivisSpeechSpeaker
+            except ImportError:
+                from speech.speech_wrapper import VoiceVoxSpeaker, AivisSpeechSpeaker
+            # speakers=[VoiceVoxSpeaker(speaker_id=43)]  # VoiceVoxスピーカーの設定
+            speakers=[AivisSpeechSpeaker(speaker_id=888753761),AivisSpeechSpeaker(speaker_id=888753761)]  # AivisSpeechスピーカーの設定
+        self.speakers=speakers
+
+        if agent is None:
+            # 会話モードの設定(会話はDBに残し、リセット後に話しかけられたら直近の会話を思い出す)
+            if conversation_db is None:
+                conversation_db = ConversationDB()
+            memory = LongTermMemory()
+            memory.load_from_db(conversation_db, "default")  # 過去の会話を長期記憶に読み込む
+            # GPTの応答を待つ間に流す相槌(起動時に裏で合成しておく)
+            filler_cache = FillerCache(self.speakers, fillers={0: ["うん", "なるほどなのだ", "そうなのだ"], 1: ["そうね", "ふうん", "なるほどね"]})
+            filler_cache.warm_up()
+            agent=MultiAIAgent(speakers=self.speakers, autosave=autosave, conversation_db=conversation_db, long_term_memory=memory, filler_cache=filler_cache)
+        self.agent=agent
+        # 話し終わりの推定(VAD・is_final・文末の形・userごとの学習)。Noneにするとresponse_start_thresholdの固定値で判断する
+        if endpointer is None:
+            endpointer = Endpointer(vad=getattr(self.recognizer, "vad", None), fixed_threshold=self.response_start_threshold,
+                                    profile_path=".user_data/endpointing.json", user_id=getattr(self.agent, "user_id", "default"))
+        self.endpointer = endpointer
+        self.is_recognition_updated=False  # userが応答に割り込んだか(次の応答はupdate_chattingで送る)
+        self.runtime = ChatRuntime(self)
 
-        # 会話モードの設定
-        self.agent=MultiAIAgent(speakers=self.speakers)
-    
     def start_chatting(self) -> None:
+        """
+        会話を始める(stop()が呼ばれるまで戻らない)
+        音声認識の結果とターンの終了はChatRuntimeのイベントループで受け取り、届いた瞬間に判断する
+        """
+        asyncio.run(self.runtime.run())
+
+    def stop(self) -> None:
+        """start_chattingを終わらせる(別スレッドから呼ぶ)"""
+        self.runtime.stop()
+
+    def reset_conversation(self) -> None:
+        """無言が続いたときの初期化"""
+        self.agent.reset()  # agentを初期化
+        self.recognizer.reset_recognition()  # 音声認識をリセット
 
-        # 音声認識の更新フラグの初期化
-        self.is_recognition_updated=False
-        self.last_conversation_time=time.time()
-        while True:
-            time.sleep(0.01)
-
-            # キャッシュが無限にたまると困るので、一定時間ごとに音声認識を初期化
-            if time.time() - self.last_conversation_time > 240:  # 互いに無言のまま240秒経過したら
-                logging.debug("最後の会話から240秒経過したのでいろいろ初期化")
-                self.last_conversation_time = time.time()  # 時間を更新
-                self.agent.reset()  # agentを初期化
-                self.recognizer.reset_recognition()  # 音声認識をリセット
-            
-            # 音声認識結果 -> user_utteranceに対して処理
-            if self.recognizer.is_timed_out(self.response_start_threshold):  # 最後の認識から一定市場の時間が経過したら
-                user_utterance=self.recognizer.get_latest_recognized()
-                gpt_input=self.handle_user_input(user_utterance) # 手動処理
-                self.respond(gpt_input) # AI応答
+    def speculate(self, text) -> None:
+        """
+        userが少し黙ったら、その時点の認識結果でGPTへのリクエストを先に送っておく(応答はrespondでcommitされるまで話さない)
+        認識結果が変わったらChatRuntimeが投機実行を捨てる
+        """
+        self.resume_if_needed()
+        self.agent.speculate(text)
+
+    def resume_if_needed(self) -> None:
+        """リセット後の最初の発話なら、前回までの会話を少しだけ思い出す"""
+        if len(self.agent.dialog_store) == 0:
+            self.agent.resume()
 
     def respond(self,text)-> None:
-        time.sleep(0.2)
-        if text and text.strip():  # 反応すべきテキストが存在するかの確認
-            logging.debug("反応開始！")
-            # 話してる途中だったら中断する
-            for speaker in self.speakers:
-                speaker.interrupt()  # スピーカーの中断
-            self.agent.stop_chat_thread()  # GPTスレッドの停止
-            # GPTに入力を送信
-            if not self.is_recognition_updated:
-                # 普通の入力だったら普通に応答する
-                self.agent.start_chatting(text)
-            else:
-                # userが割り込んできていたら割り込みモードで応答する
-                self.agent.update_chatting(text)
-            # エージェントが話し終わるまで待機
-            while not self.agent.end_event.is_set(): 
-                # 再び話し始めたっぽかったら(言葉に詰まったあと再び話し始めたら)応答を中断
-                if self.recognizer.get_latest_recognized() != text:
-                    logging.debug("大変だ！また話し始めたぞ！") 
-                    for speaker in self.speakers:
-                        speaker.interrupt()
-                    self.agent.cancel_chatting()
-                    self.is_recognition_updated = True
-                    break
-                time.sleep(0.01)
-            
-            logging.debug("待機ループ脱出！") 
-            # (割り込まれず)最後まで話したか？
-            if self.agent.end_event.is_set():
-                logging.debug("agent turn end!")
-                self.handle_agent_output(self.agent.get_recent_output()) # agentが話したことについて何か処理する
-                self.last_conversation_time = time.time()
-                self.recognizer.reset_recognition()  # 音声認識をリセット
-                self.is_recognition_updated = False
+        """
+        GPTに入力を送る(待たない。話し終わりや割り込みはChatRuntimeが受け取る)
+        """
+        logging.debug("反応開始！")
+        if self.speculation_threshold is not None and not self.is_recognition_updated and self.agent.commit_speculation(text):
+            # 途中結果で先に送っておいたリクエストがそのまま使えた
+            logging.debug(f"投機実行の応答を使用: {self.agent.speculation_stats.summary()}")
+        else:
+            self.start_response(text)
     
+    def start_response(self, text) -> None:
+        """
+        話している途中なら中断して、GPTに入力を送信する
+        """
+        # 話してる途中だったら中断する
+        for speaker in self.speakers:
+            speaker.interrupt()  # スピーカーの中断
+        self.agent.stop_chat_thread()  # GPTスレッドの停止(投機実行中のリクエストも捨てる)
+        self.resume_if_needed()
+        # GPTに入力を送信
+        if not self.is_recognition_updated:
+            # 普通の入力だったら普通に応答する
+            self.agent.start_chatting(text)
+        else:
+            # userが割り込んできていたら割り込みモードで応答する
+            self.agent.update_chatting(text)
+
     def handle_user_input(self,text):
         """
         userの入力から特定の処理を行う
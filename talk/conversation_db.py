@@ -0,0 +1,207 @@
+"""
+AIAgentの会話をSQLiteに保存しておくためのモジュール
+セッション(1回の会話)・ターン(発話1件)・ターンごとのメタデータ(応答時間，トークン数，感情)を保存する．
+
+ChatBotは240秒無言だと会話ログを捨ててしまうので，戻ってきたuserとは最初からやり直しになっていた．
+ここに保存しておけば，recent_turns()で直近の会話をインデックス経由で(O(log n)で)引いてきて，すぐに思い出せる．
+
+author: matsumoto
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    agent_name TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_user_time ON sessions(user_id, started_at);
+
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    user_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    is_json INTEGER NOT NULL DEFAULT 0,
+    latency REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    emotion TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_turns_session_time ON turns(session_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_turns_user_time ON turns(user_id, created_at);
+"""
+
+
+class ConversationDB:
+    """
+    会話の保存先．複数スレッドから使ってよい(書き込みはlockで直列化)
+    """
+
+    def __init__(self, path: str = ".user_data/conversation.db"):
+        """
+        Args:
+            path (str): SQLiteファイルのパス
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # WALにしておくと読み込みが書き込みを待たない．synchronous=NORMALはWALなら電源断以外では壊れない
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def start_session(self, user_id: str, agent_name: str = "") -> int:
+        """
+        新しいセッションを始める
+
+        Returns:
+            int: セッションID
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO sessions (user_id, agent_name, started_at) VALUES (?, ?, ?)",
+                (user_id, agent_name, time.time()),
+            )
+            self._conn.commit()
+            return cur.lastrowid
+
+    def end_session(self, session_id: int) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE sessions SET ended_at = ? WHERE id = ?", (time.time(), session_id))
+            self._conn.commit()
+
+    def add_turn(self, session_id: int, user_id: str, role: str, content, latency: Optional[float] = None,
+                 prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None,
+                 emotion: Optional[str] = None, created_at: Optional[float] = None) -> int:
+        """
+        ターン(発話1件)を保存する
+
+        Args:
+            session_id (int): セッションID
+            user_id (str): userのID
+            role (str): "user"または"assistant"
+            content (str or dict): 発話の内容．辞書はJSONにして保存する
+            latency (float): 応答にかかった秒数
+            prompt_tokens, completion_tokens (int): トークン数
+            emotion (str): GPTが出力した感情
+            created_at (float): 発話の時刻(UNIX時間)．省略時は今．長期記憶と同じ時刻にしたいときに指定する
+
+        Returns:
+            int: ターンID
+        """
+        is_json = isinstance(content, dict)
+        text = json.dumps(content, ensure_ascii=False) if is_json else str(content)
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO turns (session_id, user_id, created_at, role, content, is_json, latency, prompt_tokens, completion_tokens, emotion)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (session_id, user_id, time.time() if created_at is None else created_at, role, text, int(is_json), latency, prompt_tokens, completion_tokens, emotion),
+            )
+            self._conn.commit()
+            return cur.lastrowid
+
+    def recent_turns(self, user_id: str, limit: int = 20, since: Optional[float] = None,
+                     exclude_session: Optional[int] = None) -> list:
+        """
+        userの直近のターンを古い順に返す(セッションをまたいでよい)
+
+        Args:
+            user_id (str): userのID
+            limit (int): 最大件数
+            since (float): これより前のターンは返さない(UNIX時間)
+            exclude_session (int): このセッションのターンは除く(今のセッションの分はメモリにあるので)
+
+        Returns:
+            list: {"role", "content", "created_at", "session_id", "emotion"}の辞書のリスト．contentはJSONなら辞書に戻す
+        """
+        query = "SELECT session_id, created_at, role, content, is_json, emotion FROM turns WHERE user_id = ?"
+        params = [user_id]
+        if since is not None:
+            query += " AND created_at >= ?"
+            params.append(since)
+        if exclude_session is not None:
+            query += " AND session_id != ?"
+            params.append(exclude_session)
+        # (user_id, created_at)のインデックスを後ろから辿るだけなので件数が増えても速い
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row_to_turn(row) for row in reversed(rows)]
+
+    def iter_turns(self, user_id: str, batch_size: int = 1000):
+        """
+        userの全ターンを古い順に流す(長期記憶のインデックス作成用)．lockはbatch_size件ごとにしか取らない
+
+        Yields:
+            dict: recent_turnsと同じ形式の辞書
+        """
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, session_id, created_at, role, content, is_json, emotion FROM turns"
+                    " WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+                    (user_id, last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1]["id"]
+            for row in rows:
+                yield self._row_to_turn(row)
+
+    def session_turns(self, session_id: int) -> list:
+        """セッションのターンを古い順に返す"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id, created_at, role, content, is_json, emotion FROM turns WHERE session_id = ? ORDER BY created_at",
+                (session_id,),
+            ).fetchall()
+        return [self._row_to_turn(row) for row in rows]
+
+    def recent_sessions(self, user_id: str, limit: int = 10) -> list:
+        """userの直近のセッションを新しい順に返す"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, agent_name, started_at, ended_at FROM sessions WHERE user_id = ? ORDER BY started_at DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _row_to_turn(row) -> dict:
+        content = row["content"]
+        if row["is_json"]:
+            try:
+                content = json.loads(content)
+            except json.JSONDecodeError:
+                logging.debug("JSONとして読めないターンがありました: %s", content)
+        return {
+            "session_id": row["session_id"],
+            "created_at": row["created_at"],
+            "role": row["role"],
+            "content": content,
+            "emotion": row["emotion"],
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
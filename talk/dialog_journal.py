@@ -0,0 +1,216 @@
+"""
+会話ログの自動保存用ジャーナル
+以前はput_dialogのたびにsave_dialogで会話全体をテキストに書き直していた(ストリーミングの1項目ごとに全体を書き直すのでO(n^2)，しかも応答スレッド上)．
+ここでは変更点だけを1行1イベントのJSONLとして追記し，書き込みは専用スレッドでまとめて行う．
+会話ログはload_journal()でイベントを順に適用し直せば復元できる．
+
+イベントの形式
+- {"op": "put", "role": ..., "content": ..., "t": 時刻}  DialogStore.putと同じ(同じroleならマージ)
+- {"op": "pop", "role": ...}                          DialogStore.pop_ifと同じ
+- {"op": "clear"}                                     DialogStore.clearと同じ
+
+author: matsumoto
+"""
+
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+try:
+    from .dialog_store import DialogStore
+except ImportError:
+    from dialog_store import DialogStore
+
+
+class DialogJournal:
+    """
+    会話ログの変更イベントを専用スレッドでJSONLに追記するクラス
+    append()はキューに積むだけなので応答スレッドをブロックしない
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5, fsync_interval: float = 5.0,
+                 max_batch: int = 256, rotate_bytes: int = 8 * 1024 * 1024, compress_rotated: bool = True):
+        """
+        Args:
+            path (str): ジャーナルのパス(.jsonl)
+            flush_interval (float): 何秒ごとにまとめて書き出すか
+            fsync_interval (float): 何秒ごとにfsyncしてディスクに確実に書き込むか
+            max_batch (int): この数のイベントが溜まったらflush_intervalを待たずに書き出す
+            rotate_bytes (int): ファイルがこのサイズを超えたらローテーションする
+            compress_rotated (bool): ローテーションしたファイルをgzip圧縮するか
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_batch = max_batch
+        self.rotate_bytes = rotate_bytes
+        self.compress_rotated = compress_rotated
+
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._flushed = threading.Condition()
+        self._written = 0  # 書き出し済みのイベント数
+        self._enqueued = 0  # キューに積んだイベント数
+        self._enqueue_lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        # 前回書き込み途中で落ちていた場合，壊れた行に次のイベントがくっつかないよう改行を補う
+        if self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+        self._last_fsync = time.time()
+        self._thread = threading.Thread(target=self._writer_loop, name="dialog_journal", daemon=True)
+        self._thread.start()
+
+    def append(self, op: str, **payload) -> None:
+        """
+        イベントを1つ積む(書き込みは専用スレッドで行う)
+
+        Args:
+            op (str): "put", "pop", "clear"のいずれか
+            payload: イベントの中身(role, contentなど)
+        """
+        if self._closed.is_set():
+            return
+        event = {"op": op, "t": time.time(), **payload}
+        with self._enqueue_lock:
+            self._enqueued += 1
+            self._queue.put(event)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """
+        それまでに積んだイベントが書き出されるまで待つ
+
+        Returns:
+            bool: 時間内に書き出されたかどうか
+        """
+        with self._enqueue_lock:
+            target = self._enqueued
+        self._queue.put(None)  # 書き込みスレッドを起こす
+        with self._flushed:
+            return self._flushed.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self) -> None:
+        """残りを書き出してfsyncし，スレッドを止める"""
+        if self._closed.is_set():
+            return
+        self.flush()
+        self._closed.set()
+        self._queue.put(None)
+        self._thread.join(timeout=5.0)
+
+    def _writer_loop(self) -> None:
+        """
+        書き込みスレッド: イベントをまとめて書き出し，一定間隔でfsyncとローテーションを行う
+        """
+        while not (self._closed.is_set() and self._queue.empty()):
+            # 何か来るまではブロックして待つ(アイドル中に無駄に起きない)
+            event = self._queue.get()
+            batch = [] if event is None else [event]
+            # 最初のイベントからflush_intervalの間，またはmax_batch個溜まるまでまとめる
+            deadline = time.time() + self.flush_interval
+            while event is not None and len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is not None:  # Noneはflush/closeの合図
+                    batch.append(event)
+            if batch:
+                self._write_batch(batch)
+        self._fsync()
+        self._file.close()
+
+    def _write_batch(self, batch: list) -> None:
+        try:
+            self._file.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in batch))
+            self._file.flush()
+            if time.time() - self._last_fsync >= self.fsync_interval:
+                self._fsync()
+            if self._file.tell() >= self.rotate_bytes:
+                self._rotate()
+        except Exception as e:
+            logging.debug("ジャーナルの書き込みに失敗しました: %s", e)
+        with self._flushed:
+            self._written += len(batch)
+            self._flushed.notify_all()
+
+    def _fsync(self) -> None:
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except (OSError, ValueError):
+            pass
+        self._last_fsync = time.time()
+
+    def _rotate(self) -> None:
+        """
+        現在のファイルを<path>.<連番>(.gz)に退避して新しいファイルに切り替える．
+        load_journalは退避したファイルも連番順に読むので，会話は最初から復元できる
+        """
+        self._fsync()
+        self._file.close()
+        index = len(_rotated_files(self.path)) + 1
+        rotated = f"{self.path}.{index:04d}"
+        os.replace(self.path, rotated)
+        if self.compress_rotated:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                dst.writelines(src)
+            os.remove(rotated)
+        self._file = open(self.path, "a", encoding="utf-8")
+        logging.debug("ジャーナルをローテーションしました: %s", rotated)
+
+
+def _rotated_files(path: str) -> list:
+    """ローテーション済みのファイルを連番順に返す"""
+    files = glob.glob(glob.escape(path) + ".[0-9][0-9][0-9][0-9]") + glob.glob(glob.escape(path) + ".[0-9][0-9][0-9][0-9].gz")
+    return sorted(files, key=lambda f: f[len(path) + 1:len(path) + 5])
+
+
+def _iter_events(path: str):
+    """ローテーション済みのファイルも含めてイベントを古い順に流す"""
+    for file_path in _rotated_files(path) + ([path] if os.path.exists(path) else []):
+        opener = gzip.open if file_path.endswith(".gz") else open
+        with opener(file_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた最後の行
+                    logging.debug("壊れた行を読み飛ばしました: %s", file_path)
+
+
+def load_journal(path: str, store: DialogStore = None) -> DialogStore:
+    """
+    ジャーナルを読み込んで会話ログを復元する
+
+    Args:
+        path (str): ジャーナルのパス
+        store (DialogStore): 復元先．省略時は新しく作る
+
+    Returns:
+        DialogStore: 復元した会話ログ
+    """
+    store = store if store is not None else DialogStore()
+    for event in _iter_events(path):
+        op = event.get("op")
+        if op == "put":
+            store.put(event["role"], event["content"])
+        elif op == "pop":
+            store.pop_if(event["role"])
+        elif op == "clear":
+            store.clear()
+    return store
@@ -0,0 +1,267 @@
+"""
+AIAgentの会話ログ(dialog)を保持するためのクラス群
+
+以前はassistantの出力をstr(dict)で持っておき，ストリーミングで次の辞書が来るたびにeval()で辞書に戻してupdateしていた．
+これだとターンが長くなるほど1回のマージが重くなる上に，モデルの出力をPythonとして評価することになるので危ない．
+ここでは辞書は辞書のまま持っておき，マージはdict.update一発で済ませる．
+文字列への変換はAPIに送るメッセージを作るとき(to_api_messages)に1回だけ行う．
+会話ログはコピーオンライトの不変なtupleで持つので，読み込み側はlockを取らずにスナップショットを受け取れる．
+ただしストリーミング中のassistantの出力(末尾のメッセージ)だけはlockの中で可変のまま持ち，マージを1項目分のupdateで済ませる．
+末尾はターンの終わり(seal)か次のメッセージの追加で不変なDialogMessageにする．
+
+author: matsumoto
+"""
+
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Tuple, Union
+
+
+class TimedLock:
+    """
+    保持時間を計測できるLock
+    `with lock:` でもacquire()/release()でも使える．計測値はstats()で取れる
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.count = 0  # 取得回数
+        self.total_hold = 0.0  # 保持時間の合計(秒)
+        self.max_hold = 0.0  # 保持時間の最大(秒)
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired_at = time.perf_counter()
+        return acquired
+
+    def release(self) -> None:
+        held = time.perf_counter() - self._acquired_at
+        # lockを持っている間に更新するのでカウンタ自体の競合はない
+        self.count += 1
+        self.total_hold += held
+        if held > self.max_hold:
+            self.max_hold = held
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: {"count": 取得回数, "total_ms": 保持時間の合計, "mean_us": 平均, "max_us": 最大}
+        """
+        count = self.count
+        return {
+            "count": count,
+            "total_ms": self.total_hold * 1e3,
+            "mean_us": (self.total_hold / count * 1e6) if count else 0.0,
+            "max_us": self.max_hold * 1e6,
+        }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.count = 0
+            self.total_hold = 0.0
+            self.max_hold = 0.0
+
+
+@dataclass(frozen=True)
+class DialogMessage:
+    """
+    会話ログ1件分(不変)
+    contentはuserの発話なら文字列，assistantのJSON出力なら辞書のまま持つ．
+    DialogStoreのスナップショット同士で共有されるので，contentの辞書も書き換えないこと(マージはDialogStoreの中の_OpenMessageで行う)
+    """
+
+    role: str
+    content: Union[str, dict]
+    created_at: float = field(default_factory=time.time)
+
+    def content_text(self) -> str:
+        """APIやログに出す用の文字列"""
+        if isinstance(self.content, dict):
+            return json.dumps(self.content, ensure_ascii=False)
+        return self.content
+
+    def to_api(self) -> dict:
+        """OpenAI APIに渡す形式({'role': ..., 'content': ...})にする．不変なので1回作ったら使い回す"""
+        cached = self.__dict__.get("_api")
+        if cached is None:
+            cached = {"role": self.role, "content": self.content_text()}
+            object.__setattr__(self, "_api", cached)
+        return dict(cached)
+
+
+class _OpenMessage:
+    """
+    マージ中の末尾のメッセージ(可変)．DialogStoreのlockの中でしか触らない
+    辞書はそのままupdateし，文字列は断片をリストに溜めておくので，1回のマージは届いた分の大きさだけで済む
+    """
+
+    def __init__(self, role: str, content, created_at: Optional[float] = None):
+        self.role = role
+        self.created_at = time.time() if created_at is None else created_at
+        self.is_dict = isinstance(content, dict)
+        self.content = dict(content) if self.is_dict else [content]
+
+    def merge(self, content) -> bool:
+        """contentをマージする．マージできない組み合わせならFalse"""
+        if self.is_dict and isinstance(content, dict):
+            self.content.update(content)
+            return True
+        if not self.is_dict and isinstance(content, str):
+            self.content.append(content)
+            return True
+        return False
+
+    def freeze(self, copy: bool = True) -> DialogMessage:
+        """
+        不変なDialogMessageにする
+
+        Args:
+            copy (bool): Falseなら辞書をコピーせずに渡す(以降このオブジェクトを使わないとき)
+        """
+        if self.is_dict:
+            content = dict(self.content) if copy else self.content
+        else:
+            content = "".join(self.content)
+            self.content = [content]  # 次にfreezeするときに連結し直さないように
+        return DialogMessage(self.role, content, self.created_at)
+
+
+class DialogStore:
+    """
+    DialogMessageの列をコピーオンライトで保持するクラス
+
+    会話ログ本体は不変のtupleで，書き込み側(put/pop_if/clear)だけがlockを取り，新しいtupleを作って参照を差し替える．
+    参照の差し替えはアトミックなので，読み込み側(snapshot/to_api_messages/last_role…)はlockを取らず，
+    その時点のtupleをそのまま受け取る(O(1)，コピーなし)．ストリーミング中の書き込みと自動保存やUIからの読み込みが互いを待たない
+
+    ストリーミングで同じroleのマージが続く間は，末尾を可変の_OpenMessageで持ってtupleは作り直さない(1回のマージはO(届いた項目))．
+    読み込み側はマージがあった後の最初のsnapshotだけlockを取って末尾を固めたtupleを作り，次のマージまで使い回す
+    """
+
+    def __init__(self):
+        self._messages: Tuple[DialogMessage, ...] = ()  # 固めたメッセージ(末尾の_openを含まない)
+        self._open: Optional[_OpenMessage] = None  # マージ中の末尾のメッセージ
+        self._view: Optional[Tuple[DialogMessage, ...]] = ()  # 読み込み側に渡すtuple(末尾を含む)．Noneなら作り直す
+        self.lock = TimedLock()  # 書き込み同士の競合防止用のlock
+
+    def put(self, role: str, content) -> str:
+        """
+        メッセージを追加する．直前と同じroleの場合は直前のメッセージにマージする
+        - 辞書同士: 直前の辞書にupdate (ストリーミングで1項目ずつ届くassistantの出力)
+        - 文字列同士: 直前の文字列に連結
+        - それ以外: 新しいメッセージとして追加
+
+        Args:
+            role (str): "user"または"assistant"
+            content (str or dict): メッセージの内容
+
+        Returns:
+            str: マージした場合は"merge"，追加した場合は"append"
+        """
+        # 呼び出し元の辞書を後から書き換えられても影響しないようにコピーして持つ
+        content = dict(content) if isinstance(content, dict) else str(content)
+        with self.lock:
+            self._view = None
+            if self._open is None and self._messages and self._messages[-1].role == role:
+                # sealした後に同じroleが来た場合は，固めた末尾を開き直す(ターンに1回だけなのでコピーしてよい)
+                last = self._messages[-1]
+                if isinstance(last.content, dict) == isinstance(content, dict):
+                    self._open = _OpenMessage(last.role, last.content, last.created_at)
+                    self._messages = self._messages[:-1]
+            if self._open is not None and self._open.role == role and self._open.merge(content):
+                return "merge"
+            self._seal_locked()
+            self._open = _OpenMessage(role, content)
+            return "append"
+
+    def seal(self) -> None:
+        """マージ中の末尾を不変なDialogMessageに固める(ターンの終わりに呼ぶ)"""
+        with self.lock:
+            self._seal_locked()
+            self._view = None
+
+    def _seal_locked(self) -> None:
+        if self._open is not None:
+            self._messages = self._messages + (self._open.freeze(copy=False),)
+            self._open = None
+
+    def pop_if(self, role: str) -> Optional[DialogMessage]:
+        """
+        最後のメッセージが指定のroleなら取り除いて返す
+
+        Returns:
+            DialogMessage: 取り除いたメッセージ．取り除かなかった場合はNone
+        """
+        with self.lock:
+            self._seal_locked()
+            messages = self._messages
+            if messages and messages[-1].role == role:
+                self._messages = self._view = messages[:-1]
+                return messages[-1]
+            return None
+
+    def last_role(self) -> Optional[str]:
+        open_message = self._open
+        if open_message is not None:
+            return open_message.role
+        messages = self._messages
+        return messages[-1].role if messages else None
+
+    def last_content(self, role: str):
+        """
+        指定したroleの最新のメッセージの内容を返す．無ければNone
+        """
+        for message in reversed(self.snapshot()):
+            if message.role == role:
+                return message.content
+        return None
+
+    def snapshot(self) -> Tuple[DialogMessage, ...]:
+        """
+        現在の会話ログを返す．不変なのでコピーせずそのまま渡す(O(1))
+        マージ中の末尾があれば，前回のsnapshotの後にマージがあったときだけlockを取って固めたtupleを作る
+
+        Returns:
+            tuple: DialogMessageのtuple
+        """
+        view = self._view
+        if view is not None:
+            return view
+        with self.lock:
+            if self._view is None:
+                self._view = self._messages + (self._open.freeze(),) if self._open is not None else self._messages
+            return self._view
+
+    def to_api_messages(self, prefix: Optional[list] = None) -> list:
+        """
+        APIに送る形式のメッセージリストを作る．文字列化はDialogMessageごとに1回だけ行い，以降は使い回す
+
+        Args:
+            prefix (list): 先頭に付けるメッセージ(システムメッセージなど)．API形式の辞書のリスト
+
+        Returns:
+            list: API形式の辞書のリスト(新しく作ったリストなので呼び出し元で自由にいじってよい)
+        """
+        api_messages = list(prefix) if prefix else []
+        api_messages.extend(message.to_api() for message in self.snapshot())
+        return api_messages
+
+    def clear(self) -> None:
+        with self.lock:
+            self._messages = self._view = ()
+            self._open = None
+
+    def __len__(self) -> int:
+        return len(self.snapshot())
@@ -0,0 +1,257 @@
+"""
+userが話し終わったか(ターンの終わり)を推定するモジュール
+
+ChatBotは「最後の認識結果から1秒」で話し終わりとみなしていたので，どのターンも最低1秒待っていた．
+しかも認識結果は音声から数百ms遅れて届くので，実際に黙ってからはもっと待っている．
+ここでは以下を組み合わせて，ターンごとに待ち時間を決める
+- マイクのVAD: 認識結果ではなく，実際に声が途切れた時刻から測る．まだ声が出ていれば話し終わりではない
+- 音声認識のis_final: サーバーが文の区切りと判断したら短くする
+- 文末の形: 「〜ね」「〜ですか」「。」などの終わり方なら短く，「〜けど」「〜て」「えっと」などの途中っぽい終わり方なら長くする
+- userごとの学習: 発話の途中の間(息継ぎ)の長さを覚えておき，ゆっくり話す人には長めに待つ．
+  早く応答しすぎて(userがまだ話していて)割り込まれたら，その間も学習に使う
+固定の1秒に比べてどれだけ早く応答を始められたか(とどれだけ早すぎたか)はstats()で見られる．
+
+author: matsumoto
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+try:
+    from .speculation import normalize_transcript
+except ImportError:
+    from talk.speculation import normalize_transcript
+
+
+# 言い切りっぽい文末(短く待つ)
+FINAL_ENDINGS = ("。", "？", "?", "！", "!", "ね", "よ", "か", "な", "わ", "の", "さ", "ます", "です", "でした", "ました",
+                 "だ", "た", "ない", "かな", "だよ", "だね", "よね", "なのだ", "もん")
+# 続きがありそうな文末(長く待つ)
+CONTINUATION_ENDINGS = ("、", "て", "で", "が", "けど", "けれど", "から", "ので", "し", "と", "は", "を", "に", "も", "って",
+                        "えーと", "えっと", "あの", "その", "まあ", "なんか", "ええと")
+
+
+def ending_factor(text: str) -> float:
+    """
+    文末の形から待ち時間の倍率を決める
+
+    Returns:
+        float: 言い切りっぽければ1未満，続きがありそうなら1より大きい
+    """
+    stripped = (text or "").strip()
+    if not stripped:
+        return 1.0
+    if stripped[-1] in "。？?！!":
+        return 0.5
+    # 「〜けど」のように長い方から見る(「ど」と「けど」など)
+    for ending in sorted(CONTINUATION_ENDINGS, key=len, reverse=True):
+        if stripped.endswith(ending):
+            return 1.5
+    for ending in sorted(FINAL_ENDINGS, key=len, reverse=True):
+        if stripped.endswith(ending):
+            return 0.7
+    return 1.0
+
+
+class UserEndpointProfile:
+    """1人のuserの話し方の学習結果"""
+
+    def __init__(self, pauses=None, decisions: int = 0, premature: int = 0):
+        self.pauses = deque(pauses or [], maxlen=100)  # 発話の途中の間の長さ(秒)
+        self.decisions = decisions  # 話し終わりと判断した回数
+        self.premature = premature  # 判断が早すぎた(userがまだ話していた)回数
+
+    def base_threshold(self, default: float, min_threshold: float, max_threshold: float, min_samples: int = 5) -> float:
+        """
+        このuserの基本の待ち時間
+        発話の途中の間の90パーセンタイルより少し長く待てば，息継ぎで応答を始めてしまうことはほとんどない
+        """
+        if len(self.pauses) < min_samples:
+            return default
+        ordered = sorted(self.pauses)
+        p90 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+        return min(max_threshold, max(min_threshold, p90 * 1.2))
+
+    def to_dict(self) -> dict:
+        return {"pauses": list(self.pauses), "decisions": self.decisions, "premature": self.premature}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserEndpointProfile":
+        return cls(data.get("pauses"), data.get("decisions", 0), data.get("premature", 0))
+
+
+class Endpointer:
+    """
+    ターンの終わりの推定器．ChatRuntimeから使う(スレッドセーフ)
+    """
+
+    def __init__(self, vad=None, fixed_threshold: float = 1.0, min_threshold: float = 0.3, max_threshold: float = 1.6,
+                 stt_settle: float = 0.15, profile_path: Optional[str] = None, user_id: str = "default"):
+        """
+        Args:
+            vad (EnergyVAD): マイクのVAD．Noneなら認識結果の時刻だけで判断する
+            fixed_threshold (float): 比較対象の固定しきい値(これまでのresponse_start_threshold)．学習前の基本の待ち時間にもなる
+            min_threshold (float): 待ち時間の下限(秒)
+            max_threshold (float): 待ち時間の上限(秒)
+            stt_settle (float): 声が途切れてから認識結果が追いつくのを待つ最低時間(秒)．is_finalなら待たない
+            profile_path (str): 学習結果を保存するJSONのパス．Noneなら保存しない
+            user_id (str): 今話しているuser
+        """
+        self.vad = vad
+        self.fixed_threshold = fixed_threshold
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.stt_settle = stt_settle
+        self.profile_path = profile_path
+        self.user_id = user_id
+        self.profiles: Dict[str, UserEndpointProfile] = {}
+        self._lock = threading.Lock()
+        self._turn_started_at = time.monotonic()
+        self._last_decision = None  # (判断した時刻, そのときの認識結果, 判断した時点での無音の長さ)
+        self.saved_latencies = []  # 固定しきい値と比べて早く判断できた時間(秒)
+        self._last_transcript_at = None
+        self._transcript_gaps = []  # VADが無いときの代わり: このターンの認識結果の間隔(秒)
+        self.load()
+
+    @property
+    def profile(self) -> UserEndpointProfile:
+        with self._lock:
+            return self.profiles.setdefault(self.user_id, UserEndpointProfile())
+
+    def threshold(self, text: str, is_final: bool = False) -> float:
+        """今の認識結果に対する待ち時間(秒)．声が途切れた時刻から数える"""
+        base = self.profile.base_threshold(self.fixed_threshold, self.min_threshold, self.max_threshold)
+        threshold = base * ending_factor(text)
+        if is_final:
+            threshold *= 0.5
+        return min(self.max_threshold, max(self.min_threshold, threshold))
+
+    def deadline(self, text: str, last_transcript_at: float, is_final: bool = False, now: Optional[float] = None) -> float:
+        """
+        話し終わりと判断する時刻(monotonic)
+        VADで声が出ている間は「今から」数え直すので，その時刻になったらもう一度聞くこと
+
+        Args:
+            text (str): 最新の認識結果
+            last_transcript_at (float): 最新の認識結果が届いた時刻(monotonic)
+            is_final (bool): 最新の認識結果がis_finalだったか
+        """
+        now = time.monotonic() if now is None else now
+        threshold = self.threshold(text, is_final)
+        anchor = last_transcript_at
+        if self.vad is not None:
+            silence = self.vad.silence_duration(now)
+            if silence is not None and self.vad.last_voice_at >= self._turn_started_at:
+                # 実際に声が途切れた時刻から数える(まだ話していればsilence=0なので，今から数える)
+                anchor = now - silence
+        settle = 0.0 if is_final else self.stt_settle
+        return max(anchor + threshold, last_transcript_at + settle)
+
+    def observe_transcript(self, at: float) -> None:
+        """
+        認識結果が届いたことを記録する．VADが無いときは，認識結果の間隔を発話の途中の間の代わりに学習に使う
+        (話している間の認識結果は0.1〜0.2秒おきに届くので，それより長い間隔だけ数える)
+        """
+        with self._lock:
+            if self.vad is None and self._last_transcript_at is not None:
+                gap = at - self._last_transcript_at
+                if 0.25 <= gap <= self.max_threshold * 1.5:
+                    self._transcript_gaps.append(gap)
+            self._last_transcript_at = at
+
+    def record_decision(self, decided_at: float, last_transcript_at: float, text: str) -> None:
+        """話し終わりと判断した(応答を始めた)ことを記録する"""
+        saved = last_transcript_at + self.fixed_threshold - decided_at
+        last_voice_at = self.vad.last_voice_at if self.vad is not None else None
+        silence = decided_at - (last_voice_at if last_voice_at is not None else last_transcript_at)
+        with self._lock:
+            self.saved_latencies.append(saved)
+            self._last_decision = (decided_at, text, silence)
+        self.profile.decisions += 1
+        logging.debug(f"話し終わりと判断: 固定しきい値より{saved * 1000:.0f}ms早い")
+
+    def record_continuation(self, resumed_at: float, text: str) -> bool:
+        """
+        応答を始めた後にuserが話を続けた(認識結果が伸びた)ことを記録する
+
+        Returns:
+            bool: 判断が早すぎたとみなしたらTrue(続けて話した間を学習に使う)
+        """
+        with self._lock:
+            last_decision = self._last_decision
+        if last_decision is None:
+            return False
+        decided_at, decided_text, silence = last_decision
+        gap = resumed_at - decided_at
+        if gap > self.max_threshold * 2:
+            return False  # 応答を聞いてから話し始めたもの(割り込み)
+        if not normalize_transcript(text).startswith(normalize_transcript(decided_text)):
+            return False
+        profile = self.profile
+        profile.premature += 1
+        # 判断した時点ではまだ間の途中だったので，実際の間はもっと長かった
+        profile.pauses.append(silence + gap)
+        with self._lock:
+            self._last_decision = None
+        logging.debug(f"話し終わりの判断が早すぎた({profile.premature}/{profile.decisions})")
+        return True
+
+    def end_turn(self) -> None:
+        """ターンが最後まで終わったときに呼ぶ．このターンの発話の途中の間を学習する"""
+        now = time.monotonic()
+        if self.vad is not None:
+            pauses = [pause for pause in self.vad.pauses_since(self._turn_started_at) if pause <= self.max_threshold * 1.5]
+        else:
+            with self._lock:
+                pauses = self._transcript_gaps
+        self.profile.pauses.extend(pauses)
+        with self._lock:
+            self._turn_started_at = now
+            self._last_decision = None
+            self._last_transcript_at = None
+            self._transcript_gaps = []
+        self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            saved = list(self.saved_latencies)
+        profile = self.profile
+        return {
+            "user_id": self.user_id,
+            "decisions": profile.decisions,
+            "premature": profile.premature,
+            "premature_rate": profile.premature / profile.decisions if profile.decisions else None,
+            "base_threshold": profile.base_threshold(self.fixed_threshold, self.min_threshold, self.max_threshold),
+            "mean_saved_latency": sum(saved) / len(saved) if saved else None,
+            "total_saved_latency": sum(saved),
+        }
+
+    def load(self) -> None:
+        if not self.profile_path or not os.path.exists(self.profile_path):
+            return
+        try:
+            with open(self.profile_path, encoding="utf-8") as f:
+                data = json.load(f)
+            with self._lock:
+                self.profiles = {user_id: UserEndpointProfile.from_dict(profile) for user_id, profile in data.items()}
+        except (OSError, ValueError) as e:
+            logging.debug("話し終わりの学習結果の読み込みに失敗しました: %s", e)
+
+    def save(self) -> None:
+        if not self.profile_path:
+            return
+        with self._lock:
+            data = {user_id: profile.to_dict() for user_id, profile in self.profiles.items()}
+        try:
+            directory = os.path.dirname(self.profile_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.profile_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        except OSError as e:
+            logging.debug("話し終わりの学習結果の保存に失敗しました: %s", e)
@@ -0,0 +1,133 @@
+"""
+GPTFileProcessorで処理するファイルを探すためのモジュール
+os.scandirでフォルダを再帰的に辿り，条件に合うファイルを見つけ次第yieldする．
+全部リストアップしてから処理を始めるのではなく，最初の1件が見つかった時点で処理を始められる．
+
+author: matsumoto
+"""
+
+import datetime
+import fnmatch
+import logging
+import os
+from dataclasses import dataclass
+from typing import Generator, Iterable, Optional
+
+
+@dataclass(frozen=True)
+class FoundFile:
+    """見つかったファイル1件分の情報"""
+
+    path: str  # フルパス
+    relpath: str  # rootからの相対パス(区切りは"/")
+    size: int  # バイト数
+    mtime: float  # 最終更新時刻(UNIX時間)
+
+
+def _to_timestamp(value) -> Optional[float]:
+    """datetimeでもUNIX時間でも受け付けられるようにする"""
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def _match_any(relpath: str, name: str, patterns: Iterable[str]) -> bool:
+    """
+    globパターンのどれかに一致するか
+    "/"を含むパターンは相対パス全体に，含まないパターンはファイル名(フォルダ名)に対して照合する
+    """
+    for pattern in patterns:
+        target = relpath if "/" in pattern else name
+        if fnmatch.fnmatch(target, pattern):
+            return True
+    return False
+
+
+def iter_files(
+    root: str,
+    include: Iterable[str] = ("*",),
+    exclude: Iterable[str] = (),
+    recursive: bool = True,
+    keyword: str = "",
+    min_size: Optional[int] = None,
+    max_size: Optional[int] = None,
+    modified_after=None,
+    modified_before=None,
+    follow_symlinks: bool = False,
+) -> Generator[FoundFile, None, None]:
+    """
+    条件に合うファイルを順次yieldするジェネレータ
+
+    Args:
+        root (str): 探索を始めるフォルダ
+        include (Iterable[str]): 対象にするglobパターン (例: ["*.txt", "*.ipynb"])
+        exclude (Iterable[str]): 除外するglobパターン．フォルダに一致した場合はその中身ごと除外
+        recursive (bool): サブフォルダも探すかどうか
+        keyword (str): ファイル名にこの文字列を含むものだけを対象にする
+        min_size (int): これより小さいファイルは除外(バイト)
+        max_size (int): これより大きいファイルは除外(バイト)
+        modified_after (datetime or float): これより前に更新されたファイルは除外
+        modified_before (datetime or float): これより後に更新されたファイルは除外
+        follow_symlinks (bool): シンボリックリンク先のフォルダも辿るかどうか
+
+    Yields:
+        FoundFile: 見つかったファイル
+    """
+    include = list(include)
+    exclude = list(exclude)
+    after = _to_timestamp(modified_after)
+    before = _to_timestamp(modified_before)
+
+    # 再帰呼び出しではなくスタックで辿る(深い階層でも落ちないように)
+    stack = [(root, "")]
+    while stack:
+        directory, prefix = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logging.warning(f"フォルダを読めませんでした: {directory} ({e})")
+            continue
+
+        subdirs = []
+        for entry in entries:
+            relpath = prefix + entry.name
+            if exclude and _match_any(relpath, entry.name, exclude):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if recursive:
+                        subdirs.append((entry.path, relpath + "/"))
+                    continue
+                if not entry.is_file():
+                    continue
+                if keyword and keyword not in entry.name:
+                    continue
+                if not _match_any(relpath, entry.name, include):
+                    continue
+                # Windowsではscandirの時点でstatがキャッシュされているので安い
+                stat = entry.stat()
+            except OSError as e:
+                logging.warning(f"ファイル情報を取得できませんでした: {entry.path} ({e})")
+                continue
+            if min_size is not None and stat.st_size < min_size:
+                continue
+            if max_size is not None and stat.st_size > max_size:
+                continue
+            if after is not None and stat.st_mtime < after:
+                continue
+            if before is not None and stat.st_mtime > before:
+                continue
+            yield FoundFile(entry.path, relpath, stat.st_size, stat.st_mtime)
+
+        # 名前順に辿るため逆順で積む
+        stack.extend(reversed(subdirs))
+
+
+def extensions_to_patterns(extensions: Iterable[str]) -> list:
+    """
+    従来の拡張子リスト([".txt", ".md"])をglobパターン(["*.txt", "*.md"])に変換する
+    """
+    return ["*" + ext if ext.startswith(".") else "*." + ext for ext in extensions]
@@ -1,12 +1,24 @@
+import argparse
+import glob
+import json
 import logging
-import tkinter as tk
 import os
-from tkinter import filedialog
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
 
 try:
     from .gpt_handler import GPTHandler, JsonGPTHandler
+    from .result_writer import KEY_FIELD, WRITER_FORMATS, create_result_writer
+    from .file_discovery import extensions_to_patterns, iter_files
+    from .usage_report import RequestRecord, UsageReport
 except ImportError:
     from gpt_handler import GPTHandler, JsonGPTHandler
+    from result_writer import KEY_FIELD, WRITER_FORMATS, create_result_writer
+    from file_discovery import extensions_to_patterns, iter_files
+    from usage_report import RequestRecord, UsageReport
 
 
 class GPTFileProcessor:
@@ -14,24 +26,31 @@ class GPTFileProcessor:
     テキストファイルをGPTで処理するためのクラス
     """
 
-    def __init__(self, model="gpt-4o-mini"):
+    # 一時的なエラーとみなしてリトライする例外
+    RETRYABLE_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError, openai.InternalServerError)
+
+    def __init__(self, model="gpt-4o-mini", max_retries=2):
         """
         コンストラクタ
 
         Args:
             model (str): 使用するGPTモデル
-            output_json (bool): JsonGPTHandlerを使用するかどうか
+            max_retries (int): 一時的なエラーの時に何回までリトライするか
         """
         self.model = model  # 使用するGPTモデルを設定
         self.gpt_handler = JsonGPTHandler()
+        self.gpt_handler.client_options = {"max_retries": 0}  # リトライはprocess_fileで数えながら行うので，SDKの自動リトライは切る
+        self.max_retries = max_retries
+        self.usage_report = UsageReport()  # リクエストごとのトークン数・所要時間の記録
 
-    def process_file(self, instructions, output_field={"main_output":"タスクの結果"}, filepath:str=""):
+    def process_file(self, instructions, output_field={"main_output":"タスクの結果"}, filepath:str="", file_name:str=""):
         """
         テキストファイルを処理するメソッド
 
         Args:
             filepath (str): 処理するファイルのパス
             instructions (str): GPTへの指示
+            file_name (str): 使用量レポートに書く名前(出力のfile_name列と同じもの)．省略時はfilepath
 
         Returns:
             str: 処理済みテキスト。ファイルが見つからない場合はNone
@@ -59,20 +78,54 @@ class GPTFileProcessor:
             {"role": "user", "content": text},
         ]
 
-        streaming_object = self.gpt_handler.chat(messages, model=self.model)
-
-        # 無駄にstreamingしているので，全部出てくるまで待つ
-        response={}
-        for item in streaming_object:  # 疑似ループでレスポンスを処理
-            response.update(item)  # 応答アイテムをresponseに追加
+        record = RequestRecord(file_name=file_name or filepath, model=self.model)
+        start_time = time.time()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    streaming_object = self.gpt_handler.chat(messages, model=self.model, on_usage=record.update_usage)
+
+                    # 無駄にstreamingしているので，全部出てくるまで待つ
+                    response={}
+                    for item in streaming_object:  # 疑似ループでレスポンスを処理
+                        response.update(item)  # 応答アイテムをresponseに追加
+                    break
+                except self.RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    record.retries += 1
+                    logging.warning(f"GPTへのリクエストに失敗したのでリトライします({record.retries}回目): {filepath} ({e})")
+                    time.sleep(2 ** attempt)
+        except Exception:
+            record.ok = False
+            raise
+        finally:
+            record.latency = time.time() - start_time
+            self.usage_report.add(record)
 
         logging.debug(f"処理済みテキスト:\n{response}")
 
         return response
     
-    def process_on_directory(self, instructions, output_field={"main_output":"タスクの結果"}, keyword="",dirpath:str="", extensions:list=[".txt"], output_path=""):
+    def process_on_directory(self, instructions, output_field={"main_output":"タスクの結果"}, keyword="",dirpath:str="", extensions:list=[".txt"], output_path="", output_format="", resume=True,
+                             recursive=False, include:list=None, exclude:list=(), min_size=None, max_size=None, modified_after=None, modified_before=None, concurrency=1):
         """
         特定のディレクトリにあるファィルすべてに対してprocess_fileを実行するメソッド
+        結果は1ファイル処理するたびに出力先へ追記されるので，途中で落ちても処理済みの分は残る
+
+        Args:
+            output_path (str): 出力先のパス．省略時はdirpath/output.csv
+            output_format (str): "csv"(UTF-8 BOM付き), "csv-sjis", "jsonl", "sqlite"．省略時は拡張子から推測
+            resume (bool): Trueなら出力先に既にあるファイルはスキップする
+            recursive (bool): サブフォルダ(学生ごと・課題ごとのフォルダなど)も探すかどうか
+            include (list): 対象にするglobパターン．指定した場合はextensionsより優先
+            exclude (list): 除外するglobパターン．フォルダに一致した場合は中身ごと除外
+            min_size, max_size (int): ファイルサイズの範囲(バイト)
+            modified_after, modified_before (datetime or float): 更新日時の範囲
+            concurrency (int): 同時にGPTへ投げるリクエスト数
+
+        Returns:
+            list: 1行目が項目名の表(再開してスキップしたファイルも含め，出力先にある全ての行)．キャンセルされた場合はNone
         """
         # フォルダ選択ダイアログを開き、フォルダパスを取得 -> dirpath
         if not dirpath:
@@ -80,51 +133,99 @@ class GPTFileProcessor:
             if not dirpath:  # キャンセルされた場合
                 return
         
-        # dirpathからフォルダ内の指定のextのファイルパスをすべて取得 -> filepaths
-        filepaths = []
-        for filename in os.listdir(dirpath):
-            if any(filename.endswith(ext) for ext in extensions):
-                if keyword in filename: # keywordを含むファイルのみ追加
-                    filepaths.append(os.path.join(dirpath, filename))
-        
-        # filepathsの要素それぞれに対してprocess_fileを実行し，表として保存 -> output_table
-        output_table = []
-        # output_tableの最初の行に項目名を追加
-        header = ["file_name"] + list(output_field.keys())
-        output_table.append(header)
-        # ファイルごとにAI処理して表に保存
-        for filepath in filepaths:
-            processed_data = self.process_file(instructions, output_field=output_field, filepath=filepath)
-            if processed_data is not None:
-                # 処理結果を1行目の項目名順に並べ替えてlistにする(行に対応)
-                row = [os.path.basename(filepath)] + [processed_data.get(key, "") for key in header[1:]]
-                output_table.append(row)
-        
-        self.save_output_table(output_table,dirpath)
-
-        return output_table
-    
-    def save_output_table(self, data, dirpath, filepath="output.csv"):
+        if not output_path:
+            output_path = os.path.join(dirpath, "output.csv")
+
+        # dirpath以下の条件に合うファイルを見つけ次第流してくるジェネレータ -> found_files
+        found_files = iter_files(
+            dirpath,
+            include=include or extensions_to_patterns(extensions),
+            exclude=exclude,
+            recursive=recursive,
+            keyword=keyword,
+            min_size=min_size,
+            max_size=max_size,
+            modified_after=modified_after,
+            modified_before=modified_before,
+        )
+        # 出力先自身は処理しない．サブフォルダ内のファイルは"学生/課題.txt"のような相対パスで出力する
+        targets = ((found.relpath, found.path) for found in found_files
+                   if os.path.abspath(found.path) != os.path.abspath(output_path))
+
+        self.process_files(instructions, targets, output_path, output_field=output_field,
+                           output_format=output_format, resume=resume, concurrency=concurrency)
+
+        # 以前と同じく結果の表を返す(出力先から読み直すので，再開した場合は前回までの分も入る)
+        header = [KEY_FIELD] + list(output_field.keys())
+        rows = create_result_writer(output_path, header, output_format).read_rows()
+        return [header] + [[row.get(key, "") for key in header] for row in rows]
+
+    def process_files(self, instructions, targets, output_path, output_field={"main_output":"タスクの結果"}, output_format="", resume=True, concurrency=1):
         """
-        出力結果を指定されたパスにCSV形式で保存するメソッド
+        (出力上の名前, ファイルパス)の列に対してprocess_fileを実行し，1行ずつ出力先に追記するメソッド
 
         Args:
-            data (list): 保存するデータ（リスト形式）
-            output_path (str): 保存先のファイルパス。デフォルトは"output.csv"
-        """
-        import csv
+            instructions (str): GPTへの指示
+            targets (Iterable[tuple]): (file_name列に書く名前, ファイルパス)のイテラブル．ジェネレータでよい
+            output_path (str): 出力先のパス
+            output_field (dict): 出力の項目名->説明
+            output_format (str): "csv", "csv-sjis", "jsonl", "sqlite"．省略時は拡張子から推測
+            resume (bool): Trueなら出力先に既にあるファイルはスキップする
+            concurrency (int): 同時にGPTへ投げるリクエスト数
 
-        # Start of Selection
+        Returns:
+            str: 出力先のパス
+        """
+        header = [KEY_FIELD] + list(output_field.keys())
+        self.usage_report = UsageReport()  # 実行ごとに集計し直す
+
+        with create_result_writer(output_path, header, output_format, resume=resume) as writer:
+            pending = self._skip_done(targets, writer.done_keys)
+            if concurrency <= 1:
+                for file_name, filepath in pending:
+                    self._process_and_write(writer, instructions, output_field, file_name, filepath)
+            else:
+                # targetsを全部読み切らないよう，同時に抱えるジョブはconcurrencyの2倍までにする
+                with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="file_processor") as executor:
+                    in_flight = set()
+                    for file_name, filepath in pending:
+                        in_flight.add(executor.submit(self._process_and_write, writer, instructions, output_field, file_name, filepath))
+                        if len(in_flight) >= concurrency * 2:
+                            _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    wait(in_flight)
+        logging.info(f"出力結果を{output_path}に保存しました。")
+
+        # どこに時間とお金がかかったかのレポート
+        if self.usage_report.records:
+            report_path = os.path.splitext(output_path)[0] + "_usage.json"
+            self.usage_report.save(report_path)
+            logging.info(self.usage_report.summary())
+            logging.info(f"使用量レポートを{report_path}に保存しました。")
+
+        return output_path
+
+    @staticmethod
+    def _skip_done(targets, done_keys):
+        """処理済みのものを飛ばしながらtargetsを流す"""
+        for file_name, filepath in targets:
+            if file_name in done_keys:
+                logging.info(f"処理済みなのでスキップ: {file_name}")
+                continue
+            yield file_name, filepath
+
+    def _process_and_write(self, writer, instructions, output_field, file_name, filepath):
+        """
+        1ファイル分の処理と書き出し．失敗しても他のファイルの処理は続ける(出力に残らないので次回再開時にやり直される)
+        """
         try:
-            full_path = os.path.join(dirpath, filepath)  # dirpathとfilepathを結合してフルパスを作成
-            # shift_jisでエンコードできない文字が存在する場合、置き換え文字を使用してエンコード
-            with open(full_path, 'w', newline='', encoding='shift-jis', errors='replace') as f:
-                writer = csv.writer(f)
-                writer.writerows(data)
-            logging.info(f"出力結果を{full_path}に保存しました。")
+            processed_data = self.process_file(instructions, output_field=output_field, filepath=filepath, file_name=file_name)
         except Exception as e:
-            logging.error(f"出力結果の保存中にエラーが発生しました: {e}")
-
+            logging.exception(f"処理中にエラーが発生しました: {file_name} ({e})")
+            return
+        if processed_data is not None:
+            row = {key: processed_data.get(key, "") for key in output_field}
+            row[KEY_FIELD] = file_name
+            writer.write_row(row)
 
     def select_file(self):
         """
@@ -133,8 +234,9 @@ class GPTFileProcessor:
         Returns:
             str: 選択されたファイルのパス。キャンセルされた場合はNone
         """
-        root = tk.Tk()
-        root.withdraw()
+        filedialog = _load_filedialog()
+        if filedialog is None:
+            return None
         filepath = filedialog.askopenfilename(title="ファイル選択")
         return filepath
 
@@ -148,8 +250,9 @@ class GPTFileProcessor:
         Returns:
             list: 選択されたフォルダ内の指定された拡張子のファイルパスリスト。キャンセルされた場合は空リスト
         """
-        root = tk.Tk()
-        root.withdraw()
+        filedialog = _load_filedialog()
+        if filedialog is None:
+            return []
         dirpath = filedialog.askdirectory(title="フォルダ選択")
         if not dirpath:  # キャンセルされた場合
             return []
@@ -157,6 +260,97 @@ class GPTFileProcessor:
 
 
 
+def _load_filedialog():
+    """
+    ダイアログが必要になった時だけtkinterをimportする．
+    起動が遅くなるのと，GUIのないサーバーではimportやTk()の時点で落ちるので
+
+    Returns:
+        module: tkinter.filedialog．使えない環境ではNone
+    """
+    try:
+        import tkinter as tk
+        from tkinter import filedialog
+        root = tk.Tk()
+        root.withdraw()
+    except Exception as e:
+        logging.error(f"ファイルダイアログを開けませんでした(パスを引数で指定してください): {e}")
+        return None
+    return filedialog
+
+
+def _iter_cli_targets(paths, include, exclude, recursive, keyword):
+    """
+    コマンドラインで指定されたパス(ファイル・フォルダ・glob)を(出力上の名前, ファイルパス)に展開する
+    フォルダが1つだけ指定された場合はprocess_on_directoryと同じくフォルダからの相対パスを名前にする
+    """
+    single_directory = len(paths) == 1 and os.path.isdir(paths[0])
+    for path in paths:
+        if glob.has_magic(path):
+            for matched in glob.iglob(path, recursive=True):
+                if os.path.isfile(matched):
+                    yield matched.replace(os.sep, "/"), matched
+        elif os.path.isdir(path):
+            for found in iter_files(path, include=include, exclude=exclude, recursive=recursive, keyword=keyword):
+                name = found.relpath if single_directory else os.path.join(path, found.relpath).replace(os.sep, "/")
+                yield name, found.path
+        elif os.path.isfile(path):
+            yield path.replace(os.sep, "/"), path
+        else:
+            logging.warning(f"パスが見つかりません: {path}")
+
+
+def _read_text_arg(value):
+    """値が既存のファイルパスならその中身を，そうでなければ値そのものを返す"""
+    if value and os.path.isfile(value):
+        with open(value, "r", encoding="utf-8") as f:
+            return f.read()
+    return value
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(prog="python -m talk.gpt.gpt_fileprocess", description="ファイルをまとめてGPTで処理し，結果を1ファイルずつ追記する")
+    p.add_argument("paths", nargs="+", help="処理するファイル・フォルダ・globパターン (例: submissions/ \"data/**/*.txt\")")
+    p.add_argument("-i", "--instructions", required=True, help="GPTへの指示．ファイルパスを渡した場合はその中身を使う")
+    p.add_argument("-f", "--fields", default='{"main_output": "タスクの結果"}', help="出力項目のJSON(項目名->説明)．ファイルパスでもよい")
+    p.add_argument("-o", "--output", default="", help="出力先．省略時はフォルダを1つ指定した場合はその中のoutput.csv，それ以外はカレントのoutput.csv")
+    p.add_argument("--format", default="", choices=["", *WRITER_FORMATS], help="出力形式．省略時は拡張子から推測")
+    p.add_argument("-j", "--concurrency", type=int, default=4, help="同時リクエスト数")
+    p.add_argument("--model", default="gpt-4o-mini", help="使用するGPTモデル")
+    p.add_argument("-r", "--recursive", action="store_true", help="フォルダ指定時にサブフォルダも探す")
+    p.add_argument("--include", nargs="*", default=["*.txt"], help="フォルダ指定時に対象にするglobパターン")
+    p.add_argument("--exclude", nargs="*", default=[], help="フォルダ指定時に除外するglobパターン")
+    p.add_argument("--keyword", default="", help="ファイル名にこの文字列を含むものだけ処理する")
+    p.add_argument("--no-resume", action="store_true", help="出力先に既にあるファイルも処理し直す")
+    return p
+
+
+def main(argv=None) -> int:
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    args = build_argparser().parse_args(argv)
+
+    try:
+        output_field = json.loads(_read_text_arg(args.fields))
+    except json.JSONDecodeError as e:
+        logging.error(f"--fieldsをJSONとして読めませんでした: {e}")
+        return 2
+    instructions = _read_text_arg(args.instructions)
+
+    output_path = args.output
+    if not output_path:
+        if len(args.paths) == 1 and os.path.isdir(args.paths[0]):
+            output_path = os.path.join(args.paths[0], "output.csv")
+        else:
+            output_path = "output.csv"
+
+    # 出力先自身は処理しない
+    targets = ((name, path) for name, path in _iter_cli_targets(args.paths, args.include, args.exclude, args.recursive, args.keyword)
+               if os.path.abspath(path) != os.path.abspath(output_path))
+
+    processor = GPTFileProcessor(model=args.model)
+    processor.process_files(instructions, targets, output_path, output_field=output_field, output_format=args.format,
+                            resume=not args.no_resume, concurrency=args.concurrency)
+    return 0
 
 
 def test_gpt_file_processor():
@@ -188,14 +382,16 @@ def test_process_on_directory():
 
     output_field={"title":"ファイルの内容を一言で要約","topics":"主要なトピック (半角スペースで区切る)","main_output":"タスクの結果","date":"年月日から時刻まで (ex. 2024.12.18 16:15)","total time":"タイムスタンプから見る会話時間の合計"}
 
-    processed_texts = processor.process_on_directory(instructions,output_field)
+    output_table = processor.process_on_directory(instructions,output_field)
 
-    for processed_text in processed_texts:
-        if processed_text:
-            print(processed_text)
+    if output_table:
+        print(output_table)
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main())
+    # 引数なし(エディタのF5実行など)の場合はダイアログでファイルを選ぶテスト
     test_gpt_file_processor()
     # test_process_on_directory()
 
@@ -6,7 +6,8 @@ author: matsumoto
 
 
 import json
-from typing import Generator, List
+import threading
+from typing import Callable, Generator, List, Optional
 
 import openai
 
@@ -28,6 +29,119 @@ except:
     
 
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> "openai.OpenAI":
+    """
+    プロセスで共有するOpenAIクライアントを返す
+    リクエストのたびにクライアントを作ると接続プールも毎回作られ，中断したストリームの接続が溜まっていくので1つにまとめる
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = openai.OpenAI(api_key=OPENAI_APIKEY)
+        return _client
+
+
+def configure_client(base_url: Optional[str] = None, api_key: Optional[str] = None) -> Optional["openai.OpenAI"]:
+    """
+    共有のOpenAIクライアントを作り直す(接続先をローカルの代役サーバーに向けるときなど)
+
+    Args:
+        base_url (str): APIのURL．base_urlもapi_keyもNoneなら元に戻す(次のget_client()で本物のOpenAI向けに作る)
+        api_key (str): APIキー．Noneなら設定ファイル/環境変数のもの
+    """
+    global _client
+    with _client_lock:
+        if base_url is None and api_key is None:
+            _client = None
+        else:
+            _client = openai.OpenAI(api_key=api_key or OPENAI_APIKEY, base_url=base_url)
+        return _client
+
+
+class CancelToken:
+    """
+    ストリーミング応答の中断用トークン
+    cancel()すると登録しておいたコールバック(ストリームのclose)を呼ぶので，チャンク待ちでブロックしている読み込みもすぐに抜ける．
+    threading.Eventと同じくset()/is_set()でも使える
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.debug("中断時のコールバックに失敗しました: %s", e)
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    set = cancel
+    is_set = is_cancelled
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """cancel()の時に呼ぶ関数を登録する．既に中断済みならその場で呼ぶ"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+def _open_stream(result, cancel_token: Optional[CancelToken]):
+    """
+    ストリームを読み終わったら(途中で抜けたり中断されたりしても)接続を閉じる
+
+    Args:
+        result (openai.Stream): ストリーミングレスポンス
+        cancel_token (CancelToken): 中断されたらストリームを閉じる．Noneなら閉じるのは読み終わったときだけ
+    """
+    if cancel_token is not None:
+        cancel_token.add_callback(result.close)
+    try:
+        for chunk in result:
+            yield chunk
+    except Exception:
+        # 中断でストリームを閉じた場合は読み込み側で例外が出るが，それは正常な終了
+        if cancel_token is None or not cancel_token.is_cancelled():
+            raise
+    finally:
+        result.close()
+
+
+def _notify_usage(chunk, on_usage) -> None:
+    """
+    stream_options={"include_usage": True}の時に最後に届くチャンクから使用量を取り出してon_usageに渡す
+
+    Args:
+        chunk: choicesが空のチャンク
+        on_usage (Callable[[dict], None]): 使用量を受け取る関数．Noneなら何もしない
+    """
+    usage = getattr(chunk, "usage", None)
+    if on_usage is None or usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    on_usage({
+        "model": chunk.model,
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+        "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details else 0,
+    })
+
+
 class GPTHandler:
     """
     ChatGPTを使用して会話を行うためのクラス。
@@ -65,12 +179,21 @@ class GPTHandler:
             "gpt-4-1106-vision-preview",
         ]
         self.interrupt_flg=False
+        # 共有のクライアントに上書きするオプション(自前でリトライする場合は{"max_retries": 0}にしてSDKのリトライと重ねない)
+        self.client_options = {}
+
+    def _client(self) -> "openai.OpenAI":
+        """共有のクライアント(client_optionsがあれば，接続プールは共有したままオプションだけ変えたもの)"""
+        client = get_client()
+        return client.with_options(**self.client_options) if self.client_options else client
 
     def chat_gpt(
         self,
         messages: list,
         model: str = "gpt-4o-mini",
         temperature: float = 0.7,
+        on_usage: Optional[Callable[[dict], None]] = None,
+        cancel_token: Optional[CancelToken] = None,
     ) -> Generator[str, None, None]:
         """ChatGPTを使用して会話を行う
 
@@ -78,27 +201,31 @@ class GPTHandler:
             messages (list): 会話のメッセージ
             model (str): 使用するモデル名 (デフォルト: "gpt-4o-mini")
             temperature (float): ChatGPTのtemperatureパラメータ (デフォルト: 0.7)
+            on_usage (Callable[[dict], None]): ストリームの最後に届くトークン使用量を受け取る関数 (省略可)
+            cancel_token (CancelToken): 中断用のトークン．cancel()されたらストリームを閉じて終了する (省略可)
         Returns:
             Generator[str, None, None]): 会話の返答を順次生成する
 
         """
         result = None
         if model in self.openai_vision_model_name:
-            result = openai.chat.completions.create(
+            result = self._client().chat.completions.create(
                 model=model,
                 messages=messages,
                 max_tokens=1024,
                 n=1,
                 stream=True,
+                stream_options={"include_usage": True},
                 temperature=temperature,
             )
         elif model in self.openai_model_name:
-            result = openai.chat.completions.create(
+            result = self._client().chat.completions.create(
                 model=model,
                 messages=messages,
                 max_tokens=1024,
                 n=1,
                 stream=True,
+                stream_options={"include_usage": True},
                 temperature=temperature,
                 stop=None,
             )
@@ -106,7 +233,11 @@ class GPTHandler:
         full_response = ""
         # リアルタイムでのレスポンスを格納する変数
         real_time_response = ""
-        for chunk in result:
+        for chunk in _open_stream(result, cancel_token):
+            # 使用量だけが入った最後のチャンク
+            if not chunk.choices:
+                _notify_usage(chunk, on_usage)
+                continue
             # チャンクからテキストを取得
             text = chunk.choices[0].delta.content
             if text is None:
@@ -141,6 +272,8 @@ class GPTHandler:
         messages: list,
         model: str = "gpt-4o-mini",
         temperature: float = 0.7,
+        on_usage: Optional[Callable[[dict], None]] = None,
+        cancel_token: Optional[CancelToken] = None,
     ) -> Generator[str, None, None]:
         """指定したモデルを使用して会話を行う
 
@@ -148,13 +281,16 @@ class GPTHandler:
             messages (list): 会話のメッセージリスト
             model (str): 使用するモデル名 (デフォルト: "gpt-4o-mini")
             temperature (float): サンプリングの温度パラメータ (デフォルト: 0.7)
+            on_usage (Callable[[dict], None]): トークン使用量を受け取る関数 (省略可)
+            cancel_token (CancelToken): 中断用のトークン (省略可)
         Returns:
             Generator[str, None, None]): 会話の返答を順次生成する
 
         """
         if model in self.openai_model_name or model in self.openai_vision_model_name:
             yield from self.chat_gpt(
-                messages=messages, model=model, temperature=temperature
+                messages=messages, model=model, temperature=temperature, on_usage=on_usage,
+                cancel_token=cancel_token,
             )
         else:
             print(f"Model name {model} can't use for this function")
@@ -172,6 +308,8 @@ class JsonGPTHandler(GPTHandler):
         messages: list,
         model: str = "gpt-4o-mini",
         temperature: float = 0.7,
+        on_usage: Optional[Callable[[dict], None]] = None,
+        cancel_token: Optional[CancelToken] = None,
     ) -> Generator[str, None, None]:
         """ChatGPTを使用して会話を行う
 
@@ -179,28 +317,31 @@ class JsonGPTHandler(GPTHandler):
             messages (list): 会話のメッセージ
             model (str): 使用するモデル名 (デフォルト: "gpt-4o-mini")
             temperature (float): ChatGPTのtemperatureパラメータ (デフォルト: 0.7)
+            on_usage (Callable[[dict], None]): ストリームの最後に届くトークン使用量を受け取る関数 (省略可)
+            cancel_token (CancelToken): 中断用のトークン．cancel()されたらストリームを閉じて終了する (省略可)
         Returns:
             Generator[str, None, None]): 会話の返答を順次生成する
 
         """
         result = None
         if model in self.openai_vision_model_name:
-            result = openai.chat.completions.create(
+            result = self._client().chat.completions.create(
                 model=model,
                 messages=messages,
                 max_tokens=1024,
                 n=1,
                 stream=True,
+                stream_options={"include_usage": True},
                 temperature=temperature,
             )
         elif model in self.openai_model_name:
-            client = openai.OpenAI(api_key=OPENAI_APIKEY)
-            result = client.chat.completions.create(
+            result = self._client().chat.completions.create(
                 model=model,
                 messages=messages,
                 max_tokens=1024,
                 n=1,
                 stream=True,
+                stream_options={"include_usage": True},
                 temperature=temperature,
                 stop=None,
                 response_format={"type": "json_object"},
@@ -209,7 +350,11 @@ class JsonGPTHandler(GPTHandler):
         full_response = ""
         # リアルタイムでのレスポンスを格納する変数
         real_time_response = ""
-        for chunk in result: # ストリーミングレスポンスを処理
+        for chunk in _open_stream(result, cancel_token): # ストリーミングレスポンスを処理
+            # 使用量だけが入った最後のチャンク
+            if not chunk.choices:
+                _notify_usage(chunk, on_usage)
+                continue
             # チャンクからテキストを取得
             text = chunk.choices[0].delta.content
             if text is None:
@@ -272,7 +417,8 @@ def test_chat_gpt_json_streaming():
     model = "gpt-4o-mini"
     temperature = 0.7
 
-    # # 大量にリクエストしまくると、4つくらいで止まることがある。万全を期すなら、どうにかして接続をkillする必要あり？
+    # # 大量にリクエストしまくると、4つくらいで止まることがあった(途中で抜けたストリームの接続が残っていたため)。
+    # # 今はクライアントを共有し、抜けたストリームは閉じるので止まらないはず
     # n=20
     # for i in range(n):
     #     response = handler.chat(messages, model, temperature)
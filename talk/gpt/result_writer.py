@@ -0,0 +1,354 @@
+"""
+GPTFileProcessorの処理結果を1件ずつ書き出すためのライター群
+最後にまとめて書き出すと途中で落ちたときに全部消えるので，1ファイル処理するたびに追記&flushする．
+既に出力ファイルがある場合は処理済みのファイル名を読み込むので，同じ出力先を指定すれば続きから再開できる．
+再開しない(resume=False)場合は既存の出力を.bakに退避してから新しく作る(追記すると同じ行が二重になるので)．
+
+対応形式
+- csv      : UTF-8(BOM付き)．Excelでそのまま開ける
+- csv-sjis : shift-jis．エンコードできない文字は置き換え文字になる(警告は出す)
+- jsonl    : 1行1レコードのJSON
+- sqlite   : resultsテーブルに1行1レコード
+
+author: matsumoto
+"""
+
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+KEY_FIELD = "file_name"  # 再開時に処理済みかどうかを判定するための列
+
+
+def _to_text(value) -> str:
+    """
+    CSVやSQLiteに入れる用に値を文字列化する．
+    GPTの出力はlistやdictが混ざることがあるので，その場合はJSONにしておく
+    """
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _ensure_trailing_newline(path: str) -> None:
+    """
+    書き込み途中で落ちたファイルは最終行が改行で終わっていないので，追記前に改行を補う
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+class ResultWriter:
+    """
+    抽象クラスのつもり．
+    open()で出力先を開いて処理済みのキーを読み込み，write_row()で1行ずつ追記する．
+    複数スレッドから同時にwrite_row()しても大丈夫なようにlockを持っている．
+    """
+
+    def __init__(self, path: str, fieldnames: list, resume: bool = True):
+        """
+        Args:
+            path (str): 出力先のファイルパス
+            fieldnames (list): 列名のリスト．先頭はKEY_FIELD("file_name")であること
+            resume (bool): Trueなら既存の出力に追記して続きから再開する．Falseなら既存の出力を退避して作り直す
+        """
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self.resume = resume
+        self.done_keys = set()  # 既に出力済みのfile_name
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def open(self) -> set:
+        """
+        出力先を開き，既に出力済みのキーの集合を返す
+
+        Returns:
+            set: 出力済みのfile_nameの集合
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not self.resume and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            self._backup_existing("再開しない")
+        self.done_keys = self._load_done_keys()
+        self._open()
+        return self.done_keys
+
+    def write_row(self, row: dict) -> None:
+        """
+        1行分の結果を書き出してflushする
+
+        Args:
+            row (dict): 列名->値の辞書
+        """
+        with self._lock:
+            self._write(row)
+            self.done_keys.add(row.get(KEY_FIELD))
+
+    def close(self) -> None:
+        """出力先を閉じる"""
+        with self._lock:
+            self._close()
+
+    def read_rows(self) -> list:
+        """
+        出力先に書き出されている行を全て読む(openしていなくてもよい)
+
+        Returns:
+            list: 列名->値の辞書のリスト(書き出した順)
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return []
+        return self._read_rows()
+
+    def _backup_existing(self, reason: str = "列構成が異なる") -> None:
+        """既存ファイル(列構成が違う・再開しない)を消さずに退避する"""
+        backup_path = f"{self.path}.{time.strftime('%Y%m%d_%H%M%S')}.bak"
+        os.replace(self.path, backup_path)
+        logging.warning(f"{reason}ため既存の出力を{backup_path}に退避しました")
+
+    # 以下は継承先で実装
+    def _load_done_keys(self) -> set:
+        return set()
+
+    def _read_rows(self) -> list:
+        return []
+
+    def _open(self) -> None:
+        pass
+
+    def _write(self, row: dict) -> None:
+        pass
+
+    def _close(self) -> None:
+        pass
+
+
+class CsvResultWriter(ResultWriter):
+    """
+    CSVに1行ずつ追記するライター
+    """
+
+    def __init__(self, path: str, fieldnames: list, encoding: str = "utf-8-sig", resume: bool = True):
+        """
+        Args:
+            path (str): 出力先のファイルパス
+            fieldnames (list): 列名のリスト
+            encoding (str): 文字コード．"utf-8-sig"(デフォルト)か"shift-jis"
+            resume (bool): Falseなら既存の出力を退避して作り直す
+        """
+        super().__init__(path, fieldnames, resume)
+        self.encoding = encoding
+        self._file = None
+        self._writer = None
+
+    def _load_done_keys(self) -> set:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return set()
+        with open(self.path, "r", newline="", encoding=self.encoding, errors="replace") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header != self.fieldnames:
+                done_keys = None
+            else:
+                done_keys = {row[0] for row in reader if row}
+        if done_keys is None:
+            self._backup_existing()
+            return set()
+        return done_keys
+
+    def _read_rows(self) -> list:
+        with open(self.path, "r", newline="", encoding=self.encoding, errors="replace") as f:
+            return [row for row in csv.DictReader(f) if row.get(KEY_FIELD)]
+
+    def _open(self) -> None:
+        _ensure_trailing_newline(self.path)
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        # 追記モードでもutf-8-sigのBOMはファイル先頭にしか書かれない
+        self._file = open(self.path, "a", newline="", encoding=self.encoding, errors="replace")
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(self.fieldnames)
+            self._file.flush()
+
+    def _write(self, row: dict) -> None:
+        values = [_to_text(row.get(key, "")) for key in self.fieldnames]
+        try:
+            "".join(values).encode(self.encoding)
+        except UnicodeEncodeError:
+            logging.warning(f"{self.encoding}で表現できない文字を置き換えました: {row.get(KEY_FIELD)}")
+        self._writer.writerow(values)
+        self._file.flush()
+
+    def _close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class JsonlResultWriter(ResultWriter):
+    """
+    JSON Lines形式(1行1レコード)で追記するライター
+    """
+
+    def __init__(self, path: str, fieldnames: list, resume: bool = True):
+        super().__init__(path, fieldnames, resume)
+        self._file = None
+
+    def _load_done_keys(self) -> set:
+        done_keys = set()
+        if not os.path.exists(self.path):
+            return done_keys
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた行は未処理扱い
+                    continue
+                done_keys.add(record.get(KEY_FIELD))
+        return done_keys
+
+    def _read_rows(self) -> list:
+        rows = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # 書き込み途中で落ちた行
+        return rows
+
+    def _open(self) -> None:
+        _ensure_trailing_newline(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _write(self, row: dict) -> None:
+        record = {key: row.get(key, "") for key in self.fieldnames}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def _close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class SqliteResultWriter(ResultWriter):
+    """
+    SQLiteのresultsテーブルに1行ずつ書き込むライター
+    file_nameが主キーなので，同じファイルを処理し直した場合は上書きされる
+    """
+
+    table = "results"
+
+    def __init__(self, path: str, fieldnames: list, resume: bool = True):
+        super().__init__(path, fieldnames, resume)
+        self._conn = None
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        # 項目名に空白などが入っていても大丈夫なようにクォートする
+        return '"' + name.replace('"', '""') + '"'
+
+    def _load_done_keys(self) -> set:
+        return set()  # _openでテーブルを確認してから読む
+
+    def _read_rows(self) -> list:
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(f"SELECT * FROM {self.table} ORDER BY rowid")]
+        except sqlite3.OperationalError:
+            return []  # resultsテーブルがまだ無い
+        finally:
+            conn.close()
+
+    def _open(self) -> None:
+        # 書き込みはlock越しにしか行わないので，スレッドをまたいで使ってよい
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        columns = ", ".join(
+            [f"{self._quote(KEY_FIELD)} TEXT PRIMARY KEY"]
+            + [f"{self._quote(key)} TEXT" for key in self.fieldnames[1:]]
+            + ["processed_at TEXT"]
+        )
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({columns})")
+        existing = [row[1] for row in self._conn.execute(f"PRAGMA table_info({self.table})")]
+        # 足りない列があれば追加する(output_fieldを増やして再開した場合)
+        for key in self.fieldnames[1:]:
+            if key not in existing:
+                self._conn.execute(f"ALTER TABLE {self.table} ADD COLUMN {self._quote(key)} TEXT")
+        self._conn.commit()
+        self.done_keys = {row[0] for row in self._conn.execute(f"SELECT {self._quote(KEY_FIELD)} FROM {self.table}")}
+
+    def _write(self, row: dict) -> None:
+        columns = self.fieldnames + ["processed_at"]
+        values = [_to_text(row.get(key, "")) for key in self.fieldnames] + [time.strftime("%Y-%m-%d %H:%M:%S")]
+        placeholders = ", ".join("?" for _ in columns)
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} ({', '.join(self._quote(c) for c in columns)}) VALUES ({placeholders})",
+            values,
+        )
+        self._conn.commit()
+
+    def _close(self) -> None:
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+# 形式名 -> (ライタークラス, 追加の引数)
+WRITER_FORMATS = {
+    "csv": (CsvResultWriter, {"encoding": "utf-8-sig"}),
+    "csv-sjis": (CsvResultWriter, {"encoding": "shift-jis"}),
+    "jsonl": (JsonlResultWriter, {}),
+    "sqlite": (SqliteResultWriter, {}),
+}
+
+# 拡張子から形式を推測する用
+_EXTENSION_FORMATS = {
+    ".csv": "csv",
+    ".jsonl": "jsonl",
+    ".db": "sqlite",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+}
+
+
+def create_result_writer(path: str, fieldnames: list, output_format: str = "", resume: bool = True) -> ResultWriter:
+    """
+    形式名(省略時は拡張子から推測)に応じたライターを作る
+
+    Args:
+        path (str): 出力先のファイルパス
+        fieldnames (list): 列名のリスト
+        output_format (str): "csv", "csv-sjis", "jsonl", "sqlite"のいずれか
+        resume (bool): Falseなら既存の出力を退避して作り直す
+
+    Returns:
+        ResultWriter: 対応するライター(まだopenされていない)
+    """
+    if not output_format:
+        output_format = _EXTENSION_FORMATS.get(os.path.splitext(path)[1].lower(), "csv")
+    if output_format not in WRITER_FORMATS:
+        raise ValueError(f"未対応の出力形式です: {output_format} (対応: {', '.join(WRITER_FORMATS)})")
+    writer_class, kwargs = WRITER_FORMATS[output_format]
+    return writer_class(path, fieldnames, resume=resume, **kwargs)
@@ -0,0 +1,162 @@
+"""
+GPTへのバッチ処理1回分のトークン使用量・料金・所要時間を集計するモジュール
+リクエストごとにRequestRecordを1つ記録しておき，最後にsummary()でどこに時間とお金がかかったかを見る．
+
+author: matsumoto
+"""
+
+import json
+import threading
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+
+# 100万トークンあたりの料金(USD): (入力, キャッシュ済み入力, 出力)
+# 料金改定があったら更新すること．前方一致で引くので日付付きのモデル名もそのまま使える
+PRICES_PER_1M_TOKENS = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4-turbo": (10.00, 10.00, 30.00),
+    "gpt-4-32k": (60.00, 60.00, 120.00),
+    "gpt-4": (30.00, 30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+}
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> Optional[float]:
+    """
+    トークン数から料金(USD)を見積もる
+
+    Args:
+        model (str): モデル名
+        prompt_tokens (int): 入力トークン数(キャッシュ済みの分も含む)
+        completion_tokens (int): 出力トークン数
+        cached_tokens (int): 入力のうちキャッシュが効いたトークン数
+
+    Returns:
+        float: 料金(USD)．料金表にないモデルの場合はNone
+    """
+    # 一番長く一致するものを使う("gpt-4o-mini"が"gpt-4o"に吸われないように)
+    matched = [name for name in PRICES_PER_1M_TOKENS if model.startswith(name)]
+    if not matched:
+        return None
+    input_price, cached_price, output_price = PRICES_PER_1M_TOKENS[max(matched, key=len)]
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    return (uncached * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+
+@dataclass
+class RequestRecord:
+    """GPTへのリクエスト1件分の記録"""
+
+    file_name: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    latency: float = 0.0  # リクエスト開始から応答が出そろうまでの秒数(リトライ込み)
+    retries: int = 0
+    ok: bool = True
+
+    def update_usage(self, usage: dict) -> None:
+        """GPTHandlerのon_usageから受け取った使用量を反映する"""
+        self.model = usage.get("model") or self.model
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+        self.cached_tokens += usage.get("cached_tokens", 0)
+
+    @property
+    def cost(self) -> Optional[float]:
+        return estimate_cost(self.model, self.prompt_tokens, self.completion_tokens, self.cached_tokens)
+
+
+class UsageReport:
+    """
+    RequestRecordを集めて集計するクラス
+    複数スレッドから同時にadd()しても大丈夫
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record: RequestRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def totals_by_model(self) -> dict:
+        """
+        モデルごとの合計を返す
+
+        Returns:
+            dict: モデル名 -> {"requests", "prompt_tokens", "completion_tokens", "cached_tokens", "cost", "latency"}
+        """
+        totals = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            total = totals.setdefault(record.model, {
+                "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "cached_tokens": 0, "cost": 0.0, "latency": 0.0, "retries": 0, "failed": 0,
+            })
+            total["requests"] += 1
+            total["prompt_tokens"] += record.prompt_tokens
+            total["completion_tokens"] += record.completion_tokens
+            total["cached_tokens"] += record.cached_tokens
+            total["cost"] += record.cost or 0.0
+            total["latency"] += record.latency
+            total["retries"] += record.retries
+            total["failed"] += 0 if record.ok else 1
+        return totals
+
+    def slowest(self, n: int = 5) -> list:
+        with self._lock:
+            return sorted(self.records, key=lambda r: r.latency, reverse=True)[:n]
+
+    def most_expensive(self, n: int = 5) -> list:
+        with self._lock:
+            return sorted(self.records, key=lambda r: r.cost or 0.0, reverse=True)[:n]
+
+    def summary(self, top_n: int = 5) -> str:
+        """
+        人が読む用のレポート文字列を作る
+
+        Args:
+            top_n (int): 遅い順・高い順に何件まで出すか
+
+        Returns:
+            str: レポート
+        """
+        lines = ["# GPT使用量レポート"]
+        totals = self.totals_by_model()
+        total_cost = sum(t["cost"] for t in totals.values())
+        lines.append(f"リクエスト数: {sum(t['requests'] for t in totals.values())}  推定料金: ${total_cost:.4f}")
+
+        lines.append("\n## モデル別")
+        for model, t in totals.items():
+            lines.append(
+                f"- {model}: {t['requests']}件 入力{t['prompt_tokens']}(うちキャッシュ{t['cached_tokens']}) "
+                f"出力{t['completion_tokens']} 合計{t['latency']:.1f}秒 リトライ{t['retries']}回 失敗{t['failed']}件 ${t['cost']:.4f}"
+            )
+
+        lines.append(f"\n## 遅かったファイル (上位{top_n}件)")
+        for record in self.slowest(top_n):
+            lines.append(f"- {record.file_name}: {record.latency:.2f}秒 (リトライ{record.retries}回)")
+
+        lines.append(f"\n## 高かったファイル (上位{top_n}件)")
+        for record in self.most_expensive(top_n):
+            cost = "不明" if record.cost is None else f"${record.cost:.5f}"
+            lines.append(f"- {record.file_name}: {cost} (入力{record.prompt_tokens} 出力{record.completion_tokens})")
+        return "\n".join(lines)
+
+    def save(self, path: str) -> None:
+        """
+        全リクエストの記録と集計をJSONで保存する
+
+        Args:
+            path (str): 保存先
+        """
+        with self._lock:
+            records = [dict(asdict(r), cost=r.cost) for r in self.records]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"totals_by_model": self.totals_by_model(), "requests": records}, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,265 @@
+"""
+AIAgentの長期記憶(過去の会話の検索)用モジュール
+会話ログを丸ごとGPTに送ると長くなる一方なので，過去のターンをBM25の転置インデックスに入れておき，
+今のuserの発話に関係ありそうなターン(名前，趣味など)だけを上位k件引いてきてプロンプトに差し込む．
+
+日本語は分かち書きなしで扱えるよう，文字種(漢字/ひらがな/カタカナ/英数字)ごとに区切って文字bigramにする．
+英数字は単語のまま使う．
+インデックスへの追加は専用スレッドで行うので，応答スレッドはadd()で待たされない．
+
+author: matsumoto
+"""
+
+import heapq
+import logging
+import math
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+# 文字種ごとの連続部分．これ以外(記号，空白)は区切りとして捨てる
+_RUN_PATTERN = re.compile(
+    r"[一-鿿㐀-䶿々〆ヵヶ]+"  # 漢字
+    r"|[ぁ-ゟ]+"  # ひらがな
+    r"|[ァ-ヺー]+"  # カタカナ
+    r"|[a-z0-9]+"  # 英数字(NFKCで半角小文字にしてから使う)
+)
+
+
+def _is_hiragana(char: str) -> bool:
+    return "ぁ" <= char <= "ゟ"
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    検索用のトークン列にする
+
+    Args:
+        text (str): 文字列
+
+    Returns:
+        list: トークンのリスト．日本語は文字種ごとの連続部分を文字bigram(1文字だけならその文字)にする
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for match in _RUN_PATTERN.finditer(text):
+        run = match.group()
+        if run.isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            # 1文字だけのひらがなはほぼ助詞(は，の，と…)で，どの文書にも出てきて検索の邪魔なので捨てる
+            if not _is_hiragana(run):
+                tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+@dataclass
+class MemoryDocument:
+    """インデックスに入れた1件(1ターン分の会話)"""
+
+    doc_id: int
+    text: str
+    session_id: Optional[int] = None
+    created_at: float = field(default_factory=time.time)
+
+
+class LongTermMemory:
+    """
+    過去の会話をBM25で検索するための転置インデックス
+    add()は専用スレッドに任せ，search()はlockを取って転置リストを辿るだけ
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, max_df_ratio: float = 0.5,
+                 max_query_tokens: int = 12):
+        """
+        Args:
+            k1 (float): BM25のパラメータ(tfの飽和の速さ)
+            b (float): BM25のパラメータ(文書長の正規化の強さ)
+            max_df_ratio (float): これより多くの割合の文書に出てくるトークン(「user」やキャラ名，「です」など)は検索時に無視する．
+                                  スコアへの寄与はほぼ無いのに転置リストが長く，検索が遅くなるだけなので．
+                                  ペットの名前のように何度も話題になるトークンは思い出したいので，小さくしすぎない
+                                  (その程度の頻度ならBM25のIDFで重みが下がるだけで済む)
+            max_query_tokens (int): 検索に使うクエリのトークン数の上限(長い発話でも検索時間が伸びないように)
+        """
+        self.k1 = k1
+        self.b = b
+        self.max_df_ratio = max_df_ratio
+        self.max_query_tokens = max_query_tokens
+
+        self._postings = defaultdict(dict)  # token -> {doc_id: tf}
+        self._doc_lengths = {}  # doc_id -> トークン数
+        self._documents = {}  # doc_id -> MemoryDocument
+        self._total_length = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._pending = 0  # 積んだがまだインデックスに入っていない件数
+        self._idle = threading.Condition()
+        self._thread = threading.Thread(target=self._indexer_loop, name="memory_indexer", daemon=True)
+        self._thread.start()
+
+    def add(self, text: str, session_id: Optional[int] = None, created_at: Optional[float] = None) -> None:
+        """
+        文書を追加する(インデックスへの反映は専用スレッドで行う)
+
+        Args:
+            text (str): 文書の内容(1ターン分の会話など)
+            session_id (int): 会話のセッションID．検索時に今のセッションの分を除くのに使う
+            created_at (float): 作成時刻
+        """
+        if not text or not text.strip():
+            return
+        with self._idle:
+            self._pending += 1
+        self._queue.put((text, session_id, created_at or time.time()))
+
+    def wait_indexed(self, timeout: float = 5.0) -> bool:
+        """
+        それまでにadd()した文書がインデックスに入るまで待つ
+
+        Returns:
+            bool: 時間内に入ったかどうか
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def add_now(self, text: str, session_id: Optional[int] = None, created_at: Optional[float] = None) -> int:
+        """
+        文書をその場でインデックスに入れる(起動時の一括読み込み用)
+
+        Returns:
+            int: 文書ID
+        """
+        tf = Counter(tokenize(text))
+        length = sum(tf.values())
+        with self._lock:
+            doc_id = self._next_id
+            self._next_id += 1
+            self._documents[doc_id] = MemoryDocument(doc_id, text, session_id, created_at or time.time())
+            self._doc_lengths[doc_id] = length
+            self._total_length += length
+            for token, count in tf.items():
+                self._postings[token][doc_id] = count
+        return doc_id
+
+    def search(self, query: str, top_k: int = 3, exclude_session: Optional[int] = None,
+               exclude_since: Optional[float] = None) -> List[MemoryDocument]:
+        """
+        クエリに関係ありそうな文書をBM25のスコア順に返す
+
+        Args:
+            query (str): 検索クエリ(userの発話など)
+            top_k (int): 返す最大件数
+            exclude_session (int): このセッションの文書は除く(今の会話ログに既に入っているので)
+            exclude_since (float): created_atがこれ以降の文書は除く(GPTに送る会話ログに入っている分)
+
+        Returns:
+            list: MemoryDocumentのリスト(スコアの高い順)
+        """
+        query_tokens = set(tokenize(query))
+        if not query_tokens:
+            return []
+        scores = defaultdict(float)
+        with self._lock:
+            n_docs = len(self._documents)
+            if n_docs == 0:
+                return []
+            average_length = self._total_length / n_docs
+            max_df = max(1, int(n_docs * self.max_df_ratio))
+            # 転置リストを辿る内側のループが検索時間のほぼ全てなので，定数は先に計算してローカル変数に入れておく
+            k1_plus_1 = self.k1 + 1
+            norm_base = self.k1 * (1 - self.b)
+            norm_scale = self.k1 * self.b / average_length
+            doc_lengths = self._doc_lengths
+            # 珍しい(=スコアへの寄与が大きい)トークンから順にmax_query_tokens個だけ使う
+            postings_list = sorted((postings for postings in map(self._postings.get, query_tokens)
+                                    if postings and (len(postings) <= max_df or n_docs <= 10)), key=len)
+            for postings in postings_list[:self.max_query_tokens]:
+                df = len(postings)
+                weight = math.log(1 + (n_docs - df + 0.5) / (df + 0.5)) * k1_plus_1
+                for doc_id, tf in postings.items():
+                    scores[doc_id] += weight * tf / (tf + norm_base + norm_scale * doc_lengths[doc_id])
+            documents = self._documents
+            candidates = scores if exclude_session is None and exclude_since is None else (
+                doc_id for doc_id in scores
+                if (exclude_session is None or documents[doc_id].session_id != exclude_session)
+                and (exclude_since is None or documents[doc_id].created_at < exclude_since))
+            # 全件ソートせず上位k件だけ取る
+            return [self._documents[doc_id] for doc_id in heapq.nlargest(top_k, candidates, key=scores.get)]
+
+    def load_from_db(self, conversation_db, user_id: str) -> int:
+        """
+        ConversationDBに保存されている過去の会話をインデックスに読み込む(userの発話とその直後の応答で1件)
+
+        Args:
+            conversation_db (ConversationDB): 会話の保存先
+            user_id (str): userのID
+
+        Returns:
+            int: 読み込んだ件数
+        """
+        start_time = time.perf_counter()
+        count = 0
+        pending_user = None
+        for turn in conversation_db.iter_turns(user_id):
+            if turn["role"] == "user":
+                pending_user = turn
+            elif turn["role"] == "assistant" and pending_user is not None:
+                self.add_now(format_turn(pending_user["content"], turn["content"]),
+                             turn["session_id"], pending_user["created_at"])
+                pending_user = None
+                count += 1
+        logging.debug(f"長期記憶に{count}件読み込みました({(time.perf_counter() - start_time) * 1000:.1f}ms)")
+        return count
+
+    def close(self) -> None:
+        """インデックス更新スレッドを止める(それまでにadd()した文書は入れてから止まる)"""
+        self._queue.put(None)
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout=5.0)
+
+    def _indexer_loop(self) -> None:
+        """インデックス更新スレッド"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            text, session_id, created_at = item
+            try:
+                self.add_now(text, session_id, created_at)
+            except Exception as e:
+                logging.debug("長期記憶への追加に失敗しました: %s", e)
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+
+def format_turn(user_message, output) -> str:
+    """
+    1ターン分の会話を長期記憶に入れる文字列にする
+
+    Args:
+        user_message (str): userの発話
+        output (dict or str): assistantの出力({"キャラ名": "発話", "emotion": ...})
+
+    Returns:
+        str: "user: ...\\nキャラ名: ..."の形の文字列
+    """
+    lines = [f"user: {user_message}"]
+    if isinstance(output, dict):
+        lines.extend(f"{name}: {text}" for name, text in output.items() if name != "emotion")
+    elif output:
+        lines.append(f"assistant: {output}")
+    return "\n".join(lines)
@@ -0,0 +1,592 @@
+"""
+録音しておいた会話(音声認識結果とそのタイミング)をChatBotに流し直して，ターンごとの待ち時間を計測するハーネス
+
+「応答が遅い」の調査のたびにマイクに向かって話すのは再現性がないので，以下を偽物に差し替えて同じ会話を何度でも流せるようにする
+- 音声認識: ReplayRecognizer．スクリプトの時刻どおりに途中結果を積む(言い直し・割り込みもそのまま再現される)
+  voiceイベントがあればVADも持ち，声の開始・終了をマイクのフレームと同じように流す(声による割り込みの検出用)
+- GPT: StandInLLMServer．OpenAI互換のストリーミングAPIをローカルに立て，決まった応答を決まった速さで返す
+  (openaiクライアント・JsonGPTHandlerのパース・中断時のストリームのcloseまで本物と同じ経路を通る)
+- 音声合成: FakeTTSSpeaker．合成・再生とも文字数に比例した時間だけ実際に待つ(再生中の割り込みもできる)
+
+ターンごとに「userが話し終わる → GPTへのリクエスト → 最初のトークン → 最初の音 → 話し終わり」のタイムラインを出すので，
+変更の前後で同じスクリプトを流せば待ち時間の悪化をオフラインで確認できる．
+時刻は実時間なので数msの揺れはあるが，会話の内容と各部品の速さは毎回同じになる．
+
+スクリプト(JSON)の形式
+    {
+        "events": [{"t": 0.0, "text": "こんに"}, {"t": 0.4, "text": "こんにちは", "final": true}, ...],   音声認識の途中結果(t秒後に届く．finalはis_final)
+                  {"t": 6.0, "voice": true}, {"t": 6.3, "voice": false}                             マイクの声の開始・終了(省略可)
+        "replies": {"こんにちは": {"zundamon": "...", "metan": "...", "emotion": "..."}}   userの発話ごとの応答(省略時は自動生成)
+    }
+    1行1イベント({"t":..., "text":...})のJSONLでもよい
+
+使い方
+    python -m talk.replay                       (組み込みのサンプルを流す)
+    python -m talk.replay session.json --ttft 0.8 --output timeline.json
+
+author: matsumoto
+"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+try:
+    from .chatbot import ChatBot
+    from .conversation_db import ConversationDB
+    from .endpointing import Endpointer
+    from .gpt.gpt_handler import configure_client
+    from .speculation import normalize_transcript
+    from .speech.transcript_buffer import TranscriptBuffer
+    from .speech.vad import EnergyVAD
+except ImportError:
+    from talk.chatbot import ChatBot
+    from talk.conversation_db import ConversationDB
+    from talk.endpointing import Endpointer
+    from talk.gpt.gpt_handler import configure_client
+    from talk.speculation import normalize_transcript
+    from talk.speech.transcript_buffer import TranscriptBuffer
+    from talk.speech.vad import EnergyVAD
+
+
+# 組み込みのサンプル: 言い直し(途中結果の更新)，短い間(投機実行)，応答中の割り込みを含む
+SAMPLE_SCRIPT = {
+    "events": [
+        {"t": 0.0, "voice": True},
+        {"t": 0.3, "text": "こんに"},
+        {"t": 0.45, "voice": False},
+        {"t": 0.6, "text": "こんにちは"},
+        {"t": 4.3, "voice": True},
+        {"t": 4.5, "text": "今日は"},
+        {"t": 4.8, "text": "今日は天気が"},
+        {"t": 5.2, "voice": False},
+        {"t": 5.5, "text": "今日は天気がいいね"},
+        {"t": 7.6, "voice": True},  # 応答中の咳(認識結果は変わらない)
+        {"t": 7.8, "voice": False},
+        {"t": 8.7, "voice": True},
+        {"t": 9.0, "text": "ずんだ餅"},
+        {"t": 9.4, "text": "ずんだ餅って"},
+        {"t": 9.6, "voice": False},
+        {"t": 9.8, "text": "ずんだ餅っておいしい"},
+        {"t": 11.2, "voice": True},  # 応答中にしゃべり始める(割り込み)．認識結果はクラウドの往復の分遅れて届く
+        {"t": 11.6, "text": "ずんだ餅っておいしいの"},
+        {"t": 11.7, "voice": False},
+        {"t": 11.9, "text": "ずんだ餅っておいしいの？"},
+    ],
+    "replies": {},
+}
+
+
+class Timeline:
+    """各部品から届くイベントを時刻つきで溜めておく(スレッドセーフ)"""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self._events: List[dict] = []
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        return time.perf_counter() - self.origin
+
+    def record(self, kind: str, **data) -> None:
+        with self._lock:
+            self._events.append({"t": self.now(), "kind": kind, **data})
+
+    def events(self) -> List[dict]:
+        with self._lock:
+            return list(self._events)
+
+
+@dataclass
+class TurnTimeline:
+    """1ターン分のタイムライン．時刻はリプレイ開始からの秒，latencyは話し終わりからの秒"""
+
+    user_message: str
+    end_of_speech: float  # 最後の音声認識結果が届いた時刻
+    request: Optional[float] = None  # 実際に使われたGPTへのリクエストの時刻(投機実行なら話し終わりより前になる)
+    first_token: Optional[float] = None
+    first_audio: Optional[float] = None  # 相槌も含めて最初に音が鳴った時刻
+    first_response_audio: Optional[float] = None  # GPTの応答の最初の音
+    done: Optional[float] = None  # 話し終わった時刻(割り込まれたターンはNone)
+    completed: bool = True  # 最後まで話したか(Falseなら割り込まれた)
+    requests: int = 0  # このターンで送ったリクエスト数(投機実行や割り込みのやり直しを含む)
+    cancelled_requests: int = 0  # 途中で閉じられたストリームの数
+    barge_ins: int = 0  # 再生中に割り込まれた回数
+    talk_over: Optional[float] = None  # 割り込まれたターンで，userの声が始まってから音が止まるまで(秒)．VADのイベントがあるときだけ
+    false_pauses: int = 0  # 声で一時停止したが割り込みではなかった(再開した)回数
+
+    def latency(self, name: str) -> Optional[float]:
+        value = getattr(self, name)
+        return None if value is None else value - self.end_of_speech
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["latency"] = {name: self.latency(name)
+                           for name in ("request", "first_token", "first_audio", "first_response_audio", "done")}
+        return data
+
+
+class ReplayRecognizer:
+    """
+    スクリプトの途中結果を時刻どおりに積んでいく偽の音声認識(google_stt.SpeechRecognizerと同じメソッドを持つ)
+    """
+
+    def __init__(self, events: List[dict], timeline: Timeline):
+        """
+        Args:
+            events (list): {"t": 秒, "text": 途中結果}または{"t": 秒, "voice": 声の開始ならTrue}のリスト
+            timeline (Timeline): 記録先(tはこのtimelineの開始からの秒として扱う)
+        """
+        self.events = sorted(events, key=lambda event: event["t"])
+        # voiceイベントがあるときだけVADを持つ(google_stt.SpeechRecognizer.vadと同じもの)
+        self.vad = EnergyVAD() if any("voice" in event for event in self.events) else None
+        self.timeline = timeline
+        self.transcripts = TranscriptBuffer(capacity=64)
+        self.last_recognized_time = None
+        self.finished = threading.Event()  # 全イベントを流し終わったらセット
+        self.listeners = []
+        self._thread = threading.Thread(target=self._feed, name="replay_recognizer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _feed(self) -> None:
+        for event in self.events:
+            delay = event["t"] - self.timeline.now()
+            if delay > 0:
+                time.sleep(delay)
+            if "voice" in event:
+                self._feed_voice(event["voice"])
+                continue
+            self.transcripts.append(event["text"], is_final=bool(event.get("final")))
+            self.last_recognized_time = time.time()
+            self.timeline.record("stt", text=event["text"])
+            for callback in list(self.listeners):
+                callback(event["text"])
+        self.finished.set()
+
+    def _feed_voice(self, voiced: bool) -> None:
+        """声の開始・終了をマイクの100msのフレームとしてVADに流す"""
+        self.timeline.record("voice", voiced=voiced)
+        if voiced:
+            self.vad.process(np.full(1600, 3000, dtype=np.int16))
+        else:
+            for _ in range(self.vad.hangover_frames + 1):
+                self.vad.process(np.zeros(1600, dtype=np.int16))
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def reset_recognition(self):
+        self.transcripts.clear()
+        self.last_recognized_time = None
+        self.timeline.record("stt_reset")
+
+    @property
+    def last_result_final(self):
+        latest = self.transcripts.latest()
+        return latest is not None and latest.is_final
+
+    def get_time_since_last_recognition(self):
+        if self.last_recognized_time is None:
+            return None
+        return time.time() - self.last_recognized_time
+
+    def get_latest_recognized(self):
+        latest = self.transcripts.latest()
+        return latest.text if latest is not None else None
+
+    def get_latest_transcript(self):
+        return self.transcripts.latest()
+
+    def wait_for_transcript(self, version, timeout=None):
+        return self.transcripts.wait_for_newer(version, timeout)
+
+    def clear_recognized_queue(self):
+        self.transcripts.clear()
+
+    def is_timed_out(self, timeout):
+        time_since_last = self.get_time_since_last_recognition()
+        if time_since_last is None:
+            return False
+        return time_since_last > timeout
+
+
+def default_reply(user_message: str) -> dict:
+    """スクリプトに応答が無いときの決まった応答(同じ発話には毎回同じ応答を返す)"""
+    topic = normalize_transcript(user_message) or "それ"
+    return {"zundamon": f"{topic}なのだ？", "metan": "もっと聞かせてほしいわね。", "emotion": "楽しい"}
+
+
+class StandInLLMServer:
+    """
+    OpenAIのchat.completions(stream=True)の代役をするローカルHTTPサーバー
+    リクエストを受けてからttft秒後に最初のトークンを返し，その後token_interval秒ごとに続きを返す
+    """
+
+    def __init__(self, timeline: Timeline, replies: Optional[Dict[str, dict]] = None, ttft: float = 0.6,
+                 token_interval: float = 0.02, responder: Optional[Callable[[str], dict]] = None):
+        """
+        Args:
+            timeline (Timeline): 記録先
+            replies (dict): userの発話(空白・句読点は無視して比較) -> 応答の辞書
+            ttft (float): 最初のトークンまでの時間(秒)
+            token_interval (float): トークンの間隔(秒)
+            responder (Callable[[str], dict]): repliesに無い発話の応答を作る関数．省略時はdefault_reply
+        """
+        self.timeline = timeline
+        self.replies = {normalize_transcript(text): reply for text, reply in (replies or {}).items()}
+        self.ttft = ttft
+        self.token_interval = token_interval
+        self.responder = responder or default_reply
+        self._ids = iter(range(1, 1 << 30))
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="stand_in_llm", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reply_for(self, user_message: str) -> dict:
+        message = user_message[len("updated: "):] if user_message.startswith("updated: ") else user_message
+        return self.replies.get(normalize_transcript(message)) or self.responder(message)
+
+    @staticmethod
+    def tokenize(content: str) -> List[str]:
+        """本物のトークンっぽく数文字ずつに切る(JSONのコンマは単独のトークンにする)"""
+        return re.findall(r",|[^,]{1,3}", content)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                request_id = next(server._ids)
+                user_message = body["messages"][-1]["content"]
+                server.timeline.record("request", id=request_id, message=user_message)
+                content = json.dumps(server.reply_for(user_message), ensure_ascii=False)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                chunks = server.tokenize(content)
+                try:
+                    time.sleep(server.ttft)
+                    for i, token in enumerate(chunks):
+                        if i == 0:
+                            server.timeline.record("first_token", id=request_id)
+                        else:
+                            time.sleep(server.token_interval)
+                        self._send_chunk(body, [{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+                    self._send_chunk(body, [{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                    self._send_chunk(body, [], usage={"prompt_tokens": sum(len(m["content"]) for m in body["messages"]),
+                                                      "completion_tokens": len(chunks), "total_tokens": 0})
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # クライアントがストリームを閉じた(中断された)
+                    server.timeline.record("stream_cancelled", id=request_id)
+                    return
+                server.timeline.record("stream_end", id=request_id)
+
+            def _send_chunk(self, body, choices, usage=None):
+                chunk = {"id": "replay", "object": "chat.completion.chunk", "created": 0,
+                         "model": body.get("model", ""), "choices": choices}
+                if usage is not None:
+                    chunk["usage"] = usage
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+        return Handler
+
+
+class FakeTTSSpeaker:
+    """
+    文字数に比例した時間だけ実際に待つ偽のスピーカー(speech_wrapper.Speakerと同じ使い方ができる)
+    """
+
+    def __init__(self, timeline: Timeline, speaker_id: int, synthesis_time_per_char: float = 0.01,
+                 play_time_per_char: float = 0.12, fillers: Optional[List[str]] = None):
+        """
+        Args:
+            timeline (Timeline): 記録先
+            speaker_id (int): 話者ID(相槌のキャッシュのキーになる)
+            synthesis_time_per_char (float): 1文字あたりの合成時間(秒)
+            play_time_per_char (float): 1文字あたりの再生時間(秒)
+            fillers (list): 相槌のテキスト(タイムラインで応答と区別する用)
+        """
+        self.timeline = timeline
+        self.speaker_id = speaker_id
+        self.synthesis_time_per_char = synthesis_time_per_char
+        self.play_time_per_char = play_time_per_char
+        self.fillers = set(fillers or [])
+        self._state = threading.Condition()
+        self._interrupted = False
+        self._paused = False
+
+    def synthesize(self, text: str):
+        time.sleep(len(text) * self.synthesis_time_per_char)
+        return text
+
+    def play(self, data, cancel_event=None) -> None:
+        with self._state:
+            self._interrupted = cancel_event is not None and cancel_event.is_set()
+        if self._interrupted:
+            return
+        self.timeline.record("play_start", speaker=self.speaker_id, text=data, filler=data in self.fillers)
+        remaining = len(data) * self.play_time_per_char
+        with self._state:
+            while remaining > 0 and not self._interrupted:
+                if self._paused:
+                    self._state.wait()  # 一時停止中は残りの再生時間を減らさない
+                    continue
+                started = time.monotonic()
+                self._state.wait(remaining)
+                remaining -= time.monotonic() - started
+            interrupted = self._interrupted
+        self.timeline.record("play_end", speaker=self.speaker_id, text=data, interrupted=interrupted)
+
+    def speak(self, text: str) -> None:
+        self.play(self.synthesize(text))
+
+    def interrupt(self) -> None:
+        with self._state:
+            self._interrupted = True
+            self._paused = False
+            self._state.notify_all()
+
+    def pause(self) -> None:
+        with self._state:
+            self._paused = True
+            self._state.notify_all()
+        self.timeline.record("play_pause", speaker=self.speaker_id)
+
+    def resume(self) -> None:
+        with self._state:
+            self._paused = False
+            self._state.notify_all()
+        self.timeline.record("play_resume", speaker=self.speaker_id)
+
+
+def build_turns(events: List[dict]) -> List[TurnTimeline]:
+    """
+    タイムラインのイベントをターンごとにまとめる
+    ターンの区切りはturn_end(最後まで話した)か，再生中の割り込み(userが話し始めて止められた)
+    話し終わりは，最後に使われたリクエストの直前に届いた音声認識結果の時刻とする
+    """
+    turns = []
+    segment = []
+    for event in events:
+        segment.append(event)
+        completed = event["kind"] == "turn_end"
+        if not completed and not (event["kind"] == "play_end" and event["interrupted"]):
+            continue
+        requests = [e for e in segment if e["kind"] == "request"]
+        if not requests:
+            continue
+        final = requests[-1]
+        speech = [e for e in segment if e["kind"] == "stt" and e["t"] <= final["t"]]
+        last_speech = speech[-1] if speech else final
+        turn = TurnTimeline(user_message=final["message"], end_of_speech=last_speech["t"], request=final["t"],
+                            done=event["t"] if completed else None, completed=completed, requests=len(requests))
+        for e in segment:
+            if e["kind"] == "first_token" and e["id"] == final["id"]:
+                turn.first_token = e["t"]
+            elif e["kind"] == "stream_cancelled":
+                turn.cancelled_requests += 1
+            elif e["kind"] == "play_start" and e["t"] >= turn.end_of_speech:
+                if turn.first_audio is None:
+                    turn.first_audio = e["t"]
+                if turn.first_response_audio is None and not e["filler"] and e["t"] >= final["t"]:
+                    turn.first_response_audio = e["t"]
+            elif e["kind"] == "play_end" and e["interrupted"]:
+                turn.barge_ins += 1
+            elif e["kind"] == "play_resume" and e["speaker"] == 0:  # pause/resumeは全スピーカーに送られるので1人分だけ数える
+                turn.false_pauses += 1
+        if not completed:
+            onsets = [e for e in segment if e["kind"] == "voice" and e["voiced"]]
+            if onsets:
+                onset = onsets[-1]["t"]
+                stops = [e["t"] for e in segment if e["t"] >= onset and e["kind"] in ("play_pause", "play_end")]
+                turn.talk_over = stops[0] - onset if stops else None
+        turns.append(turn)
+        segment = []
+    return turns
+
+
+def _describe(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "max": None}
+    ordered = sorted(values)
+    return {"count": len(values), "mean": sum(values) / len(values), "p50": ordered[len(ordered) // 2], "max": ordered[-1]}
+
+
+def summarize(turns: List[TurnTimeline]) -> dict:
+    return {name: _describe([turn.latency(name) for turn in turns if turn.latency(name) is not None])
+            for name in ("request", "first_token", "first_audio", "first_response_audio", "done")}
+
+
+def format_turns(turns: List[TurnTimeline]) -> str:
+    def ms(value):
+        return "      -" if value is None else f"{value * 1000:7.0f}"
+
+    lines = ["turn  end_of_speech  request  1st_token  1st_audio  1st_resp     done  reqs  cancel  barge  message",
+             "                 (s)  --------------- ms from end of speech ---------------"]
+    for i, turn in enumerate(turns):
+        lines.append(f"{i:4d}  {turn.end_of_speech:13.2f}  {ms(turn.latency('request'))}  {ms(turn.latency('first_token'))}    "
+                     f"{ms(turn.latency('first_audio'))}   {ms(turn.latency('first_response_audio'))}  {ms(turn.latency('done'))}  "
+                     f"{turn.requests:4d}  {turn.cancelled_requests:6d}  {turn.barge_ins:5d}  {turn.user_message}")
+    return "\n".join(lines)
+
+
+def load_script(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        script = json.loads(text)
+    except json.JSONDecodeError:
+        script = None
+    if isinstance(script, dict):
+        return script
+    # JSONL: 1行1イベント
+    return {"events": [json.loads(line) for line in text.splitlines() if line.strip()], "replies": {}}
+
+
+def replay(script: dict, ttft: float = 0.6, token_interval: float = 0.02, synthesis_time_per_char: float = 0.01,
+           play_time_per_char: float = 0.12, settle_timeout: float = 15.0, adaptive_endpointing: bool = True,
+           voice_barge_in: bool = True) -> List[TurnTimeline]:
+    """
+    スクリプトをChatBotに流してターンごとのタイムラインを返す
+
+    Args:
+        script (dict): {"events": [...], "replies": {...}}
+        ttft (float): 代役GPTの最初のトークンまでの時間(秒)
+        token_interval (float): 代役GPTのトークンの間隔(秒)
+        synthesis_time_per_char (float): 偽スピーカーの1文字あたりの合成時間(秒)
+        play_time_per_char (float): 偽スピーカーの1文字あたりの再生時間(秒)
+        settle_timeout (float): 最後のイベントの後，ChatBotが話し終わるまで待つ最大時間(秒)
+        adaptive_endpointing (bool): Falseならresponse_start_thresholdの固定値で話し終わりを判断する(比較用)
+        voice_barge_in (bool): Falseなら声による割り込みの検出をしない(認識結果が変わるまで話し続ける．比較用)
+
+    Returns:
+        tuple: (ターンごとのタイムラインのリスト, ChatRuntimeの計測値．話し終わりの推定の計測値はruntime_stats["endpointing"])
+    """
+    timeline = Timeline()
+    llm = StandInLLMServer(timeline, script.get("replies"), ttft=ttft, token_interval=token_interval)
+    llm.start()
+    configure_client(base_url=llm.base_url, api_key="replay")
+    recognizer = ReplayRecognizer(script["events"], timeline)
+    fillers = ["うん", "なるほどなのだ", "そうなのだ", "そうね", "ふうん", "なるほどね"]  # ChatBotの相槌と同じもの
+    speakers = [FakeTTSSpeaker(timeline, speaker_id, synthesis_time_per_char, play_time_per_char, fillers)
+                for speaker_id in (0, 1)]
+    bot = None
+    runtime_stats = {}
+    try:
+        # 話し終わりの学習結果は保存しない(毎回同じ条件にする)
+        bot = ChatBot(recognizer=recognizer, speakers=speakers, conversation_db=ConversationDB(":memory:"), autosave=False,
+                      endpointer=Endpointer(vad=recognizer.vad))
+        if not adaptive_endpointing:
+            bot.endpointer = None
+        if not voice_barge_in:
+            bot.barge_in_confirm_seconds = None
+        bot.agent.filler_cache.ready.wait(timeout=10)  # 相槌の合成が終わってから始める(毎回同じ条件にする)
+        bot.agent.turn_end_callbacks.append(lambda output: timeline.record("turn_end", output=output))
+        timeline.origin = time.perf_counter()
+        bot_thread = threading.Thread(target=bot.start_chatting, name="replay_chatbot", daemon=True)
+        bot_thread.start()
+        recognizer.start()
+        recognizer.finished.wait()
+        # 最後の発話への応答が終わるまで待つ
+        deadline = time.monotonic() + settle_timeout
+        while time.monotonic() < deadline:
+            if recognizer.get_latest_recognized() is None and bot.agent.end_event.is_set():
+                break
+            time.sleep(0.05)
+        bot.stop()
+        bot_thread.join(timeout=5)
+        runtime_stats = bot.runtime.stats.summary()
+        if bot.endpointer is not None:
+            runtime_stats["endpointing"] = bot.endpointer.stats()
+    finally:
+        if bot is not None:
+            bot.agent.stop_chat_thread()
+            bot.agent.close()
+        llm.stop()
+        configure_client()
+    return build_turns(timeline.events()), runtime_stats
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(prog="python -m talk.replay", description="録音した会話をChatBotに流してターンごとの待ち時間を計測する")
+    p.add_argument("script", nargs="?", help="スクリプト(JSON/JSONL)．省略時は組み込みのサンプル")
+    p.add_argument("--ttft", type=float, default=0.6, help="代役GPTの最初のトークンまでの時間(秒)")
+    p.add_argument("--token-interval", type=float, default=0.02, help="代役GPTのトークンの間隔(秒)")
+    p.add_argument("--synthesis-time", type=float, default=0.01, help="1文字あたりの合成時間(秒)")
+    p.add_argument("--play-time", type=float, default=0.12, help="1文字あたりの再生時間(秒)")
+    p.add_argument("--no-voice-barge-in", action="store_true", help="声による割り込みの検出をしない(比較用)")
+    p.add_argument("--fixed-endpointing", action="store_true", help="話し終わりを固定のしきい値で判断する(比較用)")
+    p.add_argument("--output", help="タイムラインをJSONで書き出すパス")
+    p.add_argument("--verbose", action="store_true", help="DEBUGログを出す")
+    return p
+
+
+def main(argv=None) -> int:
+    args = build_argparser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    script = load_script(args.script) if args.script else SAMPLE_SCRIPT
+    turns, runtime_stats = replay(script, ttft=args.ttft, token_interval=args.token_interval,
+                   synthesis_time_per_char=args.synthesis_time, play_time_per_char=args.play_time,
+                   adaptive_endpointing=not args.fixed_endpointing, voice_barge_in=not args.no_voice_barge_in)
+    print(format_turns(turns))
+    summary = summarize(turns)
+    for name, stats in summary.items():
+        if stats["count"]:
+            print(f"{name:>20}: mean {stats['mean'] * 1000:7.0f}ms  p50 {stats['p50'] * 1000:7.0f}ms  max {stats['max'] * 1000:7.0f}ms")
+    print(f"runtime: {runtime_stats['wakeups']} wakeups in {runtime_stats['elapsed']:.1f}s "
+          f"({runtime_stats['wakeups_per_sec']:.1f}/s), events {runtime_stats['events']}, deadlines {runtime_stats['deadlines']}")
+    for i, turn in enumerate(turns):
+        if turn.talk_over is not None or turn.false_pauses:
+            talk_over = "-" if turn.talk_over is None else f"{turn.talk_over * 1000:.0f}ms"
+            print(f"turn {i}: talked over the user for {talk_over}, false pauses {turn.false_pauses}")
+    if runtime_stats["barge_in_pauses"]:
+        print(f"barge-in: {runtime_stats['barge_in_pauses']} pauses, confirmed {runtime_stats['barge_ins_confirmed']}, "
+              f"resumed {runtime_stats['barge_ins_cancelled']}")
+    endpointing = runtime_stats.get("endpointing")
+    if endpointing and endpointing["decisions"]:
+        print(f"endpointing: {endpointing['decisions']} decisions, premature {endpointing['premature']}, "
+              f"saved {endpointing['mean_saved_latency'] * 1000:.0f}ms/turn vs fixed threshold, "
+              f"base threshold {endpointing['base_threshold']:.2f}s")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"turns": [turn.to_dict() for turn in turns], "summary": summary, "runtime": runtime_stats},
+                      f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+"""
+複数の端末(キオスク，ロボットなど)の会話を1台で受け持つための会話サーバー
+
+ChatBotは1つのマイク，1つのMultiAIAgent，2つのスピーカーに決め打ちで1プロセス1会話だった．
+ここでは1つのasyncioのイベントループ上で接続ごとに独立したAIAgentのセッションを持ち，
+以下をセッション間で共有する
+- GPTの接続プール(gpt_handler.get_client()のOpenAIクライアント)
+- 音声合成のスレッドプール
+- 音声合成結果のキャッシュ(SynthesisCache)
+- 会話の保存先(ConversationDB)と長期記憶
+
+端末とは1行1メッセージのJSON(TCP)でやり取りする．音声認識は端末側で行い，テキストを送ってもらう
+端末 -> サーバー
+    {"type": "hello", "user_id": "kiosk1"}   セッション開始(省略時は"default")
+    {"type": "user", "text": "..."}          userの発話
+    {"type": "cancel"}                       応答を中断(userが割り込んだときなど)
+    {"type": "stats"}                        このセッションの計測値を要求
+    {"type": "bye"}                          終了
+サーバー -> 端末
+    {"type": "ready", "session": 1}
+    {"type": "say", "speaker": 0, "text": "...", "audio": ["<base64のwav>", ...]}   audioは音声合成しない設定なら空
+    {"type": "turn_end", "output": {...}, "latency": {...}}
+    {"type": "stats", ...}
+    {"type": "error", "message": "..."}
+
+使い方
+    python -m talk.server --port 8765 --tts voicevox --speaker-ids 3 2
+    python -m talk.server --client --port 8765    (動作確認用のテキストクライアント)
+
+author: matsumoto
+"""
+
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+try:
+    from .ai_agent import MultiAIAgent
+    from .conversation_db import ConversationDB
+    from .long_term_memory import LongTermMemory
+    from .speech.synthesis_cache import SynthesisCache
+except ImportError:
+    from talk.ai_agent import MultiAIAgent
+    from talk.conversation_db import ConversationDB
+    from talk.long_term_memory import LongTermMemory
+    from talk.speech.synthesis_cache import SynthesisCache
+
+
+class SessionMetrics:
+    """1セッション分の計測値"""
+
+    def __init__(self):
+        self.turns = 0  # 最後まで話したターン数
+        self.cancels = 0  # 中断したターン数
+        self.first_say_latencies: List[float] = []  # userの発話を受け取ってから最初のsayを送るまで(秒)
+        self.turn_latencies: List[float] = []  # userの発話を受け取ってからturn_endを送るまで(秒)
+
+    @staticmethod
+    def _describe(values: List[float]) -> dict:
+        if not values:
+            return {"count": 0, "mean": None, "p95": None, "max": None}
+        ordered = sorted(values)
+        return {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1],
+        }
+
+    def summary(self) -> dict:
+        return {
+            "turns": self.turns,
+            "cancels": self.cancels,
+            "first_say": self._describe(self.first_say_latencies),
+            "turn": self._describe(self.turn_latencies),
+        }
+
+
+class RemoteSpeaker:
+    """
+    セッションの端末に向けて話すスピーカー(speech_wrapper.Speakerと同じ使い方ができる)
+    合成は共有のキャッシュ経由で行い，再生の代わりに端末へsayメッセージを送る(実際の再生は端末側)
+    speech_wrapperはpyaudioが無いとimportできないので継承はしない
+    """
+
+    def __init__(self, session: "ConversationSession", index: int, tts_speaker, cache: SynthesisCache):
+        """
+        Args:
+            session (ConversationSession): 送り先のセッション
+            index (int): 何人目のキャラクターか(sayメッセージのspeaker)
+            tts_speaker (Speaker): 実際に音声合成するスピーカー．Noneならテキストだけ送る
+            cache (SynthesisCache): 共有の合成キャッシュ
+        """
+        self.session = session
+        self.index = index
+        self.tts_speaker = tts_speaker
+        self.cache = cache
+        self.speaker_id = getattr(tts_speaker, "speaker_id", None)
+
+    def synthesize(self, text: str):
+        if self.tts_speaker is None:
+            return text, []
+        key = (type(self.tts_speaker).__name__, self.speaker_id)
+        return text, self.cache.get_or_synthesize(key, text, self.tts_speaker.synthesize)
+
+    def play(self, data, cancel_event=None) -> None:
+        if cancel_event is not None and cancel_event.is_set():
+            return  # 送る前に中断された
+        text, wavs = data
+        self.session.send_threadsafe({
+            "type": "say",
+            "speaker": self.index,
+            "text": text,
+            "audio": [base64.b64encode(wav).decode("ascii") for wav in wavs],
+        })
+
+    def speak(self, text: str) -> None:
+        self.play(self.synthesize(text))
+
+    def interrupt(self) -> None:
+        pass  # 再生は端末側なので，中断はcancelメッセージで端末に任せる
+
+
+class ConversationSession:
+    """
+    1つの接続(端末)に対応する会話セッション．AIAgentはセッションごとに独立している
+    """
+
+    def __init__(self, server: "ConversationServer", session_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.session_id = session_id
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.outbox: asyncio.Queue = asyncio.Queue()
+        self.metrics = SessionMetrics()
+        self.agent = None
+        self._turn_started_at = None
+        self._first_say_sent = False
+
+    def send_threadsafe(self, message: dict) -> None:
+        """他のスレッド(音声の再生スレッド，応答のワーカー)から端末へメッセージを送る"""
+        self.loop.call_soon_threadsafe(self._enqueue, message)
+
+    def _enqueue(self, message: dict) -> None:
+        if message.get("type") == "say" and self._turn_started_at is not None and not self._first_say_sent:
+            self._first_say_sent = True
+            self.metrics.first_say_latencies.append(time.perf_counter() - self._turn_started_at)
+        self.outbox.put_nowait(message)
+
+    async def _writer_loop(self) -> None:
+        while True:
+            message = await self.outbox.get()
+            if message is None:
+                return
+            self.writer.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+            await self.writer.drain()
+
+    def _on_turn_end(self, output: dict) -> None:
+        """AIAgentのワーカースレッドから呼ばれる"""
+        self.loop.call_soon_threadsafe(self._finish_turn, output)
+
+    def _finish_turn(self, output: dict) -> None:
+        latency = {}
+        if self._turn_started_at is not None:
+            elapsed = time.perf_counter() - self._turn_started_at
+            self.metrics.turn_latencies.append(elapsed)
+            latency["turn"] = elapsed
+            if self.metrics.first_say_latencies and self._first_say_sent:
+                latency["first_say"] = self.metrics.first_say_latencies[-1]
+        self.metrics.turns += 1
+        self._turn_started_at = None
+        self.outbox.put_nowait({"type": "turn_end", "output": output, "latency": latency})
+
+    async def _start_agent(self, user_id: str) -> None:
+        # 長期記憶の読み込みなどで時間がかかるので，他のセッションの入出力を止めないようにループの外で作る
+        self.agent = await self.loop.run_in_executor(None, self.server.agent_factory, self, user_id)
+        self.agent.turn_end_callbacks.append(self._on_turn_end)
+
+    def _cancel_turn(self) -> None:
+        if self._turn_started_at is not None:
+            self.metrics.cancels += 1
+            self._turn_started_at = None
+        self.agent.cancel_chatting()
+
+    async def run(self) -> None:
+        writer_task = asyncio.create_task(self._writer_loop())
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    self.outbox.put_nowait({"type": "error", "message": "invalid json"})
+                    continue
+                kind = message.get("type")
+                if self.agent is None:
+                    await self._start_agent(message.get("user_id", "default") if kind == "hello" else "default")
+                    self.outbox.put_nowait({"type": "ready", "session": self.session_id})
+                    if kind == "hello":
+                        continue
+                if kind == "user":
+                    text = message.get("text", "")
+                    if not text.strip():
+                        continue
+                    interrupted = self._turn_started_at is not None
+                    if interrupted:
+                        self.metrics.cancels += 1  # 応答中に話しかけられたら割り込み扱い(前の発話は会話ログに残す)
+                    self._turn_started_at = time.perf_counter()
+                    self._first_say_sent = False
+                    self.agent.stop_chat_thread()
+                    if interrupted:
+                        # ChatBotのis_recognition_updatedと同じく、応答の途中で言い足したときだけ続きとして送る
+                        self.agent.update_chatting(text)
+                    else:
+                        self.agent.start_chatting(text)
+                elif kind == "cancel":
+                    self._cancel_turn()
+                    self.outbox.put_nowait({"type": "turn_end", "output": None, "latency": {}, "cancelled": True})
+                elif kind == "stats":
+                    self.outbox.put_nowait({"type": "stats", "session": self.session_id,
+                                            **self.metrics.summary(), "shared": self.server.stats()})
+                elif kind == "bye":
+                    break
+                else:
+                    self.outbox.put_nowait({"type": "error", "message": f"unknown type: {kind}"})
+        finally:
+            if self.agent is not None:
+                self.agent.stop_chat_thread()
+                # close()はスレッドのjoinを待つのでループの外でやる
+                await self.loop.run_in_executor(None, self.agent.close)
+            logging.info(f"session {self.session_id} closed: {self.metrics.summary()}")
+            self.outbox.put_nowait(None)
+            await writer_task
+            self.writer.close()
+
+
+class ConversationServer:
+    """
+    複数のConversationSessionを1つのイベントループで受け持つサーバー
+    """
+
+    def __init__(self, tts_speakers: Optional[list] = None, synthesis_workers: int = 4, cache_items: int = 512,
+                 conversation_db: Optional[ConversationDB] = None, max_sessions: int = 16,
+                 agent_factory: Optional[Callable] = None):
+        """
+        Args:
+            tts_speakers (list): 各キャラクターの音声合成に使うSpeaker．Noneならテキストだけ送る
+            synthesis_workers (int): 全セッションで共有する音声合成のスレッド数
+            cache_items (int): 音声合成キャッシュの最大件数
+            conversation_db (ConversationDB): 全セッションで共有する会話の保存先
+            max_sessions (int): 同時に受け持つ最大セッション数
+            agent_factory (Callable): (session, user_id) -> AIAgent．省略時はMultiAIAgent
+        """
+        self.tts_speakers = tts_speakers
+        self.synthesis_executor = ThreadPoolExecutor(max_workers=synthesis_workers, thread_name_prefix="shared_synthesizer")
+        self.synthesis_cache = SynthesisCache(max_items=cache_items)
+        self.conversation_db = conversation_db
+        self.max_sessions = max_sessions
+        self.agent_factory = agent_factory or self._default_agent_factory
+        self.sessions = {}
+        self._ids = itertools.count(1)
+        # user_id -> [LongTermMemory, 使っているセッション数]．最後のセッションが閉じたら捨てる
+        self._memories = {}
+        self._memory_users = {}  # session_id -> user_id(長期記憶を使っているセッション)
+        self._memories_lock = threading.Lock()  # agent_factoryはループの外のスレッドで呼ばれる
+
+    def _default_agent_factory(self, session: ConversationSession, user_id: str):
+        n_characters = len(self.tts_speakers) if self.tts_speakers else 2
+        speakers = [RemoteSpeaker(session, i, self.tts_speakers[i] if self.tts_speakers else None, self.synthesis_cache)
+                    for i in range(n_characters)]
+        memory = self._acquire_memory(session.session_id, user_id) if self.conversation_db is not None else None
+        return MultiAIAgent(speakers=speakers, autosave=False, log_title=f"session{session.session_id}",
+                            conversation_db=self.conversation_db, user_id=user_id, long_term_memory=memory,
+                            synthesis_executor=self.synthesis_executor)
+
+    def _acquire_memory(self, session_id: int, user_id: str) -> LongTermMemory:
+        """user_idの長期記憶を返す(同じuserのセッションで共有する．無ければ会話の保存先から読み込む)"""
+        with self._memories_lock:
+            entry = self._memories.get(user_id)
+            if entry is None:
+                memory = LongTermMemory()
+                memory.load_from_db(self.conversation_db, user_id)
+                entry = self._memories[user_id] = [memory, 0]
+            entry[1] += 1
+            self._memory_users[session_id] = user_id
+            return entry[0]
+
+    def _release_memory(self, session_id: int) -> None:
+        """セッションが閉じた．そのuserのセッションが無くなったら長期記憶を捨てる(次に来たら読み込み直す)"""
+        with self._memories_lock:
+            user_id = self._memory_users.pop(session_id, None)
+            entry = self._memories.get(user_id)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._memories[user_id]
+        entry[0].close()
+
+    def stats(self) -> dict:
+        return {"sessions": len(self.sessions), "memories": len(self._memories), "synthesis_cache": self.synthesis_cache.stats()}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if len(self.sessions) >= self.max_sessions:
+            writer.write(b'{"type": "error", "message": "too many sessions"}\n')
+            await writer.drain()
+            writer.close()
+            return
+        session = ConversationSession(self, next(self._ids), reader, writer)
+        self.sessions[session.session_id] = session
+        logging.info(f"session {session.session_id} opened: {writer.get_extra_info('peername')}")
+        try:
+            await session.run()
+        except Exception as e:
+            # 1つのセッションの失敗で他のセッションを巻き込まない
+            logging.warning(f"session {session.session_id} failed: {e}")
+        finally:
+            del self.sessions[session.session_id]
+            self._release_memory(session.session_id)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        server = await asyncio.start_server(self._handle, host, port)
+        logging.info(f"listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+async def run_client(host: str, port: int, user_id: str) -> None:
+    """
+    動作確認用のクライアント: 標準入力の1行をuserの発話として送り，返ってきたセリフを表示する
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((json.dumps({"type": "hello", "user_id": user_id}) + "\n").encode("utf-8"))
+    await writer.drain()
+
+    async def receive():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            if message["type"] == "say":
+                print(f"[{message['speaker']}] {message['text']}")
+            else:
+                print(message)
+
+    receiver = asyncio.create_task(receive())
+    loop = asyncio.get_running_loop()
+    while True:
+        text = await loop.run_in_executor(None, sys.stdin.readline)
+        if not text:
+            break
+        text = text.strip()
+        command = {"/stats": {"type": "stats"}, "/cancel": {"type": "cancel"}}.get(text, {"type": "user", "text": text})
+        writer.write((json.dumps(command, ensure_ascii=False) + "\n").encode("utf-8"))
+        await writer.drain()
+    writer.write(b'{"type": "bye"}\n')
+    await writer.drain()
+    await receiver
+
+
+def _create_tts_speakers(tts: str, speaker_ids: List[int]) -> Optional[list]:
+    if tts == "none":
+        return None
+    # pyaudioなどが要るので，使うときだけimportする
+    try:
+        from .speech.speech_wrapper import VoiceVoxSpeaker, AivisSpeechSpeaker
+    except ImportError:
+        from talk.speech.speech_wrapper import VoiceVoxSpeaker, AivisSpeechSpeaker
+    speaker_class = {"voicevox": VoiceVoxSpeaker, "aivis": AivisSpeechSpeaker}[tts]
+    return [speaker_class(speaker_id=speaker_id) for speaker_id in speaker_ids]
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(prog="python -m talk.server", description="複数の端末の会話を受け持つ会話サーバー")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--tts", choices=["none", "voicevox", "aivis"], default="none", help="音声合成エンジン(noneならテキストだけ送る)")
+    p.add_argument("--speaker-ids", type=int, nargs="+", default=[3, 2], help="各キャラクターの話者ID")
+    p.add_argument("--synthesis-workers", type=int, default=4, help="全セッションで共有する音声合成のスレッド数")
+    p.add_argument("--max-sessions", type=int, default=16)
+    p.add_argument("--db", default=".user_data/conversation.db", help="会話の保存先(空文字で保存しない)")
+    p.add_argument("--client", action="store_true", help="サーバーではなく動作確認用のクライアントとして起動する")
+    p.add_argument("--user-id", default="default", help="--clientの時のuserのID")
+    return p
+
+
+def main(argv=None) -> int:
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    args = build_argparser().parse_args(argv)
+    if args.client:
+        asyncio.run(run_client(args.host, args.port, args.user_id))
+        return 0
+    server = ConversationServer(
+        tts_speakers=_create_tts_speakers(args.tts, args.speaker_ids),
+        synthesis_workers=args.synthesis_workers,
+        conversation_db=ConversationDB(args.db) if args.db else None,
+        max_sessions=args.max_sessions,
+    )
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+音声認識の途中結果でGPTへのリクエストを先に投げておく(投機実行)ためのクラス群
+
+ChatBotはuserが黙ってからresponse_start_threshold(1秒)待ってからリクエストを送るので，
+その1秒の後にさらにGPTの最初の応答が返ってくるまでの時間がまるまる待ち時間になっていた．
+投機実行では短い無音の時点で途中結果のままリクエストを送っておき，応答は話さずに止めておく．
+1秒経って確定した発話が途中結果と同じならそのまま話し始め(commit)，違っていたら捨ててやり直す．
+commit率と短縮できた時間はSpeculationStatsに溜めておくので，しきい値の調整に使う．
+
+author: matsumoto
+"""
+
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+# 比較の時に無視する文字(音声認識は最後に句読点が付いたり付かなかったりするので)
+_IGNORED_CHARS = re.compile(r"[\s、。,.!?！？…]+")
+
+
+def normalize_transcript(text: str) -> str:
+    """認識結果の比較用に空白と句読点を取り除く"""
+    return _IGNORED_CHARS.sub("", text or "")
+
+
+@dataclass
+class Speculation:
+    """投機実行中のリクエスト1件分"""
+
+    message: str  # 投機実行に使った途中結果
+    gate: threading.Event = field(default_factory=threading.Event)  # セットされるまで応答を話さずに止めておく
+    started_at: float = field(default_factory=time.perf_counter)
+    committed_at: Optional[float] = None
+    first_item_at: Optional[float] = None  # 最初の応答が届いた時刻
+
+    def matches(self, message: str) -> bool:
+        return normalize_transcript(self.message) == normalize_transcript(message)
+
+    def saved_latency(self) -> Optional[float]:
+        """
+        投機実行で短縮できた時間(秒)
+        投機実行しなければcommitの時点から最初の応答までの時間(TTFT)待つことになるので，
+        短縮できたのは min(TTFT, commitまでの先行時間)
+        """
+        if self.committed_at is None or self.first_item_at is None:
+            return None
+        ttft = self.first_item_at - self.started_at
+        return max(0.0, min(ttft, self.committed_at - self.started_at))
+
+
+class SpeculationStats:
+    """投機実行の結果の集計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempts = 0  # 投機実行した回数
+        self.commits = 0  # 途中結果が確定結果と一致して，そのまま使えた回数
+        self.cancels = 0  # 途中結果から変わってしまい捨てた回数
+        self.saved_latencies: List[float] = []  # commitしたときに短縮できた時間(秒)
+
+    def add_attempt(self) -> None:
+        with self._lock:
+            self.attempts += 1
+
+    def add_commit(self) -> None:
+        with self._lock:
+            self.commits += 1
+
+    def add_cancel(self) -> None:
+        with self._lock:
+            self.cancels += 1
+
+    def add_saved_latency(self, seconds: float) -> None:
+        with self._lock:
+            self.saved_latencies.append(seconds)
+
+    def commit_rate(self) -> Optional[float]:
+        decided = self.commits + self.cancels
+        return self.commits / decided if decided else None
+
+    def summary(self) -> dict:
+        with self._lock:
+            saved = list(self.saved_latencies)
+        return {
+            "attempts": self.attempts,
+            "commits": self.commits,
+            "cancels": self.cancels,
+            "commit_rate": self.commit_rate(),
+            "mean_saved_latency": sum(saved) / len(saved) if saved else None,
+            "total_saved_latency": sum(saved),
+        }
@@ -0,0 +1,271 @@
+"""
+author Matsumoto
+マイクの音声の前処理(ゲイン・AGC・ハイパス・ノイズ抑圧)
+
+以前はMicrophoneStream._fill_bufferで (audio_data * sensitivity).astype(np.int16) としていたので，
+コールバックのたびにfloat64の配列を作り，sensitivityが1より大きいと大きな音がint16で折り返して(wrap)ノイズになっていた．
+ここではバッファを最初に確保しておき，PortAudioのコールバックの中で以下を配列の演算だけで行う
+- ハイパス(既定100Hz)とノイズ抑圧: 512点(50%オーバーラップ)のSTFTで，帯域の下側を落とし，
+  各周波数の雑音の大きさ(最小値追従)を引く．overlap-addのために32msの遅延が入る
+- AGC: 話している(レベルがagc_thresholdを超える)チャンクだけでゲインを合わせる．チャンク内でゲインを滑らかに変える
+- sensitivityのゲインとクリップ(折り返さずに飽和させる)
+1回の処理がチャンクの長さ×budgetを何度も超えたら，STFT(ハイパス・ノイズ抑圧)を止めて軽くする(入力のオーバーフローを起こさないように)．
+
+ベンチマーク: python -m talk.speech.audio_frontend
+"""
+
+import logging
+import time
+from typing import Optional
+
+import numpy as np
+
+
+class AudioFrontEnd:
+    """
+    int16・モノラルのチャンクを前処理する．process()の戻り値の配列は次の呼び出しで上書きされるので，残すならコピーすること
+    """
+
+    def __init__(self, rate: int = 16000, chunk: int = 1600, sensitivity: float = 1.0, agc: bool = True,
+                 target_rms: float = 3000.0, max_gain: float = 8.0, agc_threshold: float = 300.0,
+                 highpass_hz: Optional[float] = 100.0, noise_suppression: bool = True, frame: int = 512,
+                 budget: float = 0.2):
+        """
+        Args:
+            rate (int): サンプルレート
+            chunk (int): 1回のコールバックのサンプル数
+            sensitivity (float): 固定のゲイン(これまでのsensitivity)
+            agc (bool): AGCを使うか
+            target_rms (float): AGCで合わせる話し声のRMS(int16のスケール)
+            max_gain (float): AGCのゲインの上限(下限はその逆数)
+            agc_threshold (float): これより小さいチャンクではAGCのゲインを変えない(無音を持ち上げないように)
+            highpass_hz (float): ハイパスの遮断周波数．Noneなら使わない
+            noise_suppression (bool): ノイズ抑圧を使うか
+            frame (int): STFTの長さ(サンプル)
+            budget (float): 1回の処理に使ってよい時間(チャンクの長さに対する割合)
+        """
+        self.rate = rate
+        self.chunk = chunk
+        self.sensitivity = sensitivity
+        self.agc = agc
+        self.target_rms = target_rms
+        self.max_gain = max_gain
+        self.agc_threshold = agc_threshold
+        self.noise_suppression = noise_suppression
+        self.budget_seconds = chunk / rate * budget
+        self.gain = 1.0  # 今のAGCのゲイン
+        self._chunk = np.zeros(chunk, dtype=np.float32)
+        self._gain_ramp = np.linspace(0.0, 1.0, chunk, endpoint=False, dtype=np.float32)
+        self._gain_curve = np.empty(chunk, dtype=np.float32)
+        self._out = np.zeros(chunk, dtype=np.int16)
+
+        # STFT(ハイパス・ノイズ抑圧)用
+        self._spectral = noise_suppression or bool(highpass_hz)
+        self.frame = frame
+        self.hop = frame // 2
+        bins = frame // 2 + 1
+        n = np.arange(frame)
+        self._window = np.sqrt(0.5 - 0.5 * np.cos(2 * np.pi * n / frame)).astype(np.float32)  # 2乗の重ね合わせが1になる窓
+        self._in_fifo = np.zeros(chunk + frame, dtype=np.float32)
+        self._in_len = 0
+        self._out_fifo = np.zeros(chunk + 2 * frame, dtype=np.float32)
+        self._out_len = frame  # 遅延の分を無音で埋めておく(毎回chunk個を返せるように)
+        self._time_frame = np.zeros(frame, dtype=np.float32)
+        self._ola = np.zeros(self.hop, dtype=np.float32)
+        self._spectrum = np.empty(bins, dtype=np.complex64)
+        self._magnitude = np.empty(bins, dtype=np.float32)
+        self._noise = np.zeros(bins, dtype=np.float32)
+        self._noise_ready = False
+        self._bin_gain = np.empty(bins, dtype=np.float32)
+        self._highpass = ((np.fft.rfftfreq(frame, 1.0 / rate) >= highpass_hz).astype(np.float32)
+                          if highpass_hz else None)
+        try:
+            np.fft.rfft(self._time_frame, out=self._spectrum)
+            self._fft_out = True  # numpy 2以降はFFTの結果も確保済みの配列に書ける
+        except TypeError:
+            self._fft_out = False
+
+        self.callbacks = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.over_budget = 0  # 予算を超えた回数
+        self.clipped_chunks = 0  # クリップしたチャンクの数
+        self.degraded = False  # 予算を超え続けたのでハイパスとノイズ抑圧を止めた
+        self._over_streak = 0
+
+    def process(self, data) -> np.ndarray:
+        """
+        チャンクを1つ前処理する
+
+        Args:
+            data: int16のPCM(bytesまたはndarray)
+
+        Returns:
+            np.ndarray: 前処理したint16の配列(次の呼び出しで上書きされる)
+        """
+        start_time = time.perf_counter()
+        samples = np.frombuffer(data, dtype=np.int16) if isinstance(data, (bytes, bytearray)) else data
+        if samples.size != self.chunk:
+            # コールバックの長さが違うことは普通ないが，来たら前処理せずにゲインだけかける
+            return np.clip(samples.astype(np.float32) * self.sensitivity, -32768, 32767).astype(np.int16)
+        x = self._chunk
+        np.copyto(x, samples, casting="unsafe")
+        if self._spectral:
+            self._process_spectral(x)
+
+        # AGC: 話しているチャンクだけでゲインを合わせる(下げるときは速く，上げるときはゆっくり)
+        previous_gain = self.gain
+        if self.agc:
+            level = float(np.sqrt(np.dot(x, x) / x.size))
+            if level * self.gain >= self.agc_threshold:
+                desired = min(self.max_gain, max(1.0 / self.max_gain, self.target_rms / max(level, 1.0)))
+                self.gain += (desired - self.gain) * (0.5 if desired < self.gain else 0.05)
+        # チャンクの中でゲインを直線的に変える(段差でクリックが出ないように)
+        np.multiply(self._gain_ramp, (self.gain - previous_gain) * self.sensitivity, out=self._gain_curve)
+        self._gain_curve += previous_gain * self.sensitivity
+        x *= self._gain_curve
+
+        if x.max() > 32767 or x.min() < -32768:
+            self.clipped_chunks += 1
+            np.clip(x, -32768, 32767, out=x)
+        np.rint(x, out=x)
+        np.copyto(self._out, x, casting="unsafe")
+
+        elapsed = time.perf_counter() - start_time
+        self.callbacks += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        if elapsed > self.budget_seconds:
+            self.over_budget += 1
+            self._over_streak += 1
+            if self._over_streak >= 3 and not self.degraded:
+                # 遅延は変えずに素通しにする(FFTが処理時間のほとんど)
+                logging.debug(f"前処理が予算({self.budget_seconds * 1000:.0f}ms)を超え続けたのでハイパスとノイズ抑圧を止める")
+                self.noise_suppression = False
+                self._highpass = None
+                self.degraded = True
+        else:
+            self._over_streak = 0
+        return self._out
+
+    def _process_spectral(self, x: np.ndarray) -> None:
+        """STFTでハイパスとノイズ抑圧をかけ，xを(frame分遅れた)処理後の音で置き換える"""
+        frame, hop = self.frame, self.hop
+        n = x.size
+        self._in_fifo[self._in_len:self._in_len + n] = x
+        self._in_len += n
+        while self._in_len >= frame:
+            if self.noise_suppression or self._highpass is not None:
+                out = self._process_frame(self._in_fifo[:frame])
+            else:
+                out = self._in_fifo[:hop]  # 軽くしたとき: 同じ遅延のまま素通し
+            self._out_fifo[self._out_len:self._out_len + hop] = out
+            self._out_len += hop
+            self._in_fifo[:self._in_len - hop] = self._in_fifo[hop:self._in_len]
+            self._in_len -= hop
+        x[:] = self._out_fifo[:n]
+        self._out_fifo[:self._out_len - n] = self._out_fifo[n:self._out_len]
+        self._out_len -= n
+
+    def _process_frame(self, frame_data: np.ndarray) -> np.ndarray:
+        """1フレーム分のSTFT処理．overlap-addで確定したhop個のサンプルを返す"""
+        hop = self.hop
+        buf = self._time_frame
+        np.multiply(frame_data, self._window, out=buf)
+        if self._fft_out:
+            spectrum = np.fft.rfft(buf, out=self._spectrum)
+        else:
+            spectrum = self._spectrum
+            spectrum[:] = np.fft.rfft(buf)
+        gain = self._bin_gain
+        if self.noise_suppression:
+            magnitude = self._magnitude
+            np.abs(spectrum, out=magnitude)
+            if not self._noise_ready:
+                self._noise[:] = magnitude
+                self._noise_ready = True
+            # 雑音の大きさは最小値追従(ゆっくり上げ，小さい値が来たらすぐ下げる)
+            self._noise *= 1.002
+            np.minimum(self._noise, magnitude, out=self._noise)
+            # スペクトル減算: 雑音の2倍を引き，下限は0.1(ミュージカルノイズを抑える)
+            np.maximum(magnitude, 1e-6, out=magnitude)
+            np.divide(self._noise, magnitude, out=gain)
+            gain *= -2.0
+            gain += 1.0
+            np.maximum(gain, 0.1, out=gain)
+        else:
+            gain.fill(1.0)
+        if self._highpass is not None:
+            gain *= self._highpass
+        spectrum *= gain
+        if self._fft_out:
+            np.fft.irfft(spectrum, n=self.frame, out=buf)
+        else:
+            buf[:] = np.fft.irfft(spectrum, n=self.frame)
+        buf *= self._window
+        buf[:hop] += self._ola
+        self._ola[:] = buf[hop:]
+        return buf[:hop]
+
+    def stats(self) -> dict:
+        return {
+            "callbacks": self.callbacks,
+            "mean_ms": self.total_time / self.callbacks * 1000 if self.callbacks else None,
+            "max_ms": self.max_time * 1000,
+            "budget_ms": self.budget_seconds * 1000,
+            "over_budget": self.over_budget,
+            "clipped_chunks": self.clipped_chunks,
+            "agc_gain": self.gain,
+            "degraded": self.degraded,
+        }
+
+
+def benchmark(callbacks: int = 2000, rate: int = 16000, chunk: int = 1600, sensitivity: float = 2.0) -> dict:
+    """
+    合成した音声(話し声っぽい帯域の雑音+低い唸り+背景雑音)で，コールバック1回あたりの処理時間を計る
+    比較用に以前の (audio_data * sensitivity).astype(np.int16) の時間も計る
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(chunk * 50) / rate
+    speech = (np.sin(2 * np.pi * 220 * t) * 6000 * (np.sin(2 * np.pi * 0.5 * t) > 0)).astype(np.float32)
+    hum = (np.sin(2 * np.pi * 50 * t) * 1500).astype(np.float32)
+    noise = rng.normal(0, 200, t.size).astype(np.float32)
+    signal = np.clip(speech + hum + noise, -32768, 32767).astype(np.int16)
+    chunks = [signal[i:i + chunk].tobytes() for i in range(0, signal.size - chunk + 1, chunk)]
+
+    frontend = AudioFrontEnd(rate, chunk, sensitivity=sensitivity)
+    times = []
+    for i in range(callbacks):
+        start_time = time.perf_counter()
+        frontend.process(chunks[i % len(chunks)])
+        times.append(time.perf_counter() - start_time)
+    legacy = []
+    for i in range(callbacks):
+        start_time = time.perf_counter()
+        audio_data = np.frombuffer(chunks[i % len(chunks)], dtype=np.int16)
+        (audio_data * sensitivity).astype(np.int16)
+        legacy.append(time.perf_counter() - start_time)
+    times.sort()
+    legacy.sort()
+    return {
+        "callbacks": callbacks,
+        "chunk_ms": chunk / rate * 1000,
+        "budget_ms": frontend.budget_seconds * 1000,
+        "p50_ms": times[len(times) // 2] * 1000,
+        "p99_ms": times[int(len(times) * 0.99)] * 1000,
+        "max_ms": times[-1] * 1000,
+        "legacy_p50_ms": legacy[len(legacy) // 2] * 1000,
+        "over_budget": frontend.over_budget,
+        "clipped_chunks": frontend.clipped_chunks,
+        "degraded": frontend.degraded,
+    }
+
+
+def main():
+    result = benchmark()
+    for key, value in result.items():
+        print(f"{key:>15}: {value:.3f}" if isinstance(value, float) else f"{key:>15}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+author Matsumoto
+VADの判定で，音声認識(クラウド)に送る音声を話している間だけに絞るゲート
+
+以前はマイクの100msのチャンクを無音の間もすべてGoogleに送っていたので，通信量と料金の大半は無音だった．
+ここでは声がしている間(と，その後のhangover)だけ音声を通し，それ以外は溜めておいて送らない．
+- 声の出だしはVADが判定するより少し前から始まっている(子音など)ので，直前のpreroll分を溜めておき，開いたときに先に送る
+- 何も送らないとストリーミングのセッションが無音のエラーで切れるので，閉じている間もkeepalive_intervalごとに短い無音を送る
+ゲートの開閉はadd_listenerで登録したコールバックに通知する．
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+
+class AudioGate:
+    """
+    マイクのチャンクを受け取り，音声認識に送るチャンクを返す．process()はマイクのスレッドから呼ばれる想定
+    """
+
+    def __init__(self, rate: int = 16000, preroll_seconds: float = 0.3, hangover_seconds: float = 0.6,
+                 keepalive_interval: float = 2.0, keepalive_seconds: float = 0.02):
+        """
+        Args:
+            rate (int): サンプルレート(int16・モノラル)
+            preroll_seconds (float): 開いたときに先に送る直前の音声の長さ
+            hangover_seconds (float): 声が止んでから閉じるまでの時間(音声認識が発話の終わりを判断するのにも必要)
+            keepalive_interval (float): 閉じている間に無音を送る間隔(秒)
+            keepalive_seconds (float): 送る無音の長さ(秒)
+        """
+        self.rate = rate
+        self.preroll_seconds = preroll_seconds
+        self.hangover_seconds = hangover_seconds
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_chunk = bytes(int(rate * keepalive_seconds) * 2)
+        self.is_open = False
+        self.listeners: List[Callable[[bool, float], None]] = []  # ゲートの開閉で呼ばれる(is_open, 時刻)
+        self.input_seconds = 0.0  # マイクから受け取った音声の長さ
+        self.streamed_seconds = 0.0  # 音声認識に送った音声の長さ(keepaliveを含む)
+        self.opens = 0  # 開いた回数
+        self.keepalives = 0  # 送ったkeepaliveの数
+        self._preroll = deque()
+        self._preroll_seconds = 0.0
+        self._last_speech_at: Optional[float] = None
+        self._last_sent_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _duration(self, chunk: bytes) -> float:
+        return len(chunk) / 2 / self.rate
+
+    def process(self, chunk: bytes, is_speech: bool, now: Optional[float] = None) -> List[bytes]:
+        """
+        チャンクを1つ処理する
+
+        Args:
+            chunk (bytes): int16のPCM
+            is_speech (bool): VADの判定
+            now (float): チャンクの時刻(monotonic)．省略時は今
+
+        Returns:
+            list: 音声認識に送るチャンク(送らなければ空)
+        """
+        now = time.monotonic() if now is None else now
+        duration = self._duration(chunk)
+        changed = None
+        with self._lock:
+            self.input_seconds += duration
+            if self._last_sent_at is None:
+                self._last_sent_at = now
+            if is_speech:
+                self._last_speech_at = now
+            if self.is_open:
+                out = [chunk]
+                if not is_speech and now - self._last_speech_at >= self.hangover_seconds:
+                    self.is_open = changed = False
+            elif is_speech:
+                # 溜めておいた直前の音声から送る(声の出だしを落とさないように)
+                out = list(self._preroll) + [chunk]
+                self._preroll.clear()
+                self._preroll_seconds = 0.0
+                self.is_open = changed = True
+                self.opens += 1
+            else:
+                self._preroll.append(chunk)
+                self._preroll_seconds += duration
+                while self._preroll and self._preroll_seconds - self._duration(self._preroll[0]) >= self.preroll_seconds:
+                    self._preroll_seconds -= self._duration(self._preroll.popleft())
+                out = []
+                if now - self._last_sent_at >= self.keepalive_interval:
+                    out = [self.keepalive_chunk]
+                    self.keepalives += 1
+            if out:
+                self._last_sent_at = now
+                self.streamed_seconds += sum(self._duration(data) for data in out)
+        if changed is not None:
+            for listener in list(self.listeners):
+                listener(changed, now)
+        return out
+
+    def add_listener(self, callback: Callable[[bool, float], None]) -> None:
+        """
+        ゲートの開閉を通知するコールバックを登録する．マイクのスレッドから呼ばれるので，すぐに返すこと
+
+        Args:
+            callback: callback(is_open, 時刻(monotonic))
+        """
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[bool, float], None]) -> None:
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "input_seconds": self.input_seconds,
+                "streamed_seconds": self.streamed_seconds,
+                "streamed_ratio": self.streamed_seconds / self.input_seconds if self.input_seconds else None,
+                "opens": self.opens,
+                "keepalives": self.keepalives,
+            }
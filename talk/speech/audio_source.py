@@ -0,0 +1,146 @@
+"""
+author Matsumoto
+MicrophoneStreamに音声を流し込む入力(オーディオソース)
+
+以前のMicrophoneStreamはPyAudioのマイクからしか読めなかったので，音声認識の挙動を録音で試したり測ったりできなかった．
+ここではチャンクをcallback(data, now)で渡すものをオーディオソースとし，
+- PyAudioSource: マイク(今までどおり)
+- WavFileSource: WAVファイル．realtime=Trueなら録音と同じ速さで，Falseならできるだけ速く流す
+を用意する．WavFileSourceのnowは音声の中の時刻なので，速く流してもVAD・ゲートの判定は実時間と同じになる．
+"""
+
+import threading
+import time
+import wave
+from typing import Callable, Optional
+
+import numpy as np
+
+
+class AudioSource:
+    """
+    オーディオソースの抽象クラスのつもり．start(callback)でint16・モノラルのチャンクをcallback(data, now)で渡し始める
+    nowはチャンクの(最後の)時刻(monotonic)．Noneなら受け取った側が今の時刻を使う
+    """
+
+    def __init__(self, rate: int = 16000, chunk: int = 1600):
+        self.rate = rate
+        self.chunk = chunk
+        self.finished = threading.Event()  # 最後まで流し終わった(マイクなら閉じた)
+        self.position = 0.0  # 流した音声の長さ(秒)
+
+    def start(self, callback: Callable[[bytes, Optional[float]], None]) -> None:
+        raise NotImplementedError
+
+    def stop(self) -> None:
+        raise NotImplementedError
+
+
+class PyAudioSource(AudioSource):
+    """PyAudioのマイク"""
+
+    def __init__(self, rate: int = 16000, chunk: int = 1600):
+        super().__init__(rate, chunk)
+        self.input_overflows = 0  # PortAudioの入力のオーバーフロー(コールバックが間に合わなかった)回数
+        self._audio_interface = None
+        self._audio_stream = None
+
+    def start(self, callback):
+        import pyaudio  # マイクを使うときだけ必要
+
+        def fill_buffer(in_data, frame_count, time_info, status_flags):
+            if status_flags & pyaudio.paInputOverflow:
+                self.input_overflows += 1
+            self.position += frame_count / self.rate
+            callback(in_data, None)
+            return None, pyaudio.paContinue
+
+        self._audio_interface = pyaudio.PyAudio()  # PyAudioインスタンスを作成
+        self._audio_stream = self._audio_interface.open(
+            format=pyaudio.paInt16,  # 16ビットの整数型でオーディオデータを扱う
+            channels=1,  # モノラルで録音
+            rate=self.rate,  # サンプルレートを設定
+            input=True,  # 入力ストリームとして開く
+            frames_per_buffer=self.chunk,  # チャンクサイズごとにオーディオデータを読み込む
+            stream_callback=fill_buffer,  # コールバック関数を設定
+        )
+
+    def stop(self):
+        if self._audio_stream is not None:
+            self._audio_stream.stop_stream()  # ストリームを停止
+            self._audio_stream.close()  # ストリームを閉じる
+            self._audio_interface.terminate()  # PyAudioインスタンスを終了
+            self._audio_stream = self._audio_interface = None
+        self.finished.set()
+
+
+def read_wav(path: str, rate: int = 16000) -> np.ndarray:
+    """
+    WAVファイル(16bitのPCM)をint16・モノラル・rateの配列として読む．
+    ステレオはチャンネルの平均，サンプルレートが違えば線形補間で変換する(音声認識には十分)
+    """
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{path}: 16bitのPCMのWAVのみ対応しています")
+        channels = wav.getnchannels()
+        file_rate = wav.getframerate()
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    if file_rate != rate and samples.size:
+        length = int(round(samples.size * rate / file_rate))
+        samples = np.interp(np.arange(length) * file_rate / rate, np.arange(samples.size), samples)
+    return np.asarray(samples).astype(np.int16)
+
+
+class WavFileSource(AudioSource):
+    """
+    WAVファイルをチャンクに分けて流す
+    最後にtail_silence秒の無音を足すので，ゲートが閉じ(SEGMENT_END)，音声認識も最後の発話を確定できる
+    """
+
+    def __init__(self, path: str, rate: int = 16000, chunk: int = 1600, realtime: bool = True, tail_silence: float = 1.5):
+        """
+        Args:
+            path (str): WAVファイル
+            rate (int): 音声認識に渡すサンプルレート(ファイルと違えば変換する)
+            chunk (int): チャンクのサンプル数
+            realtime (bool): Trueなら録音と同じ速さで流す．Falseならできるだけ速く流す
+            tail_silence (float): 最後に足す無音の長さ(秒)
+        """
+        super().__init__(rate, chunk)
+        self.path = path
+        self.realtime = realtime
+        self.samples = read_wav(path, rate)
+        self.duration = self.samples.size / rate  # 足す無音を含まない長さ(秒)
+        self.tail_silence = tail_silence
+        self.started_at: Optional[float] = None  # 流し始めた時刻(monotonic)．音声の中の時刻の0秒にあたる
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, callback):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._feed, args=(callback,), name="wav_source", daemon=True)
+        self._thread.start()
+
+    def _feed(self, callback):
+        samples = np.concatenate([self.samples, np.zeros(int(self.tail_silence * self.rate), dtype=np.int16)])
+        for start in range(0, samples.size, self.chunk):
+            if self._stopped.is_set():
+                break
+            data = samples[start:start + self.chunk]
+            if data.size < self.chunk:
+                data = np.pad(data, (0, self.chunk - data.size))  # 最後は無音で埋めてチャンクの長さをそろえる(AudioFrontEndの前提)
+            self.position = (start + self.chunk) / self.rate
+            now = self.started_at + self.position
+            if self.realtime:
+                # 毎回の誤差が積もらないように，流し始めからの時刻で待つ
+                self._stopped.wait(max(0.0, now - time.monotonic()))
+            callback(data.tobytes(), now)
+        self.finished.set()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        self.finished.set()
@@ -0,0 +1,141 @@
+"""
+author Matsumoto
+録音(WAVファイル)をまとめて音声認識し，認識結果をJSONLに書き出すコマンド
+
+ファイルごとにWavFileSourceを入力にした音声認識(google_stt.SpeechRecognizerかlocal_stt.LocalSpeechRecognizer)を作り，
+--jobs個のファイルを同時に流す．マイクのときと同じ前処理・VAD・ゲートを通るので，録音で挙動を確かめたり測ったりできる．
+--realtimeなら録音と同じ速さで流す(待ち時間を測るならこちら)．省略するとできるだけ速く流すが，これはローカルのモデルだけで，
+Googleのストリーミング認識は実時間より速く送ると失敗するので--backend googleでは常に録音と同じ速さで流す．
+
+JSONLの1行は認識結果1つ
+    {"file": ..., "seq": 通し番号, "text": ..., "is_final": ..., "audio_time": 届いたときに流し終わっていた音声の長さ(秒),
+     "elapsed": 流し始めてからの実時間(秒)}
+速く流したときのaudio_timeは，結果が届くまでに先に流れた分だけ実際の発話より後ろになる．
+ファイルごとの集計(標準出力)のrecognizerはstats()で，話し終わりからの待ち時間(final_latency)は--realtimeのとき(googleでは常に)だけ意味がある．
+
+使い方
+    python -m talk.speech.batch_transcribe rec1.wav rec2.wav -o transcripts.jsonl --backend google --jobs 4
+    python -m talk.speech.batch_transcribe recordings/*.wav -o transcripts.jsonl --backend vosk --model-path vosk-model-ja-0.22
+"""
+
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from .audio_source import WavFileSource
+    from .local_stt import LocalSpeechRecognizer
+    from .microphone import RATE, CHUNK
+except ImportError:
+    from audio_source import WavFileSource
+    from local_stt import LocalSpeechRecognizer
+    from microphone import RATE, CHUNK
+
+
+def make_recognizer(backend, model_options, source):
+    """backendの音声認識をsourceを入力にして作る("google"ならGoogle Cloud，それ以外はローカルのモデル)"""
+    if backend == "google":
+        try:
+            from .google_stt import SpeechRecognizer
+        except ImportError:
+            from google_stt import SpeechRecognizer
+        return SpeechRecognizer(source=source)
+    return LocalSpeechRecognizer(backend, model_options, source=source)
+
+
+def transcribe_file(path, backend="google", model_options=None, realtime=False, settle=3.0, finals_only=False):
+    """
+    WAVファイルを1つ音声認識する
+
+    Args:
+        path (str): WAVファイル
+        backend (str): "google"，またはLocalSpeechRecognizerのbackend
+        model_options (dict): ローカルのモデルの引数
+        realtime (bool): 録音と同じ速さで流すか(backendが"google"なら常に録音と同じ速さ)
+        settle (float): 流し終わってから，この秒数だけ新しい結果が来なければ終わりにする
+        finals_only (bool): 確定結果(is_final)だけを残すか
+
+    Returns:
+        tuple: (認識結果のリスト, ファイルの集計)
+    """
+    source = WavFileSource(path, RATE, CHUNK, realtime=realtime or backend == "google")
+    records = []
+    started_at = time.monotonic()
+    recognizer = make_recognizer(backend, model_options or {}, source)
+
+    def on_transcript(text):
+        latest = recognizer.get_latest_transcript()
+        if latest is None or (finals_only and not latest.is_final):
+            return
+        records.append({"file": path, "seq": latest.seq, "text": latest.text, "is_final": latest.is_final,
+                        "audio_time": round(source.position, 3), "elapsed": round(time.monotonic() - started_at, 3)})
+
+    recognizer.add_listener(on_transcript)
+    try:
+        source.finished.wait()
+        version = recognizer.transcripts.version
+        while True:
+            latest = recognizer.wait_for_transcript(version, timeout=settle)
+            if latest is None and not getattr(recognizer, "pending", 0):
+                break
+            version = recognizer.transcripts.version
+    finally:
+        recognizer.stop_recognition()
+    wall_seconds = time.monotonic() - started_at
+    summary = {
+        "file": path,
+        "duration": round(source.duration, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "speed": round(source.duration / wall_seconds, 2) if wall_seconds else None,
+        "results": len(records),
+        "finals": sum(record["is_final"] for record in records),
+        "recognizer": recognizer.stats(),
+    }
+    if getattr(recognizer, "error", None):
+        summary["error"] = recognizer.error
+    return records, summary
+
+
+def main():
+    p = argparse.ArgumentParser(prog="python -m talk.speech.batch_transcribe", description="WAVファイルをまとめて音声認識してJSONLに書き出す")
+    p.add_argument("files", nargs="+", help="WAVファイル(16bitのPCM)")
+    p.add_argument("-o", "--output", required=True, help="書き出すJSONL")
+    p.add_argument("--backend", default="google", help='"google"，"vosk"，"faster_whisper"，"モジュール名:クラス名"')
+    p.add_argument("--model-path", help="Voskのモデルのディレクトリ")
+    p.add_argument("--model-size", default="small", help="faster-whisperのモデル")
+    p.add_argument("--jobs", type=int, default=4, help="同時に流すファイルの数(ローカルのモデルはファイルごとにプロセスを立てる)")
+    p.add_argument("--realtime", action="store_true", help="録音と同じ速さで流す(待ち時間を測るとき．--backend googleでは常にそうする)")
+    p.add_argument("--settle", type=float, default=3.0, help="流し終わってから結果を待つ秒数")
+    p.add_argument("--finals-only", action="store_true", help="確定結果だけを書き出す")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.backend == "google" and not args.realtime:
+        logging.info("Googleのストリーミング認識は実時間より速く送れないので，録音と同じ速さで流します")
+    options = {"model_path": args.model_path} if args.backend == "vosk" else (
+        {"model_size": args.model_size} if args.backend == "faster_whisper" else {})
+
+    started_at = time.monotonic()
+    total_duration = 0.0
+    with open(args.output, "w", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(transcribe_file, path, args.backend, options, args.realtime, args.settle,
+                                   args.finals_only): path for path in args.files}
+        for future in as_completed(futures):
+            try:
+                records, summary = future.result()
+            except Exception as e:
+                logging.error(f"{futures[future]}: 音声認識に失敗しました: {e}")
+                continue
+            for record in records:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            total_duration += summary["duration"]
+            print(json.dumps(summary, ensure_ascii=False))
+    wall_seconds = time.monotonic() - started_at
+    print(f"{len(args.files)}ファイル，{total_duration:.1f}秒の音声を{wall_seconds:.1f}秒で処理しました"
+          f"(実時間の{total_duration / wall_seconds:.1f}倍)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+author Matsumoto
+スピーカーから出た自分の声をマイクで拾って認識しないようにするエコー抑圧
+
+スピーカーの音をマイクが拾うと，自分のセリフが音声認識に送られ(課金され)，それに対してまたGPTに応答させ，
+応答中の割り込みとしても検出されてしまう(tester.pyのknown issue)．
+ここでは再生側(TextToVoiceVox.play_wav)が書き込んだ音のエネルギーを参照信号として共有し，
+マイク側(MicrophoneStream)は各フレームについて「今スピーカーから出ている音がマイクに回り込んだらこのくらい」という
+レベルを見積もって，それより小さいフレームはエコーだけとみなして無音にしてから音声認識に送る．
+userが再生中に話した(ダブルトーク)フレームはエコーの見積もりより十分大きいので，そのまま通す(割り込みの検出に必要)．
+
+スピーカーからマイクへの回り込みの大きさ(結合係数)は再生中のフレームから学習するので，音量や配置を変えても調整しなくてよい．
+本物のエコーキャンセラ(適応フィルタ)ではないので，エコーとuserの声が重なったフレームからエコーだけを取り除くことはしない．
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import numpy as np
+
+
+class EchoReference:
+    """
+    再生中の音声のエネルギーの履歴(参照信号)．再生スレッドがpublishし，マイクのスレッドがlevelで読む
+    """
+
+    def __init__(self, max_entries: int = 2000):
+        self._entries = deque(maxlen=max_entries)  # (書き込んだ時刻, 再生し終わる時刻, RMS)
+        self._lock = threading.Lock()
+
+    def publish(self, data: bytes, rate: int, channels: int = 1, at: Optional[float] = None) -> None:
+        """
+        スピーカーに書き込んだ音声(int16のPCM)を登録する
+
+        Args:
+            data (bytes): 書き込んだPCM
+            rate (int): サンプルレート
+            channels (int): チャンネル数
+            at (float): 書き込んだ時刻(monotonic)．省略時は今
+        """
+        at = time.monotonic() if at is None else at
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        if samples.size == 0:
+            return
+        level = float(np.sqrt(np.dot(samples, samples) / samples.size))
+        duration = samples.size / channels / rate
+        with self._lock:
+            self._entries.append((at, at + duration, level))
+
+    def level(self, start: float, end: float) -> float:
+        """[start, end]に鳴っていた(と思われる)音の最大のRMS．何も鳴っていなければ0"""
+        with self._lock:
+            levels = [level for began, ended, level in reversed(self._entries) if began <= end and ended >= start]
+        return max(levels) if levels else 0.0
+
+
+# 同じプロセスの再生とマイクで共有する参照信号
+DEFAULT_ECHO_REFERENCE = EchoReference()
+
+
+class EchoSuppressor:
+    """
+    マイクのフレームを参照信号と比べ，エコーだけのフレームを無音にする．process()はマイクのスレッドから呼ばれる想定
+    """
+
+    def __init__(self, reference: Optional[EchoReference] = None, rate: int = 16000, max_delay: float = 0.35,
+                 margin: float = 2.0, initial_coupling: float = 4.0, min_rms: float = 200.0):
+        """
+        Args:
+            reference (EchoReference): 参照信号．省略時はDEFAULT_ECHO_REFERENCE
+            rate (int): マイクのサンプルレート
+            max_delay (float): 書き込んでからマイクに届くまでの最大の遅れ(出力・入力のバッファと残響の分)(秒)
+            margin (float): エコーの見積もりの何倍までをエコーだけとみなすか
+            initial_coupling (float): 学習前の結合係数(マイクのRMS/参照信号のRMS)．大きめにしておき，再生中に下げていく
+            min_rms (float): これより小さいフレームは抑圧しても数えない(もともと無音)
+        """
+        self.reference = reference or DEFAULT_ECHO_REFERENCE
+        self.rate = rate
+        self.max_delay = max_delay
+        self.margin = margin
+        self.coupling = initial_coupling
+        self.min_rms = min_rms
+        self.frames = 0  # 処理したフレーム数
+        self.playback_frames = 0  # 再生中だったフレーム数
+        self.suppressed_frames = 0  # 無音にした(声の大きさがあった)フレーム数
+        self.double_talk_frames = 0  # 再生中だがuserの声とみなして通したフレーム数
+        self.avoided_turns = 0  # 無音にしたフレームのかたまりの数(防いだ「自分の声への応答」の上限の見積もり)
+        self._suppressing = False
+        self._lock = threading.Lock()
+
+    def process(self, frame, now: Optional[float] = None) -> np.ndarray:
+        """
+        フレームを1つ処理する
+
+        Args:
+            frame: int16のPCM(bytesまたはndarray)
+            now (float): フレームを受け取った時刻(monotonic)．省略時は今
+
+        Returns:
+            np.ndarray: 音声認識に送るフレーム(エコーだけなら無音)
+        """
+        now = time.monotonic() if now is None else now
+        samples = np.frombuffer(frame, dtype=np.int16) if isinstance(frame, (bytes, bytearray)) else frame
+        if samples.size == 0:
+            return samples
+        as_float = samples.astype(np.float32)
+        mic = float(np.sqrt(np.dot(as_float, as_float) / samples.size))
+        duration = samples.size / self.rate
+        reference = self.reference.level(now - duration - self.max_delay, now)
+        with self._lock:
+            self.frames += 1
+            if reference <= 0.0:
+                self._suppressing = False
+                return samples
+            self.playback_frames += 1
+            if mic >= self.min_rms:
+                # 結合係数はエコーだけのフレームの比(下側の包絡線)なので，下がるときは速く，上がるときは遅く追う
+                # (再生が終わった直後の残りの窓のような，ほぼ無音のフレームでは学習しない)
+                ratio = mic / reference
+                self.coupling += (ratio - self.coupling) * (0.5 if ratio < self.coupling else 0.02)
+            if mic > self.coupling * reference * self.margin:
+                self.double_talk_frames += 1
+                self._suppressing = False
+                return samples
+            if mic >= self.min_rms:
+                self.suppressed_frames += 1
+                if not self._suppressing:
+                    self.avoided_turns += 1
+                self._suppressing = True
+            return np.zeros_like(samples)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "frames": self.frames,
+                "playback_frames": self.playback_frames,
+                "suppressed_frames": self.suppressed_frames,
+                "double_talk_frames": self.double_talk_frames,
+                "avoided_turns": self.avoided_turns,
+                "coupling": self.coupling,
+            }
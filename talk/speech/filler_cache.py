@@ -0,0 +1,93 @@
+"""
+author Matsumoto
+相槌・つなぎ言葉(「うん」「なるほどなのだ」など)の音声を起動時に合成しておくキャッシュ
+
+userが話し終わってからGPTの最初のセリフが再生されるまでには1秒以上の無音があることが多い．
+その間を埋めるために，ターンの開始と同時にキャッシュ済みの相槌を再生する(合成待ちがないので即座に鳴る)．
+相槌はSpeechPipelineに先に積むので，本来の応答はその再生が終わった直後に順番通り続く．
+"""
+
+import logging
+import random
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+DEFAULT_FILLERS = ["うん", "うんうん", "なるほど", "へえ"]
+
+
+class FillerCache:
+    """
+    話者ごとの相槌の音声のキャッシュ
+    warm_up()で合成しておき，pick()で取り出す．相槌のリストはスピーカーのインデックス(キャラクター)ごとに持つ．
+    同じ話者IDのスピーカーが同じテキストを使う場合だけ，合成済みの音声を共有する
+    """
+
+    def __init__(self, speakers: list, fillers: Optional[Dict[int, List[str]]] = None):
+        """
+        Args:
+            speakers (list): Speakerのリスト(AIAgentに渡すものと同じ並び)
+            fillers (dict): スピーカーのインデックス -> 相槌のリスト．無いスピーカーはDEFAULT_FILLERSを使う
+        """
+        self.speakers = speakers
+        self.fillers = fillers or {}
+        self._cache: Dict[int, List[Tuple[str, object]]] = {}  # スピーカーのインデックス -> [(テキスト, 合成済みデータ)]
+        self._synthesized: Dict[Tuple[object, str], object] = {}  # (話者のキー, テキスト) -> 合成済みデータ
+        self._lock = threading.Lock()
+        self._last_text = None
+        self.ready = threading.Event()
+
+    @staticmethod
+    def _key(speaker):
+        return (type(speaker).__name__, getattr(speaker, "speaker_id", id(speaker)))
+
+    def warm_up(self, background: bool = True) -> None:
+        """
+        全スピーカーの相槌を合成してキャッシュする
+
+        Args:
+            background (bool): Trueなら別スレッドで合成する(起動を待たせない)
+        """
+        if background:
+            threading.Thread(target=self.warm_up, args=(False,), name="filler_warm_up", daemon=True).start()
+            return
+        for index, speaker in enumerate(self.speakers):
+            key = self._key(speaker)
+            for text in self.fillers.get(index, DEFAULT_FILLERS):
+                with self._lock:
+                    if any(cached_text == text for cached_text, _ in self._cache.get(index, [])):
+                        continue
+                    data = self._synthesized.get((key, text))
+                if data is None:
+                    try:
+                        data = speaker.synthesize(text)
+                    except Exception as e:
+                        logging.debug("相槌の合成に失敗しました: %s", e)
+                        continue
+                with self._lock:
+                    self._synthesized[(key, text)] = data
+                    self._cache.setdefault(index, []).append((text, data))
+        self.ready.set()
+        logging.debug(f"相槌のキャッシュ完了: {sum(len(v) for v in self._cache.values())}件")
+
+    def pick(self, speaker_index: Optional[int] = None) -> Optional[Tuple[int, str, object]]:
+        """
+        相槌を1つ選ぶ(直前と同じものはなるべく避ける)
+
+        Args:
+            speaker_index (int): 話者のインデックス．省略時はキャッシュのある話者からランダムに選ぶ
+
+        Returns:
+            tuple: (スピーカーのインデックス, テキスト, 合成済みデータ)．キャッシュが無ければNone
+        """
+        indices = [speaker_index] if speaker_index is not None else list(range(len(self.speakers)))
+        with self._lock:
+            candidates = [(index, text, data)
+                          for index in indices
+                          for text, data in self._cache.get(index, [])]
+            if not candidates:
+                return None
+            fresh = [candidate for candidate in candidates if candidate[1] != self._last_text] or candidates
+            choice = random.choice(fresh)
+            self._last_text = choice[1]
+            return choice
@@ -16,88 +16,67 @@
 # 2. 環境変数GOOGLE_APPLICATION_CREDENTIALSを設定します。
 # 3. スクリプトを実行します。
 # 
-# known issue:
-# - 無音のまま放置するとエラー吐く
+# マイクのストリームは1つだけ開いておき、Google側のストリーミングのセッションだけを切り替える。
+# セッションには長さの上限(約5分)があり、無音のまま放置してもエラーで切れるので、
+# rotate_after秒経ったら(話していなければ)次のセッションを先に開き、直前の音声(overlap_seconds)を流し直してから古いセッションを閉じる。
+# 切り替えの間の音声は両方のセッションに流れるので、二重に認識された部分は取り除く。
+# 送る音声はAudioGateで話している間だけに絞る(無音の間は短いkeepaliveだけ送る)。
 
 
 import os
 import sys
 from google.cloud import speech
-import pyaudio
 import threading
-import queue
 import time
 import logging
-import numpy as np
+from collections import deque
+
+try:
+    from .vad import EnergyVAD
+    from .echo import EchoSuppressor
+    from .transcript_buffer import TranscriptBuffer, overlap_length
+    from .audio_gate import AudioGate
+    from .audio_frontend import AudioFrontEnd
+    from .microphone import MicrophoneStream, RATE, CHUNK
+except ImportError:
+    from vad import EnergyVAD
+    from echo import EchoSuppressor
+    from transcript_buffer import TranscriptBuffer, overlap_length
+    from audio_gate import AudioGate
+    from audio_frontend import AudioFrontEnd
+    from microphone import MicrophoneStream, RATE, CHUNK
 
 
 # Google Cloud Speech-to-Textの設定
 # os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = r"path to json"
 
-# オーディオ録音の設定
-RATE = 16000  # サンプルレートを16000Hzに設定
-CHUNK = int(RATE / 10)  # 100msごとにオーディオデータを処理するためのチャンクサイズ
-
-class MicrophoneStream:
-    """マイクロフォンからのストリーミング入力を処理するクラス"""
-    def __init__(self, rate, chunk,sensitivity=1.0):
-        self._rate = rate  # サンプルレート
-        self._chunk = chunk  # チャンクサイズ
-        self._buff = queue.Queue()  # オーディオデータを一時保存するキュー
-        self.closed = True  # ストリームの開閉状態
-        self.sensitivity = sensitivity
-
-    def __enter__(self):
-        self._audio_interface = pyaudio.PyAudio()  # PyAudioインスタンスを作成
-        self._audio_stream = self._audio_interface.open(
-            format=pyaudio.paInt16,  # 16ビットの整数型でオーディオデータを扱う
-            channels=1,  # モノラルで録音
-            rate=self._rate,  # サンプルレートを設定
-            input=True,  # 入力ストリームとして開く
-            frames_per_buffer=self._chunk,  # チャンクサイズごとにオーディオデータを読み込む
-            stream_callback=self._fill_buffer,  # コールバック関数を設定
-        )
-        self.closed = False  # ストリームを開く
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self._audio_stream.stop_stream()  # ストリームを停止
-        self._audio_stream.close()  # ストリームを閉じる
-        self.closed = True  # ストリームの状態を閉じた状態に更新
-        self._buff.put(None)  # キューにNoneを入れてジェネレータを終了させる
-        self._audio_interface.terminate()  # PyAudioインスタンスを終了
-
-    def _fill_buffer(self, in_data, frame_count, time_info, status_flags):
-        """バッファにオーディオデータを追加するコールバック関数"""
-        # オーディオデータの感度を調整
-        audio_data = np.frombuffer(in_data, dtype=np.int16)
-        audio_data = (audio_data * self.sensitivity).astype(np.int16)
-        self._buff.put(audio_data.tobytes())
-        return None, pyaudio.paContinue
-
-    def generator(self):
-        """オーディオデータのジェネレータ"""
-        while not self.closed:  # ストリームが開いている間は続ける
-            chunk = self._buff.get()  # キューからオーディオデータを取得
-            if chunk is None:  # Noneが来たら終了
-                return
-            data = [chunk]
-
-            # バッファに残っているデータをすべて取得する
-            while True:
-                try:
-                    chunk = self._buff.get(block=False)  # ノンブロッキングでキューからデータを取得
-                    if chunk is None:  # Noneが来たら終了
-                        return
-                    data.append(chunk)  # データをリストに追加
-                except queue.Empty:  # キューが空ならループを抜ける
-                    break
 
-            yield b''.join(data)  # データのリストをバイト列に結合してyield
+class _RecognitionSession:
+    """Google側のストリーミング認識のセッション1つ分"""
+    def __init__(self, number, audio):
+        self.number = number  # 何番目のセッションか(ログ用)
+        self.audio = audio  # MicrophoneStream.subscribe()のキュー
+        self.started_at = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.failed = False  # エラーで切れた(上限の時間を超えた・長い無音など)
+        self.last_text = None  # このセッションが最後に出した認識結果
+        self.last_final = False
+        self.carry = None  # 前のセッションの最後の認識結果(text, is_final)．流し直した音声で二重に認識された部分を取り除く用
+        self.pending = None  # 前のセッションが話し終わるのを待っている間に届いた認識結果
 
 
 class SpeechRecognizer:
-    def __init__(self, timeout=6,sensitivity=1.0):
+    def __init__(self, timeout=6,sensitivity=1.0,rotate_after=240,max_session_seconds=290,overlap_seconds=1.5,drain_timeout=3.0,source=None):
+        """
+        Args:
+            rotate_after (float): この秒数が経ったら、話していないときに次のセッションに切り替える
+            max_session_seconds (float): 話していてもこの秒数が経ったら切り替える(Googleの上限は約305秒)
+            overlap_seconds (float): 切り替えのときに新しいセッションに流し直す直前の音声の長さ
+            drain_timeout (float): 切り替えた後、古いセッションの発話の確定(is_final)を待つ最大時間
+            source (AudioSource): 音声の入力(audio_source.WavFileSourceなど)。省略時はマイク。
+                ストリーミング認識は実時間より速く送れないので、速く流すWavFileSource(realtime=False)も録音と同じ速さで流す
+        """
         # Google Speech-to-Textクライアントの初期化
         self.client = speech.SpeechClient()  # Speech-to-Text APIのクライアントを作成
         self.config = speech.RecognitionConfig(
@@ -110,77 +89,258 @@ class SpeechRecognizer:
             config=self.config,  # 設定を適用
             interim_results=True  # 中間結果も取得するように設定
         )
-        self.recognized_queue = queue.Queue()  # 認識結果を保存するキューを初期化
+        self.transcripts = TranscriptBuffer(capacity=64)  # 認識結果(最新の64個だけ残す。長時間動かしてもメモリは一定)
         
         self.last_recognized_time = None
         self.time_memory_lock = threading.Lock()
         self.sensitivity=sensitivity
+        self.listeners = []  # 認識結果が届くたびに呼ぶ関数(ポーリングせずに待つ用)
+        self.vad = EnergyVAD()  # マイクの発話区間(話し終わりの推定用)
+        self.echo = EchoSuppressor(rate=RATE)  # 自分のスピーカーの音を認識しないように(stats()で抑圧したフレーム数がわかる)
+        self.gate = AudioGate(rate=RATE)  # 話している間だけGoogleに送る(stats()で送った秒数がわかる)
+        self.frontend = AudioFrontEnd(RATE, CHUNK, sensitivity=sensitivity)  # マイクの前処理(stats()で処理時間がわかる)
+        self.rotate_after = rotate_after
+        self.max_session_seconds = max_session_seconds
+        self.overlap_seconds = overlap_seconds
+        self.drain_timeout = drain_timeout
+        if source is not None and not getattr(source, "realtime", True):
+            logging.warning("Googleのストリーミング認識には実時間より速く送れないので、録音と同じ速さで流します")
+            source.realtime = True
+        self.source = source
+        self.microphone = None  # 開きっぱなしにする唯一のマイクのストリーム
+        self._session = None  # 認識結果を出しているセッション
+        self._draining = None  # 切り替え中の古いセッション(発話が確定するまでこちらの結果を出す)
+        self._session_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._supervisor = None
+        self.sessions_started = 0
+        self.rotations = 0  # 時間切れ・エラーで切り替えた回数
+        self.deduplicated = 0  # 流し直した音声で二重に認識された部分を取り除いた回数
+        self.final_latencies = deque(maxlen=200)  # 話し終わり(VADの最後の声)から確定結果までの時間(秒)。ローカルの音声認識と比べる用
 
         # ここで開始してもいいけど、外部から開始してもいいよ
         self.start_recognition()  # 音声認識ループを開始
 
     def start_recognition(self):
-        """音声認識ループを実行するメソッド"""
-        self.stop_event = threading.Event()  # 終了イベントを初期化
-        self.recognition_thread = threading.Thread(target=SpeechRecognizer.recognition_loop,name="recognizer", args=(self.recognized_queue, self.client, self.streaming_config, self.stop_event, self,self.sensitivity))
-        self.recognition_thread.start()
-    
+        """マイクを開き(開いていなければ)、音声認識のセッションを開始するメソッド"""
+        if self.microphone is None:
+            self.microphone = MicrophoneStream(RATE, CHUNK, sensitivity=self.sensitivity, vad=self.vad, echo=self.echo,
+                                               overlap_chunks=int(self.overlap_seconds * RATE / CHUNK), gate=self.gate,
+                                               frontend=self.frontend, source=self.source).__enter__()
+            self._closed.clear()
+            self._supervisor = threading.Thread(target=self._supervise, name="recognizer_supervisor", daemon=True)
+            self._supervisor.start()
+        self._rotate(replay=False, drain=False)
+
     def stop_recognition(self):
-        """音声認識を停止するメソッド"""
-        if self.recognition_thread and self.recognition_thread.is_alive():
-            self.stop_event.set()  # タイムアウトイベントをセット
-            self.recognition_thread = None  # スレッドオブジェクトをクリアして次に進む。まだスレッドは動いてるけど、フラグ送ったしそのうち終了してくれるよ。
+        """音声認識を停止し、マイクを閉じるメソッド"""
+        self._closed.set()
+        with self._session_lock:
+            sessions = [session for session in (self._session, self._draining) if session is not None]
+            self._session = self._draining = None
+        for session in sessions:
+            self._retire(session)
+        if self.microphone is not None:
+            self.microphone.__exit__(None, None, None)
+            self.microphone = None
+        for session in sessions:
+            if session.thread is not None and session.thread is not threading.current_thread():
+                session.thread.join(timeout=2)
+
+    def _rotate(self, replay, drain):
+        """
+        次のセッションを開いてから今のセッションを閉じる
+
+        Args:
+            replay (bool): 直前の音声を新しいセッションに流し直すか
+            drain (bool): 今のセッションの発話が確定するまで、そちらの認識結果を使い続けるか
+        """
+        with self._session_lock:
+            self.sessions_started += 1
+            session = _RecognitionSession(self.sessions_started, self.microphone.subscribe(replay=replay))
+            old, self._session = self._session, session
+            if self._draining is not None:
+                self._retire(self._draining)  # 切り替え中にまた切り替えることになったら、古い方はもう待たない
+                self._draining = None
+            if old is not None:
+                if drain and not old.failed:
+                    self._draining = old
+                else:
+                    self._retire(old)
+        session.thread = threading.Thread(target=self._session_loop, args=(session,), name=f"recognizer{session.number}")
+        session.thread.start()
+
+    def _retire(self, session):
+        session.stop_event.set()
+        if self.microphone is not None:
+            self.microphone.unsubscribe(session.audio)  # リクエストのジェネレータが終わり、ストリームが閉じる
+
+    def _supervise(self):
+        """セッションの時間切れ・エラーを見張って切り替えるスレッド"""
+        while not self._closed.wait(0.5):
+            with self._session_lock:
+                session, draining = self._session, self._draining
+            if session is None:
+                continue
+            age = time.monotonic() - session.started_at
+            if draining is not None:
+                if age >= self.drain_timeout:
+                    self._finish_draining(draining)
+                continue
+            if session.failed:
+                logging.debug(f"音声認識のセッション{session.number}が切れたので開き直す")
+                self.rotations += 1
+                self._rotate(replay=True, drain=False)
+            elif age >= self.max_session_seconds or (age >= self.rotate_after and not self.vad.is_speech):
+                logging.debug(f"音声認識のセッション{session.number}を切り替える({age:.0f}秒)")
+                self.rotations += 1
+                self._rotate(replay=True, drain=True)
 
     # APIとのセッションは並列処理で実装
     # (APIの仕様上、「音声認識するたびに」実行される無限ループもどきを構築しないといけないので)
-    @staticmethod
-    def recognition_loop(queue, client, streaming_config, stop_event, recognizer,sensitivity):
+    def _session_loop(self, session):
         """
-        音声認識を開始するメソッド
-        認識結果は片っ端からqueueにぶち込む
+        1つのセッションで音声認識するメソッド
+        認識結果は片っ端から_on_resultに渡す
         """
-        with MicrophoneStream(RATE, CHUNK,sensitivity=sensitivity) as stream:  # マイクロフォンストリームを開始
-            audio_generator = stream.generator()  # オーディオデータのジェネレータを取得
-            requests = (speech.StreamingRecognizeRequest(audio_content=content)
-                        for content in audio_generator)  # オーディオデータをリクエストに変換
-            
+        requests = (speech.StreamingRecognizeRequest(audio_content=content)
+                    for content in self.microphone.generator(session.audio))  # オーディオデータをリクエストに変換
+        try:
             # ストリーミングの認識を開始。APIから何かが帰ってくるまで(たいてい、最初の音声認識があるまで)いったんここで待機するっぽい
             logging.debug("聞き取り開始")
-            responses = client.streaming_recognize(streaming_config, requests)  # ストリーミング認識を開始
+            responses = self.client.streaming_recognize(self.streaming_config, requests)  # ストリーミング認識を開始
 
             # レスポンスを処理する
             for response in responses:  # レスポンスをイテレート (ストリーミングレスポンスがAPIから断続的に送られてくるので、実質無限ループ)
                 
                 # 外部から終了指示が送られてきたら即終了
-                if stop_event.is_set():
+                if session.stop_event.is_set():
                     break
                 if not response.results:  # 結果がなければスキップ
                     continue
                 logging.debug("なんか聞こえた！")
 
-                # 最後に音声を認識した時刻を保存
-                current_time = time.time()
-                if recognizer.last_recognized_time is not None:
-                    time_diff = current_time - recognizer.last_recognized_time
-                    logging.debug(f"前回の認識時刻からの経過時間: {time_diff:.2f}秒")
-                recognizer.last_recognized_time = current_time
-
                 result = response.results[0]  # 最初の結果を取得
                 if not result.alternatives:  # 代替テキストがなければスキップ
                     continue
 
                 transcript = result.alternatives[0].transcript  # 代替テキストの最初のものを取得
+                self._on_result(session, transcript, result.is_final)
+        except Exception as e:
+            if not session.stop_event.is_set():
+                logging.debug(f"音声認識のセッション{session.number}でエラー: {e}")
+                session.failed = True  # _superviseが開き直す
+        logging.debug("音声認識スレッド終了")
+
+    def _on_result(self, session, transcript, is_final):
+        """セッションから認識結果が届いた"""
+        publish = []
+        with self._session_lock:
+            if session is self._draining:
+                session.last_text, session.last_final = transcript, is_final
+                publish.append((transcript, is_final, True))
+                if is_final:
+                    publish.extend(self._finish_draining_locked(session))
+            elif session is self._session:
+                if self._draining is not None:
+                    session.pending = (transcript, is_final)  # 古いセッションの発話が確定するまで出さない
+                else:
+                    seam = session.carry is not None  # 切り替えをまたいだ発話の途中
+                    publish.append((*self._deduplicate(session, transcript, is_final), seam))
+            # どちらでもなければ、閉じたセッションの遅れて届いた結果なので捨てる
+        for text, final, seam in publish:
+            if text is not None:
+                self._publish(text, final, seam)
+
+    def _finish_draining(self, draining):
+        with self._session_lock:
+            publish = self._finish_draining_locked(draining) if draining is self._draining else []
+        for text, final, seam in publish:
+            if text is not None:
+                self._publish(text, final, seam)
+
+    def _finish_draining_locked(self, draining):
+        """古いセッションを閉じ、待たせていた新しいセッションの結果を返す(_session_lockを取って呼ぶ)"""
+        self._draining = None
+        self._retire(draining)
+        session = self._session
+        if session is None:
+            return []
+        session.carry = (draining.last_text, draining.last_final) if draining.last_text else None
+        pending, session.pending = session.pending, None
+        return [(*self._deduplicate(session, *pending), True)] if pending is not None else []
+
+    def _deduplicate(self, session, transcript, is_final):
+        """
+        新しいセッションの最初の発話から、流し直した音声で前のセッションと二重に認識された部分を取り除く
 
-                # 結果を出力&保存
-                logging.debug(f"認識結果: {transcript}")
-                queue.put(transcript)
-            
-            logging.debug("音声認識スレッド終了")
+        Returns:
+            tuple: (出すテキスト(出さないならNone), is_final)
+        """
+        session.last_text, session.last_final = transcript, is_final
+        if session.carry is None:
+            return transcript, is_final
+        previous, previous_final = session.carry
+        if is_final:
+            session.carry = None  # 切り替えをまたいだ発話が終わった
+        overlap = overlap_length(previous, transcript)
+        if overlap:
+            self.deduplicated += 1
+        rest = transcript[overlap:]
+        if previous_final:
+            # 前の発話は確定済みなので、重なっていない部分だけが新しい発話
+            return (rest, is_final) if rest.strip() else (None, is_final)
+        return previous + rest, is_final  # 前のセッションの途中で切り替えたので、続きとしてつなげる
+
+    def _publish(self, transcript, is_final, seam=False):
+        """
+        認識結果を保存して通知する
+
+        Args:
+            seam (bool): セッションの切り替えをまたいだ結果か(同じ結果が両方のセッションから届くことがある)
+        """
+        latest = self.transcripts.latest()
+        if seam and latest is not None and latest.text == transcript and latest.is_final == is_final:
+            return  # 切り替えで同じ結果が二重に届いた(切り替えの外なら「はい」を2回言ったなどなので出す)
+
+        # 最後に音声を認識した時刻を保存
+        current_time = time.time()
+        if self.last_recognized_time is not None:
+            time_diff = current_time - self.last_recognized_time
+            logging.debug(f"前回の認識時刻からの経過時間: {time_diff:.2f}秒")
+        self.last_recognized_time = current_time
+
+        # 結果を出力&保存
+        logging.debug(f"認識結果: {transcript}")
+        if is_final and self.vad.last_voice_at is not None:
+            self.final_latencies.append(time.monotonic() - self.vad.last_voice_at)
+        self.transcripts.append(transcript, is_final=is_final)
+        self.notify_listeners(transcript)
+
+    def add_listener(self, callback):
+        """認識結果が届くたびにcallback(transcript)を呼ぶ(音声認識のスレッドから呼ばれるので、重い処理はしないこと)"""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify_listeners(self, transcript):
+        for callback in list(self.listeners):
+            try:
+                callback(transcript)
+            except Exception as e:
+                logging.debug("認識結果の通知に失敗しました: %s", e)
 
     def reset_recognition(self):
-        """音声認識をリセットするメソッド"""
-        self.stop_recognition()
-        self.start_recognition()
+        """
+        音声認識をリセットするメソッド
+        マイクは開いたまま新しいセッションに切り替えるので、リセットの直後に話し始めても聞き逃さない
+        """
+        if self.microphone is None:
+            self.start_recognition()
+        else:
+            self._rotate(replay=False, drain=False)
         self.clear_recognized_queue()
         self.last_recognized_time=None
 
@@ -190,25 +350,37 @@ class SpeechRecognizer:
             return None
         return time.time() - self.last_recognized_time
 
+    @property
+    def last_result_final(self):
+        """最新の認識結果がis_final(サーバーが文の区切りと判断した)か"""
+        latest = self.transcripts.latest()
+        return latest is not None and latest.is_final
+
     def get_latest_recognized(self):
-        """recognized_queueの最新の要素を参照するメソッド"""
-        if not self.recognized_queue.empty():
-            return self.recognized_queue.queue[-1]
-        return None
+        """最新の認識結果のテキストを参照するメソッド"""
+        latest = self.transcripts.latest()
+        return latest.text if latest is not None else None
+
+    def get_latest_transcript(self):
+        """最新の認識結果(通し番号・is_final・受け取った時刻つきのTranscript)を参照するメソッド"""
+        return self.transcripts.latest()
+
+    def wait_for_transcript(self, version, timeout=None):
+        """通し番号がversionより新しい認識結果が届くまで待つメソッド。タイムアウトしたらNone"""
+        return self.transcripts.wait_for_newer(version, timeout)
 
     def clear_recognized_queue(self):
-        """recognized_queueの内容をクリアするメソッド"""
-        self.recognized_queue.queue.clear()
+        """認識結果をクリアするメソッド"""
+        self.transcripts.clear()
 
     def pop_oldest_recognized(self):
-        """recognized_queueの最古の要素をpopするメソッド"""
-        if not self.recognized_queue.empty():
-            return self.recognized_queue.get()
-        return None
+        """保持している最古の認識結果をpopするメソッド"""
+        oldest = self.transcripts.pop_oldest()
+        return oldest.text if oldest is not None else None
 
     def get_all_recognized(self):
-        """recognized_queueの全ての要素をリストとして取得するメソッド"""
-        return list(self.recognized_queue.queue)
+        """保持している全ての認識結果のテキストをリストとして取得するメソッド"""
+        return [transcript.text for transcript in self.transcripts.snapshot()]
     
     def is_timed_out(self, timeout):
         """最後に音声が認識されてからの時間がタイムアウト時間を超えたかどうかを返すメソッド"""
@@ -217,6 +389,19 @@ class SpeechRecognizer:
             return False
         return time_since_last > timeout
 
+    def stats(self):
+        """確定結果までの待ち時間とセッションの切り替えの統計(local_stt.LocalSpeechRecognizer.stats()と比べられる)"""
+        finals = sorted(self.final_latencies)
+        return {
+            "backend": "google",
+            "finals": len(finals),
+            "p50_final_latency": finals[len(finals) // 2] if finals else None,
+            "p90_final_latency": finals[min(len(finals) - 1, int(len(finals) * 0.9))] if finals else None,
+            "sessions_started": self.sessions_started,
+            "rotations": self.rotations,
+            "deduplicated": self.deduplicated,
+        }
+
 # テストコード
 def console_input_handler(recognizer):
     while True:
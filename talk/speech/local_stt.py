@@ -0,0 +1,446 @@
+"""
+author Matsumoto
+ローカルのCPUで動く音声認識モデル(Vosk・faster-whisperなど)を，google_stt.SpeechRecognizerと同じ使い方で使うためのモジュール
+
+Google Cloudの音声認識は途中結果・確定結果のたびにネットワークの往復が入る．
+ここではマイクの音声をVAD(AudioGate)で発話ごとに区切り，別プロセスのモデルで認識する
+- 話している間はinterim_intervalごとにそこまでの音声を認識して途中結果にする(前の途中結果の処理中なら飛ばす)
+- ゲートが閉じたら(話し終わったら)発話全体を認識して確定結果(is_final)にする
+推論は別プロセスなので，重いモデルでもマイクのコールバックやChatBotのスレッドを止めない．
+
+モデルはbackendで選ぶ("vosk"，"faster_whisper"，または"モジュール名:クラス名"で自作のLocalSTTModel)．
+どれも使うときにだけimportするので，使わないライブラリは入れなくてよい．
+stats()でリアルタイム係数(推論時間/音声の長さ)と，話し終わりから確定結果までの時間がわかる(SpeechRecognizer.stats()と比べられる)．
+
+使い方
+    recognizer = LocalSpeechRecognizer(backend="vosk", model_options={"model_path": "vosk-model-ja-0.22"})
+    bot = ChatBot(recognizer=recognizer)
+    python -m talk.speech.local_stt --backend vosk --model-path vosk-model-ja-0.22 [--compare]
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+try:
+    from .microphone import MicrophoneStream, RATE, CHUNK, SEGMENT_END
+    from .vad import EnergyVAD
+    from .echo import EchoSuppressor
+    from .audio_gate import AudioGate
+    from .audio_frontend import AudioFrontEnd
+    from .transcript_buffer import TranscriptBuffer
+except ImportError:
+    from microphone import MicrophoneStream, RATE, CHUNK, SEGMENT_END
+    from vad import EnergyVAD
+    from echo import EchoSuppressor
+    from audio_gate import AudioGate
+    from audio_frontend import AudioFrontEnd
+    from transcript_buffer import TranscriptBuffer
+
+
+class LocalSTTModel:
+    """
+    ローカルの音声認識モデルの抽象クラスのつもり．ワーカープロセスの中で作られる
+    """
+    def transcribe(self, audio: np.ndarray, rate: int) -> str:
+        """
+        発話1つ分の音声を認識する
+
+        Args:
+            audio (np.ndarray): int16・モノラルの音声
+            rate (int): サンプルレート
+
+        Returns:
+            str: 認識結果
+        """
+        raise NotImplementedError
+
+
+class VoskModel(LocalSTTModel):
+    """Vosk(Kaldi)．日本語モデルは https://alphacephei.com/vosk/models"""
+    def __init__(self, model_path: str):
+        from vosk import KaldiRecognizer, Model, SetLogLevel
+        SetLogLevel(-1)
+        self.model = Model(model_path)
+        self._recognizer_class = KaldiRecognizer
+
+    def transcribe(self, audio: np.ndarray, rate: int) -> str:
+        recognizer = self._recognizer_class(self.model, rate)
+        recognizer.AcceptWaveform(audio.tobytes())
+        return json.loads(recognizer.FinalResult()).get("text", "").replace(" ", "")  # 日本語モデルは単語の間に空白が入る
+
+
+class FasterWhisperModel(LocalSTTModel):
+    """faster-whisper(CTranslate2のWhisper)．入力は16kHzであること"""
+    def __init__(self, model_size: str = "small", compute_type: str = "int8", language: str = "ja", cpu_threads: int = 4):
+        from faster_whisper import WhisperModel
+        self.model = WhisperModel(model_size, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+        self.language = language
+
+    def transcribe(self, audio: np.ndarray, rate: int) -> str:
+        samples = audio.astype(np.float32) / 32768.0
+        segments, _ = self.model.transcribe(samples, language=self.language, beam_size=1, condition_on_previous_text=False)
+        return "".join(segment.text for segment in segments).strip()
+
+
+MODEL_BACKENDS = {
+    "vosk": VoskModel,
+    "faster_whisper": FasterWhisperModel,
+}
+
+
+def load_model(backend: str, options: dict) -> LocalSTTModel:
+    """backendの名前("vosk"など)か"モジュール名:クラス名"からモデルを作る"""
+    if backend in MODEL_BACKENDS:
+        model_class = MODEL_BACKENDS[backend]
+    else:
+        module_name, _, class_name = backend.partition(":")
+        model_class = getattr(importlib.import_module(module_name), class_name)
+    return model_class(**options)
+
+
+def _worker_main(backend: str, options: dict, jobs, results) -> None:
+    """
+    ワーカープロセス: モデルを読み込み，(job_id, generation, segment, is_final, 音声, rate)を順に認識する
+    """
+    try:
+        model = load_model(backend, options)
+    except Exception as e:
+        results.put(("error", repr(e)))
+        return
+    results.put(("ready", None))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, generation, segment, is_final, audio_bytes, rate = job
+        audio = np.frombuffer(audio_bytes, dtype=np.int16)
+        start_time = time.perf_counter()
+        try:
+            text = model.transcribe(audio, rate)
+        except Exception as e:
+            logging.debug(f"ローカルの音声認識に失敗: {e}")
+            text = ""
+        results.put(("result", (job_id, generation, segment, is_final, text, audio.size / rate,
+                                time.perf_counter() - start_time)))
+
+
+def _percentile(values, ratio):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))] if ordered else None
+
+
+class LocalSpeechRecognizer:
+    """
+    ローカルのモデルで音声認識する．google_stt.SpeechRecognizerと同じメソッドを持つので，ChatBotのrecognizerにそのまま渡せる
+    """
+
+    def __init__(self, backend="vosk", model_options=None, sensitivity=1.0, microphone=None, interim_interval=0.5,
+                 max_segment_seconds=15.0, source=None, start=True):
+        """
+        Args:
+            backend (str): "vosk"・"faster_whisper"・"モジュール名:クラス名"
+            model_options (dict): モデルのコンストラクタの引数
+            sensitivity (float): マイクの感度(microphoneを渡したときは使わない)
+            microphone (MicrophoneStream): 開いているマイクを共有する(クラウドの音声認識と同じ音声で比べる用)．
+                vad・gateを持っていること．Noneなら自分で開く
+            interim_interval (float): 話している間に途中結果を出す間隔(秒)
+            max_segment_seconds (float): 発話がこれより長くなったら区切って確定させる(秒)
+            source (AudioSource): 音声の入力(audio_source.WavFileSourceなど)．省略時はマイク(microphoneを渡したときは使わない)
+            start (bool): すぐに開始するか
+        """
+        self.backend = backend
+        self.model_options = model_options or {}
+        self.sensitivity = sensitivity
+        self.interim_interval = interim_interval
+        self.max_segment_seconds = max_segment_seconds
+        self.transcripts = TranscriptBuffer(capacity=64)  # 認識結果(最新の64個だけ残す)
+        self.last_recognized_time = None
+        self.listeners = []  # 認識結果が届くたびに呼ぶ関数
+        self.microphone = microphone
+        self.source = source if microphone is None else microphone.source
+        self._owns_microphone = microphone is None
+        if microphone is None:
+            self.vad = EnergyVAD()
+            self.echo = EchoSuppressor(rate=RATE)
+            self.gate = AudioGate(rate=RATE)
+            self.frontend = AudioFrontEnd(RATE, CHUNK, sensitivity=sensitivity)
+        else:
+            self.vad, self.echo, self.gate, self.frontend = microphone.vad, microphone.echo, microphone.gate, microphone.frontend
+        self.ready = threading.Event()  # モデルの読み込みが終わった(または失敗した)
+        self.error = None
+        self._context = multiprocessing.get_context("spawn")  # 音声のスレッドがいるプロセスをforkしない
+        self._jobs = None
+        self._results = None
+        self._worker = None
+        self._audio = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._generation = 0  # reset_recognitionのたびに増やす．古い世代の結果は捨てる
+        self._discard_segment = False
+        self._job_id = 0
+        self._submitted = {}  # job_id -> (投入した時刻, 話し終わった時刻)
+        self._interim_pending = False
+        self._last_final_segment = 0
+        self.segments = 0
+        self.rtfs = deque(maxlen=200)  # 推論時間/音声の長さ
+        self.finals = 0  # 確定した認識結果の数
+        self.final_latencies = deque(maxlen=200)  # 話し終わり(VADの最後の声)から確定結果までの時間(秒)
+        self.interim_latencies = deque(maxlen=200)  # 途中結果を投入してから届くまでの時間(秒)
+        if start:
+            self.start_recognition()
+
+    # --- 開始・終了 ---
+
+    def start_recognition(self):
+        """ワーカープロセスとマイクを開始するメソッド"""
+        if self._worker is not None:
+            return
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        self._worker = self._context.Process(target=_worker_main, name="local_stt",
+                                             args=(self.backend, self.model_options, self._jobs, self._results), daemon=True)
+        self._worker.start()
+        if self.microphone is None:
+            self.microphone = MicrophoneStream(RATE, CHUNK, sensitivity=self.sensitivity, vad=self.vad, echo=self.echo,
+                                               gate=self.gate, frontend=self.frontend, source=self.source).__enter__()
+        self._audio = self.microphone.subscribe()
+        self._threads = [threading.Thread(target=self._segment_loop, name="local_stt_segmenter", daemon=True),
+                         threading.Thread(target=self._result_loop, name="local_stt_results", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop_recognition(self):
+        """音声認識を停止するメソッド(自分で開いたマイクは閉じる)"""
+        if self._worker is None:
+            return
+        if self.microphone is not None:
+            self.microphone.unsubscribe(self._audio)
+            if self._owns_microphone:
+                self.microphone.__exit__(None, None, None)
+                self.microphone = None
+        self._jobs.put(None)
+        self._results.put(("stop", None))
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._worker.join(timeout=5)
+        if self._worker.is_alive():
+            self._worker.terminate()
+        self._jobs.cancel_join_thread()  # 受け取られなかった推論は捨てる(読み込みに失敗したワーカーを待って終了できなくならないように)
+        self._worker = None
+
+    def reset_recognition(self):
+        """音声認識をリセットするメソッド(話している途中の発話と、処理中の結果は捨てる)"""
+        with self._lock:
+            self._generation += 1
+            self._discard_segment = True
+        self.clear_recognized_queue()
+        self.last_recognized_time = None
+
+    # --- 発話の区切りと推論 ---
+
+    def _submit(self, segment, is_final, audio, voice_end=None):
+        if self.error is not None:
+            return  # モデルを読み込めなかったので推論しない
+        with self._lock:
+            self._job_id += 1
+            job_id = self._job_id
+            self._submitted[job_id] = (time.monotonic(), voice_end)
+            if not is_final:
+                self._interim_pending = True
+            generation = self._generation
+        self._jobs.put((job_id, generation, segment, is_final, audio, RATE))
+
+    def _segment_loop(self):
+        """マイクのチャンクを発話ごとにまとめてワーカーに投げるスレッド"""
+        chunks = []
+        segment = 0
+        samples = 0
+        last_interim_at = 0.0
+        while True:
+            chunk = self._audio.get()
+            if chunk is None:
+                break
+            if chunk is self.gate.keepalive_chunk:
+                continue  # ゲートが閉じている間のkeepalive
+            with self._lock:
+                if self._discard_segment:
+                    self._discard_segment = False
+                    chunks, samples = [], 0
+            if chunk == SEGMENT_END or samples >= self.max_segment_seconds * RATE:
+                if chunks:
+                    self._submit(segment, True, b"".join(chunks), voice_end=self.vad.last_voice_at)
+                    chunks, samples = [], 0
+                if chunk == SEGMENT_END:
+                    continue
+            if not chunks:
+                self.segments += 1
+                segment = self.segments
+                last_interim_at = time.monotonic()
+            chunks.append(chunk)
+            samples += len(chunk) // 2
+            now = time.monotonic()
+            if now - last_interim_at >= self.interim_interval and not self._interim_pending:
+                last_interim_at = now
+                self._submit(segment, False, b"".join(chunks))
+
+    def _result_loop(self):
+        """ワーカーの結果を受け取って認識結果にするスレッド"""
+        while True:
+            kind, payload = self._results.get()
+            if kind == "stop":
+                break
+            if kind == "ready":
+                logging.debug(f"ローカルの音声認識({self.backend})の準備ができた")
+                self.ready.set()
+                continue
+            if kind == "error":
+                self.error = payload
+                logging.error(f"ローカルの音声認識({self.backend})を読み込めませんでした: {payload}")
+                self.ready.set()
+                continue
+            job_id, generation, segment, is_final, text, audio_seconds, inference_seconds = payload
+            now = time.monotonic()
+            with self._lock:
+                submitted_at, voice_end = self._submitted.pop(job_id, (now, None))
+                if not is_final:
+                    self._interim_pending = False
+                stale = generation != self._generation or segment <= self._last_final_segment
+                if is_final and not stale:
+                    self._last_final_segment = segment
+                    self.finals += 1
+            if audio_seconds > 0:
+                self.rtfs.append(inference_seconds / audio_seconds)
+            if stale:
+                continue  # リセット前の発話か，確定した後に届いた途中結果
+            if not is_final:
+                self.interim_latencies.append(now - submitted_at)
+            elif getattr(self.source, "realtime", True):  # 速く流したファイルでは話し終わりからの待ち時間は測れない
+                self.final_latencies.append(now - (voice_end if voice_end is not None else submitted_at))
+            if text.strip():
+                self._publish(text, is_final)
+
+    def _publish(self, transcript, is_final):
+        """認識結果を保存して通知する"""
+        self.last_recognized_time = time.time()
+        logging.debug(f"認識結果: {transcript}")
+        self.transcripts.append(transcript, is_final=is_final)
+        for callback in list(self.listeners):
+            try:
+                callback(transcript)
+            except Exception as e:
+                logging.debug("認識結果の通知に失敗しました: %s", e)
+
+    # --- SpeechRecognizerと同じメソッド ---
+
+    def add_listener(self, callback):
+        """認識結果が届くたびにcallback(transcript)を呼ぶ(重い処理はしないこと)"""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    @property
+    def pending(self):
+        """ワーカーに投げてまだ結果が届いていない推論の数(ワーカーが止まっていれば0)"""
+        if self._worker is None or not self._worker.is_alive():
+            return 0
+        with self._lock:
+            return len(self._submitted)
+
+    @property
+    def last_result_final(self):
+        latest = self.transcripts.latest()
+        return latest is not None and latest.is_final
+
+    def get_time_since_last_recognition(self):
+        if self.last_recognized_time is None:
+            return None
+        return time.time() - self.last_recognized_time
+
+    def get_latest_recognized(self):
+        latest = self.transcripts.latest()
+        return latest.text if latest is not None else None
+
+    def get_latest_transcript(self):
+        return self.transcripts.latest()
+
+    def wait_for_transcript(self, version, timeout=None):
+        return self.transcripts.wait_for_newer(version, timeout)
+
+    def clear_recognized_queue(self):
+        self.transcripts.clear()
+
+    def pop_oldest_recognized(self):
+        oldest = self.transcripts.pop_oldest()
+        return oldest.text if oldest is not None else None
+
+    def get_all_recognized(self):
+        return [transcript.text for transcript in self.transcripts.snapshot()]
+
+    def is_timed_out(self, timeout):
+        time_since_last = self.get_time_since_last_recognition()
+        if time_since_last is None:
+            return False
+        return time_since_last > timeout
+
+    def stats(self) -> dict:
+        rtfs = list(self.rtfs)
+        finals = list(self.final_latencies)
+        interims = list(self.interim_latencies)
+        return {
+            "backend": self.backend,
+            "segments": self.segments,
+            "finals": self.finals,
+            "mean_rtf": sum(rtfs) / len(rtfs) if rtfs else None,
+            "p50_final_latency": _percentile(finals, 0.5),
+            "p90_final_latency": _percentile(finals, 0.9),
+            "p50_interim_latency": _percentile(interims, 0.5),
+        }
+
+
+def main():
+    p = argparse.ArgumentParser(prog="python -m talk.speech.local_stt", description="ローカルの音声認識を試す(--compareでGoogleと比べる)")
+    p.add_argument("--backend", default="vosk", help='"vosk"，"faster_whisper"，"モジュール名:クラス名"')
+    p.add_argument("--model-path", help="Voskのモデルのディレクトリ")
+    p.add_argument("--model-size", default="small", help="faster-whisperのモデル")
+    p.add_argument("--compare", action="store_true", help="同じマイクの音声をGoogle Cloudでも認識して待ち時間を比べる")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    options = {"model_path": args.model_path} if args.backend == "vosk" else (
+        {"model_size": args.model_size} if args.backend == "faster_whisper" else {})
+
+    cloud = None
+    if args.compare:
+        try:
+            from .google_stt import SpeechRecognizer
+        except ImportError:
+            from google_stt import SpeechRecognizer
+        cloud = SpeechRecognizer()
+        cloud.add_listener(lambda text: print(f"[cloud] {text}"))
+    local = LocalSpeechRecognizer(args.backend, options, microphone=cloud.microphone if cloud else None)
+    local.add_listener(lambda text: print(f"[local] {text}"))
+    local.ready.wait()
+    print("話しかけてください(Ctrl+Cで終了)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    local.stop_recognition()
+    print("local:", local.stats())
+    if cloud is not None:
+        cloud.stop_recognition()
+        print("cloud:", cloud.stats())
+
+
+if __name__ == "__main__":
+    main()
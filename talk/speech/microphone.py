@@ -0,0 +1,142 @@
+"""
+author Matsumoto
+マイクの入力ストリーム(google_stt.pyから分離．クラウド・ローカルどちらの音声認識からも使う)
+
+オーディオソース(マイクやWAVファイル．audio_source.py)のチャンクを 前処理(AudioFrontEnd) → エコー抑圧 → VAD → ゲート の順に通し，
+subscribe()したキューのそれぞれに同じチャンクを配る．
+ゲートが閉じたら(発話が終わったら)区切りとしてSEGMENT_END(空のbytes)も配る．
+"""
+
+import queue
+import threading
+from collections import deque
+
+try:
+    from .audio_frontend import AudioFrontEnd
+    from .audio_source import PyAudioSource
+except ImportError:
+    from audio_frontend import AudioFrontEnd
+    from audio_source import PyAudioSource
+
+
+SEGMENT_END = b""  # ゲートが閉じた(発話が終わった)ことを表す区切り．音声としては長さ0なので，そのまま連結してもよい
+
+# オーディオ録音の設定
+RATE = 16000  # サンプルレートを16000Hzに設定
+CHUNK = int(RATE / 10)  # 100msごとにオーディオデータを処理するためのチャンクサイズ
+
+class MicrophoneStream:
+    """
+    マイクロフォンからのストリーミング入力を処理するクラス
+    subscribe()したキューのそれぞれに同じオーディオデータを配る(音声認識のセッションを切り替える間は2つに配る)
+    """
+    def __init__(self, rate, chunk,sensitivity=1.0,vad=None,echo=None,overlap_chunks=15,gate=None,frontend=None,source=None):
+        self._rate = rate  # サンプルレート
+        self._chunk = chunk  # チャンクサイズ
+        self._subscribers = []  # オーディオデータを配るキュー
+        self._recent = deque(maxlen=overlap_chunks)  # 直前のオーディオデータ(新しいセッションに流し直す用)
+        self._lock = threading.Lock()
+        self.closed = True  # ストリームの開閉状態
+        self.sensitivity = sensitivity
+        # 前処理(ゲイン・AGC・ハイパス・ノイズ抑圧)。バッファを確保済みなのでコールバックの中で配列を作らない
+        self.frontend = frontend or AudioFrontEnd(rate, chunk, sensitivity=sensitivity)
+        self.source = source or PyAudioSource(rate, chunk)  # 音声の入力(省略時はマイク)
+        self._source_started = False  # 最初のsubscribe()で開始する(それより前のチャンクは誰にも配られずに消えるので)
+        self.vad = vad  # 指定するとフレームごとに発話区間を判定する(話し終わりの推定用)
+        self.echo = echo  # 指定すると自分のスピーカーの音(エコー)だけのフレームを無音にしてから送る
+        self.gate = gate  # 指定するとvadの判定で話している間だけ送る(vadが必要)
+
+    @property
+    def input_overflows(self):
+        """PortAudioの入力のオーバーフロー(コールバックが間に合わなかった)回数"""
+        return getattr(self.source, "input_overflows", 0)
+
+    def __enter__(self):
+        self.closed = False  # ストリームを開く(オーディオソースは最初のsubscribe()で開始する)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._source_started:
+            self.source.stop()
+        self.closed = True  # ストリームの状態を閉じた状態に更新
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for buff in subscribers:
+            buff.put(None)  # キューにNoneを入れてジェネレータを終了させる
+
+    def subscribe(self, replay=False):
+        """
+        オーディオデータを受け取るキューを追加する
+
+        Args:
+            replay (bool): Trueなら直前のオーディオデータ(overlap_chunks個)を先に入れておく
+        """
+        buff = queue.Queue()
+        with self._lock:
+            if replay and (self.gate is None or self.gate.is_open):  # 話していなければ流し直すものは無い(出だしはgateのprerollが補う)
+                for chunk in self._recent:
+                    buff.put(chunk)
+            self._subscribers.append(buff)
+            start = not self._source_started and not self.closed
+            self._source_started = self._source_started or start
+        if start:
+            # コールバックは_lockを取るので，lockの外で開始する(ファイルの先頭の発話の出だしも落とさない)
+            self.source.start(self._fill_buffer)
+        return buff
+
+    def unsubscribe(self, buff):
+        """キューへの配信をやめ、そのキューのジェネレータを終了させる"""
+        with self._lock:
+            if buff in self._subscribers:
+                self._subscribers.remove(buff)
+        buff.put(None)
+
+    def _fill_buffer(self, in_data, now=None):
+        """バッファにオーディオデータを追加するコールバック関数(nowはオーディオソースの時刻．Noneなら今)"""
+        # オーディオデータの感度の調整などの前処理(int16で折り返さずに飽和させる)
+        audio_data = self.frontend.process(in_data)
+        if self.echo is not None:
+            audio_data = self.echo.process(audio_data, now)  # VADにも自分の声で割り込ませないように先に通す
+        is_speech = True
+        if self.vad is not None:
+            is_speech = self.vad.process(audio_data, now)
+        chunk = audio_data.tobytes()
+        if self.gate is None or self.vad is None:
+            chunks = [chunk]
+        else:
+            was_open = self.gate.is_open
+            chunks = self.gate.process(chunk, is_speech, now)
+            if was_open and not self.gate.is_open:
+                chunks.append(SEGMENT_END)
+        with self._lock:
+            self._recent.append(chunk)
+            for buff in self._subscribers:
+                for data in chunks:
+                    buff.put(data)
+
+    def generator(self, buff=None, max_bytes=25600):
+        """
+        オーディオデータのジェネレータ(buffを省略すると新しくsubscribeする)
+        溜まっていた分はまとめて返すが，ファイルを速く流したときでもmax_bytes(Googleの1リクエストの上限)ずつに分ける
+        """
+        if buff is None:
+            buff = self.subscribe()
+        while not self.closed:  # ストリームが開いている間は続ける
+            chunk = buff.get()  # キューからオーディオデータを取得
+            if chunk is None:  # Noneが来たら終了
+                return
+            data = [chunk]
+
+            # バッファに残っているデータをすべて取得する
+            while True:
+                try:
+                    chunk = buff.get(block=False)  # ノンブロッキングでキューからデータを取得
+                    if chunk is None:  # Noneが来たら終了
+                        return
+                    data.append(chunk)  # データをリストに追加
+                except queue.Empty:  # キューが空ならループを抜ける
+                    break
+
+            joined = b''.join(data)  # データのリストをバイト列に結合してyield
+            for start in range(0, len(joined), max_bytes):  # 区切り(SEGMENT_END)だけなら送らない
+                yield joined[start:start + max_bytes]
@@ -0,0 +1,233 @@
+"""
+author Matsumoto
+音声合成と再生をパイプライン化するためのモジュール
+
+以前はGPTの応答を1セリフ受け取るたびにspeak(blocking=True)で「合成→再生」を終えるまで次のセリフを読まなかったので，
+ずんだもんが話し終わってからめたんのセリフの合成が始まり，話者の切り替わりのたびに合成時間分の無音が入っていた．
+ここでは受け取ったセリフはすぐに合成スレッドに投げ(先読み)，再生は専用スレッドで受け取った順に1つずつ行う．
+話者間の無音(gap)はターンごとに計測する．
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class TurnSpeechMetrics:
+    """1ターン分の再生の計測値"""
+
+    started_at: float = field(default_factory=time.perf_counter)
+    first_audio_latency: Optional[float] = None  # ターン開始から最初の再生開始まで(秒)．相槌も含む(userが感じる待ち時間)
+    first_response_latency: Optional[float] = None  # ターン開始から最初の(相槌ではない)応答の再生開始まで(秒)
+    gaps: List[float] = field(default_factory=list)  # 前のセリフの再生終了から次のセリフの再生開始まで(秒)
+    synthesis_times: List[float] = field(default_factory=list)  # 各セリフの合成時間(秒)
+    utterances: int = 0  # 再生したセリフ数
+
+    def summary(self) -> dict:
+        return {
+            "utterances": self.utterances,
+            "first_audio_latency": self.first_audio_latency,
+            "first_response_latency": self.first_response_latency,
+            "mean_gap": sum(self.gaps) / len(self.gaps) if self.gaps else None,
+            "max_gap": max(self.gaps) if self.gaps else None,
+            "mean_synthesis": sum(self.synthesis_times) / len(self.synthesis_times) if self.synthesis_times else None,
+        }
+
+
+@dataclass
+class _Utterance:
+    speaker: object
+    text: str
+    future: Future
+    generation: int
+    is_filler: bool = False
+
+
+class SpeechPipeline:
+    """
+    セリフの合成は並列に先読みし，再生は投入順に1つずつ行う
+    Speakerはsynthesize(text)とplay(data)を持っていればよい(speech_wrapper.Speaker参照)
+    """
+
+    def __init__(self, synthesis_workers: int = 2, executor: Optional[Executor] = None):
+        """
+        Args:
+            synthesis_workers (int): 同時に合成するセリフの数
+            executor (Executor): 合成に使うスレッドプール．複数のパイプラインで共有する場合に指定する(synthesis_workersは無視)
+        """
+        self._owns_executor = executor is None  # 自分で作ったスレッドプールだけclose()で止める
+        self._executor = executor or ThreadPoolExecutor(max_workers=synthesis_workers, thread_name_prefix="synthesizer")
+        self._play_queue = queue.Queue()
+        self._generation = 0  # cancel()のたびに増やす．古い世代のセリフは再生しない
+        self._lock = threading.Lock()
+        self._pending = 0  # 投入されてまだ再生(または破棄)されていないセリフ数
+        self._idle = threading.Condition(self._lock)
+        self._playing_speaker = None
+        self._playing_cancel = None  # 再生中のセリフの中断用のイベント(play()の開始とcancel()が競合しても再生させない)
+        self._last_play_end = None
+        self.metrics = TurnSpeechMetrics()
+        self.last_metrics: Optional[TurnSpeechMetrics] = None  # 直前に終わったターンの計測値
+        self._player_thread = threading.Thread(target=self._player_loop, name="speech_player", daemon=True)
+        self._player_thread.start()
+
+    def start_turn(self) -> None:
+        """ターンの計測を始める"""
+        with self._lock:
+            self.metrics = TurnSpeechMetrics()
+            self._last_play_end = None
+
+    def submit(self, speaker, text: str) -> None:
+        """
+        セリフを投入する．合成はすぐに始まり，再生は前のセリフが終わり次第行われる
+
+        Args:
+            speaker (Speaker): 話者
+            text (str): セリフ
+        """
+        if not text:
+            return
+        with self._lock:
+            generation = self._generation
+            self._pending += 1
+        future = self._executor.submit(self._synthesize, speaker, text)
+        self._play_queue.put(_Utterance(speaker, text, future, generation))
+
+    def submit_synthesized(self, speaker, text: str, data, is_filler: bool = True) -> None:
+        """
+        合成済みの音声を投入する(相槌のキャッシュなど)．合成待ちが無いので，前のセリフが無ければすぐに再生される
+
+        Args:
+            speaker (Speaker): 話者
+            text (str): セリフ(ログ用)
+            data: speaker.synthesize()の結果
+            is_filler (bool): 相槌かどうか(first_response_latencyの計測から除く)
+        """
+        with self._lock:
+            generation = self._generation
+            self._pending += 1
+        future = Future()
+        future.set_result(data)
+        self._play_queue.put(_Utterance(speaker, text, future, generation, is_filler))
+
+    def _synthesize(self, speaker, text: str):
+        start_time = time.perf_counter()
+        data = speaker.synthesize(text)
+        elapsed = time.perf_counter() - start_time
+        with self._lock:
+            self.metrics.synthesis_times.append(elapsed)
+        return data
+
+    def cancel(self) -> None:
+        """
+        未再生のセリフを全て破棄し，再生中のものを止める
+        """
+        with self._lock:
+            self._generation += 1
+            playing = self._playing_speaker
+            if self._playing_cancel is not None:
+                self._playing_cancel.set()  # interrupt()より先にセットするので，play()がフラグを戻した後でも気づける
+        while True:
+            try:
+                utterance = self._play_queue.get_nowait()
+            except queue.Empty:
+                break
+            utterance.future.cancel()
+            self._done()
+        if playing is not None:
+            playing.interrupt()
+
+    def close(self) -> None:
+        """
+        未再生のセリフを破棄し，再生スレッドを止める(自分で作ったスレッドプールも止める)
+        """
+        self.cancel()
+        self._play_queue.put(None)  # 再生スレッドへの終了の合図
+        if self._player_thread is not threading.current_thread():
+            self._player_thread.join(timeout=5.0)
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def wait_idle(self, cancel_event=None, timeout: Optional[float] = None) -> bool:
+        """
+        投入したセリフを全て再生し終わるまで待つ
+
+        Args:
+            cancel_event (threading.Event or CancelToken): これがセットされたら待つのをやめる
+            timeout (float): 最大待ち時間
+
+        Returns:
+            bool: 全て再生し終わったかどうか
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._pending > 0:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                # cancel_eventはこのConditionを起こさないので，短い間隔で確認する
+                self._idle.wait(0.05 if remaining is None else min(0.05, remaining))
+            return True
+
+    def finish_turn(self, cancel_event=None) -> TurnSpeechMetrics:
+        """
+        全て再生し終わるのを待ってターンの計測を締める
+
+        Returns:
+            TurnSpeechMetrics: このターンの計測値
+        """
+        self.wait_idle(cancel_event)
+        with self._lock:
+            metrics = self.metrics
+            self.last_metrics = metrics
+        logging.debug(f"speech metrics: {metrics.summary()}")
+        return metrics
+
+    def _done(self) -> None:
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
+
+    def _player_loop(self) -> None:
+        """再生スレッド: 投入順に，合成が終わるのを待って再生する"""
+        while True:
+            utterance = self._play_queue.get()
+            if utterance is None:
+                break
+            try:
+                if utterance.generation != self._generation:
+                    continue
+                try:
+                    data = utterance.future.result()
+                except Exception as e:
+                    logging.debug("Failed to synthesize speech: %s", e)
+                    continue
+                with self._lock:
+                    if utterance.generation != self._generation:
+                        continue
+                    self._playing_speaker = utterance.speaker
+                    self._playing_cancel = cancel_event = threading.Event()
+                    now = time.perf_counter()
+                    metrics = self.metrics
+                    if metrics.first_audio_latency is None:
+                        metrics.first_audio_latency = now - metrics.started_at
+                    if metrics.first_response_latency is None and not utterance.is_filler:
+                        metrics.first_response_latency = now - metrics.started_at
+                    if self._last_play_end is not None:
+                        metrics.gaps.append(now - self._last_play_end)
+                    metrics.utterances += 1
+                try:
+                    utterance.speaker.play(data, cancel_event=cancel_event)
+                except Exception as e:
+                    logging.debug("Failed to play speech: %s", e)
+                with self._lock:
+                    self._playing_speaker = self._playing_cancel = None
+                    self._last_play_end = time.perf_counter()
+            finally:
+                self._done()
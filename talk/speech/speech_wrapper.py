@@ -33,6 +33,43 @@ class Speaker:
         """
         pass
 
+    def pause(self):
+        """
+        音声再生を一時停止する(割り込みかどうか確かめている間)。resume()で続きから再生する
+        """
+        pass
+
+    def resume(self):
+        """
+        pause()で止めた音声再生を再開する。
+        """
+        pass
+
+    def synthesize(self, text: str):
+        """
+        テキストを音声合成する(再生はしない)。SpeechPipelineで先読みするために使う。
+        ダミーではテキストをそのまま返す
+
+        Args:
+            text (str): 音声合成対象のテキスト。
+
+        Returns:
+            play()に渡すデータ。
+        """
+        return text
+
+    def play(self, data, cancel_event=None) -> None:
+        """
+        synthesize()の結果を再生する(再生し終わるまでブロック)。
+        ダミーではspeak()するだけ
+
+        Args:
+            data: synthesize()の結果
+            cancel_event (threading.Event): セットされていたら再生しない(interrupt()が再生の開始と競合したとき用)
+        """
+        if cancel_event is None or not cancel_event.is_set():
+            self.speak(data)
+
 
 # ローカルで処理
 class VoiceVoxSpeaker(Speaker):
@@ -139,6 +176,30 @@ class VoiceVoxSpeaker(Speaker):
         """
         self.__class__.tts.stop_and_clear()  # 再生をやめて、キューをクリアする
 
+    def pause(self):
+        """
+        音声再生を一時停止する。キューはクリアしない
+        """
+        self.__class__.tts.pause()
+
+    def resume(self):
+        """
+        一時停止した音声再生を再開する。
+        """
+        self.__class__.tts.resume()
+
+    def synthesize(self, text: str) -> list:
+        """
+        テキストを音声合成する(再生はしない)。話者IDを直接渡すので、他の話者の合成と並列に呼んでもよい
+        """
+        return self.__class__.tts.synthesize(text, speaker_id=self.speaker_id)
+
+    def play(self, data: list, cancel_event=None) -> None:
+        """
+        synthesize()で合成した音声を再生する(再生し終わるまでブロック)
+        """
+        self.__class__.tts.play(data, cancel_event=cancel_event)
+
 # webで処理
 class VoiceVoxWebSpeaker(VoiceVoxSpeaker):
     tts = None  # 音声合成用のインスタンスをクラス変数として定義(じゃないとthreadが乱立する)
@@ -0,0 +1,90 @@
+"""
+author Matsumoto
+音声合成結果のLRUキャッシュ(複数セッションで共有する用)
+
+相槌や「こんにちは」のような定番のセリフは何度も同じものを合成することになるので，(話者, テキスト)ごとに結果を持っておく．
+同じセリフの合成が同時に頼まれた場合は1回だけ合成して，残りはその結果を待つ．
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Hashable
+
+
+class SynthesisCache:
+    """
+    (話者のキー, テキスト) -> 合成済みデータ のLRUキャッシュ．スレッドセーフ
+    """
+
+    def __init__(self, max_items: int = 512):
+        """
+        Args:
+            max_items (int): 保持する最大件数．超えたら最近使っていないものから捨てる
+        """
+        self.max_items = max_items
+        self._items: "OrderedDict[tuple, object]" = OrderedDict()
+        self._in_flight = {}  # 合成中のキー -> Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_synthesize(self, speaker_key: Hashable, text: str, synthesize: Callable[[str], object]):
+        """
+        キャッシュにあればそれを返し，無ければsynthesize(text)で合成してキャッシュする
+
+        Args:
+            speaker_key (Hashable): 話者を区別するキー(話者IDなど)
+            text (str): セリフ
+            synthesize (Callable[[str], object]): 合成する関数
+
+        Returns:
+            合成済みデータ
+        """
+        key = (speaker_key, text)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not owner:
+            # 他のスレッドが同じセリフを合成中なので，その結果を待つ
+            return future.result()
+        try:
+            data = synthesize(text)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            self._items[key] = data
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        future.set_result(data)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "items": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else None,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+        logging.debug("合成キャッシュをクリアしました")
@@ -0,0 +1,123 @@
+"""
+author Matsumoto
+音声認識の結果を溜めておく容量固定のリングバッファ
+
+以前は途中結果を全部queue.Queueに積んでいて，ChatBotの240秒ごとのリセットまで増え続けていた．
+しかも最新の結果はロックを取らずにqueue.queue[-1]で覗いていたので，クリアと同時に読むと壊れることがあった．
+ここでは最新のcapacity個だけを残し，結果ごとに単調に増える通し番号(seq)をつける．
+読む側は「このseqより新しい結果」を待てるので，ポーリングも，リセット前の古い結果との取り違えもしなくてよい．
+"""
+
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass(frozen=True)
+class Transcript:
+    """音声認識の結果1つ"""
+
+    seq: int  # 通し番号(1から．clearしても戻らない)
+    text: str
+    is_final: bool = False  # サーバーが文の区切りと判断した結果か(Falseなら途中結果)
+    received_at: float = 0.0  # 受け取った時刻(monotonic)
+
+
+class TranscriptBuffer:
+    """
+    最新のcapacity個の認識結果を保持する．どのスレッドから読み書きしてもよい
+    """
+
+    def __init__(self, capacity: int = 64):
+        """
+        Args:
+            capacity (int): 保持する結果の数．溢れたら古いものから捨てる
+        """
+        self.capacity = capacity
+        self._items = deque(maxlen=capacity)
+        self._seq = 0
+        self._latest: Optional[Transcript] = None
+        self._changed = threading.Condition()
+
+    @property
+    def version(self) -> int:
+        """最後に追加した結果のseq(まだ無ければ0)．wait_for_newerに渡す"""
+        with self._changed:
+            return self._seq
+
+    def append(self, text: str, is_final: bool = False, at: Optional[float] = None) -> Transcript:
+        """結果を追加して，待っているスレッドを起こす"""
+        with self._changed:
+            self._seq += 1
+            transcript = Transcript(self._seq, text, is_final, time.monotonic() if at is None else at)
+            self._items.append(transcript)
+            self._latest = transcript
+            self._changed.notify_all()
+        return transcript
+
+    def latest(self) -> Optional[Transcript]:
+        """最新の結果(clear後はNone)"""
+        with self._changed:
+            return self._latest
+
+    def wait_for_newer(self, version: int, timeout: Optional[float] = None) -> Optional[Transcript]:
+        """
+        seqがversionより新しい結果が届くまで待つ
+
+        Args:
+            version (int): 読んだことのある最後のseq
+            timeout (float): 最大待ち時間(秒)．Noneなら届くまで待つ
+
+        Returns:
+            Transcript: 最新の結果．タイムアウトしたらNone
+        """
+        with self._changed:
+            if not self._changed.wait_for(lambda: self._latest is not None and self._latest.seq > version, timeout):
+                return None
+            return self._latest
+
+    def since(self, version: int) -> List[Transcript]:
+        """seqがversionより新しい結果のうち，まだ保持しているもの(古い順)"""
+        with self._changed:
+            return [transcript for transcript in self._items if transcript.seq > version]
+
+    def pop_oldest(self) -> Optional[Transcript]:
+        with self._changed:
+            if not self._items:
+                return None
+            transcript = self._items.popleft()
+            if not self._items:
+                self._latest = None
+            return transcript
+
+    def snapshot(self) -> List[Transcript]:
+        """保持している全ての結果(古い順)"""
+        with self._changed:
+            return list(self._items)
+
+    def clear(self) -> None:
+        """結果を全て捨てる．seqは戻さないので，clear前のversionで待っていても古い結果は返らない"""
+        with self._changed:
+            self._items.clear()
+            self._latest = None
+
+    def __len__(self) -> int:
+        with self._changed:
+            return len(self._items)
+
+
+def overlap_length(previous: str, current: str, min_overlap: int = 2) -> int:
+    """
+    previousの末尾とcurrentの先頭が重なっている長さ
+    音声認識のセッションを切り替えるとき，新しいセッションには直前の音声を流し直すので，同じ言葉が二重に認識される．
+    その重なりを取り除くのに使う(1文字だけの一致は偶然のことが多いので数えない)
+
+    Returns:
+        int: 重なっている文字数(min_overlap未満なら0)
+    """
+    for length in range(min(len(previous), len(current)), min_overlap - 1, -1):
+        if previous.endswith(current[:length]):
+            return length
+    return 0
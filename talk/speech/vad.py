@@ -0,0 +1,130 @@
+"""
+author Matsumoto
+マイクのフレームのエネルギーで発話区間を判定する簡単なVAD(Voice Activity Detection)
+
+音声認識の結果はサーバーから数百ms遅れて届くので，「最後の認識結果からの時間」ではuserが本当に黙った時刻がわからない．
+ここではマイクのフレーム(int16のPCM)ごとにRMSを計算し，ノイズフロアより十分大きければ発話中とみなす．
+ノイズフロアは無音のフレームで少しずつ追従させるので，部屋の騒音レベルが変わってもしきい値を調整しなくてよい．
+発話の開始・終了はadd_listenerで登録したコールバックにも通知する(応答中の割り込みの検出用)．
+"""
+
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+
+class EnergyVAD:
+    """
+    フレームごとのRMSとノイズフロアの比で発話中かどうかを判定する．process()は音声のスレッドから呼ばれる想定
+    """
+
+    def __init__(self, ratio: float = 3.0, min_rms: float = 200.0, noise_adapt: float = 0.05,
+                 hangover_frames: int = 2, max_pauses: int = 200):
+        """
+        Args:
+            ratio (float): ノイズフロアの何倍のRMSで発話とみなすか
+            min_rms (float): これより小さいRMSは常に無音とみなす(int16のスケール)
+            noise_adapt (float): 無音フレームでノイズフロアを追従させる速さ(0-1)
+            hangover_frames (int): 発話の後，何フレーム無音が続いたら発話終了とみなすか(語尾の子音などで途切れないように)
+            max_pauses (int): 保持する無音区間の数
+        """
+        self.ratio = ratio
+        self.min_rms = min_rms
+        self.noise_adapt = noise_adapt
+        self.hangover_frames = hangover_frames
+        self.max_pauses = max_pauses
+        self.noise_rms = min_rms / ratio
+        self.last_rms = 0.0
+        self.is_speech = False
+        self.speech_started_at: Optional[float] = None  # 今の発話区間の開始時刻(monotonic)
+        self.last_voice_at: Optional[float] = None  # 最後に発話と判定したフレームの時刻(monotonic)
+        self.pauses: List[tuple] = []  # (発話が再開した時刻, 直前の無音の長さ)
+        self._silent_frames = 0
+        self._lock = threading.Lock()
+        self.listeners: List[Callable[[bool, float], None]] = []  # 発話の開始・終了で呼ばれる(is_speech, 時刻)
+
+    @staticmethod
+    def rms(frame) -> float:
+        """int16のPCM(bytesまたはndarray)のRMS"""
+        samples = np.frombuffer(frame, dtype=np.int16) if isinstance(frame, (bytes, bytearray)) else frame
+        if samples.size == 0:
+            return 0.0
+        samples = samples.astype(np.float32)
+        return float(np.sqrt(np.dot(samples, samples) / samples.size))
+
+    def process(self, frame, now: Optional[float] = None) -> bool:
+        """
+        フレームを1つ判定する
+
+        Args:
+            frame: int16のPCM
+            now (float): フレームの時刻(monotonic)．省略時は今
+
+        Returns:
+            bool: 発話中かどうか(hangover込み)
+        """
+        now = time.monotonic() if now is None else now
+        level = self.rms(frame)
+        voiced = level >= max(self.min_rms, self.noise_rms * self.ratio)
+        with self._lock:
+            was_speech = self.is_speech
+            self.last_rms = level
+            if voiced:
+                if not self.is_speech:
+                    if self.last_voice_at is not None:
+                        self.pauses.append((now, now - self.last_voice_at))
+                        del self.pauses[:-self.max_pauses]
+                    self.speech_started_at = now
+                self.is_speech = True
+                self.last_voice_at = now
+                self._silent_frames = 0
+            else:
+                # 無音のフレームだけでノイズフロアを追従させる(発話でしきい値が上がらないように)
+                self.noise_rms += (level - self.noise_rms) * self.noise_adapt
+                self._silent_frames += 1
+                if self.is_speech and self._silent_frames > self.hangover_frames:
+                    self.is_speech = False
+            is_speech = self.is_speech
+        if is_speech != was_speech:
+            # ロックの外で通知する(コールバックからsilence_durationなどを呼べるように)
+            for listener in list(self.listeners):
+                listener(is_speech, now)
+        return is_speech
+
+    def add_listener(self, callback: Callable[[bool, float], None]) -> None:
+        """
+        発話の開始・終了を通知するコールバックを登録する．音声のスレッドから呼ばれるので，すぐに返すこと
+
+        Args:
+            callback: callback(is_speech, 時刻(monotonic))
+        """
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[bool, float], None]) -> None:
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def pauses_since(self, since: float) -> List[float]:
+        """sinceより後に発話が再開した無音区間の長さのリスト(発話の途中の息継ぎなど)"""
+        with self._lock:
+            return [pause for resumed_at, pause in self.pauses if resumed_at >= since]
+
+    def silence_duration(self, now: Optional[float] = None) -> Optional[float]:
+        """最後の発話からの経過時間．発話中なら0，まだ一度も発話が無ければNone"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.is_speech:
+                return 0.0
+            if self.last_voice_at is None:
+                return None
+            return now - self.last_voice_at
+
+    def reset(self) -> None:
+        with self._lock:
+            self.is_speech = False
+            self.speech_started_at = None
+            self.last_voice_at = None
+            self.pauses.clear()
+            self._silent_frames = 0
@@ -4,7 +4,7 @@ import json
 import time
 import wave
 from queue import Queue
-from threading import Thread
+from threading import Event, Lock, Thread
 from typing import Any
 
 import pyaudio
@@ -15,13 +15,16 @@ import re
 
 try:
     from .err_handler import ignoreStderr
+    from .echo import DEFAULT_ECHO_REFERENCE
 except:
     from err_handler import ignoreStderr
+    from echo import DEFAULT_ECHO_REFERENCE
 
 class TextToVoiceVox(object):
     """
     VoiceVoxを使用してテキストから音声を生成するクラス。
     """
+    echo_reference = DEFAULT_ECHO_REFERENCE  # 再生した音を書き込む(マイク側のエコー抑圧の参照信号)
 
     def __init__(self, host: str = "127.0.0.1", port: str = "50021", speaker_id:int=8,split_character:list=["。","？","!", "…"]) -> None:
         """クラスの初期化メソッド。
@@ -36,6 +39,12 @@ class TextToVoiceVox(object):
         self.port = port
         self.play_flg = False
         self.finished = True
+        self.finished_event = Event()  # 合成・再生待ちのテキストが無くなったらセット(wait_finish用)
+        self.finished_event.set()
+        self._pending = 0  # put_textされてまだ再生(または破棄)されていない断片の数
+        self._pending_lock = Lock()
+        self.resume_event = Event()  # クリアされている間は再生を一時停止する(割り込みかもしれない声を聞いたとき)
+        self.resume_event.set()
         self.voice_thread = Thread(target=self.text_to_voice_thread,name="text2voice")
         self.speaker_thread = Thread(target=self.speak_voice_thread,name="speaker")
         self.voice_thread.start()
@@ -54,33 +63,43 @@ class TextToVoiceVox(object):
     def text_to_voice_thread(self) -> None:
         """
         音声合成スレッドの実行関数。VOICEVOXの生成待ち時間をメイン処理から分離する為に必要。
-        キューにテキストがある限り、text_to_voice関数を呼び出す。
+        キューにテキストが来るまでブロックして待ち、来たらtext_to_voice関数を呼び出す。
         """
         while True:
-            if self.text_queue.qsize() > 0:
-                text = self.text_queue.get()
-                if not text: # 空の時はスルー
-                    continue
-                logging.debug(f"generate: \"{text}\"")
+            text = self.text_queue.get()
+            if not text: # 空の時はスルー
+                self._done(1)
+                continue
+            logging.debug(f"generate: \"{text}\"")
+            try:
                 wav = self.text_to_voice(text)
-                logging.debug(f"play: \"{text}\"")
-                self.wav_queue.put(wav)
-
-            time.sleep(0.01)
+            except Exception as e:
+                logging.debug(f"fail to generate: {e}")
+                self._done(1)
+                continue
+            logging.debug(f"play: \"{text}\"")
+            self.wav_queue.put(wav)
     
     def speak_voice_thread(self) -> None:
         """
         wav_queueのデータを再生するスレッド。音声の再生待ち時間をメイン処理や音声合成処理から分離するために必要
-        キューにデータがある限り、play_wav関数を呼び出す。
+        キューにデータが来るまでブロックして待ち、来たらplay_wav関数を呼び出す。
         """
         while True:
-            if self.wav_queue.qsize() > 0:
-                wav = self.wav_queue.get()
+            wav = self.wav_queue.get()
+            try:
                 self.play_wav(wav)
                 logging.debug("playing completed")
-            if self.text_queue.qsize() == 0 and self.wav_queue.qsize()==0:
+            finally:
+                self._done(1)
+
+    def _done(self, count: int) -> None:
+        """断片をcount個再生(または破棄)した。全部終わったらfinishedにする"""
+        with self._pending_lock:
+            self._pending = max(0, self._pending - count)
+            if self._pending == 0:
                 self.finished = True
-            time.sleep(0.01)
+                self.finished_event.set()
 
     def allow_speech(self):
         self.play_flg=True
@@ -91,12 +110,29 @@ class TextToVoiceVox(object):
         """
         logging.debug(f"interrupted in {self.__class__.__name__}.stop_and_clear")
 
-        # キューをクリア
-        self.text_queue.queue.clear()  
-        self.wav_queue.queue.clear() 
+        # キューをクリア(捨てた断片は再生済みとして数える)
+        with self.text_queue.mutex, self.wav_queue.mutex:
+            dropped = len(self.text_queue.queue) + len(self.wav_queue.queue)
+            self.text_queue.queue.clear()
+            self.wav_queue.queue.clear()
+        self._done(dropped)
 
         # 再生フラグをFalseに設定(再生中なら即ループ脱出)
         self.play_flg = False  
+        self.resume_event.set()  # 一時停止中なら起こして抜けさせる
+
+    def pause(self) -> None:
+        """
+        再生を一時停止する(次の1024フレームの書き込みの前で止まる)。キューはそのまま
+        """
+        logging.debug(f"paused in {self.__class__.__name__}.pause")
+        self.resume_event.clear()
+
+    def resume(self) -> None:
+        """
+        pauseで止めた再生を、止めたところから再開する。
+        """
+        self.resume_event.set()
 
     def set_speaker_id(self,id):
         """
@@ -121,44 +157,35 @@ class TextToVoiceVox(object):
             self.play_flg = True
 
         # 区切り文字に従ってテキストを分割
-        text_chunks = [text]
-        for char in self.split_character:
-            new_chunks = []
-            for chunk in text_chunks:
-                parts = chunk.split(char)
-                for i, part in enumerate(parts):
-                    if i < len(parts) -1:
-                        new_chunks.append(part + char)
-                    else:
-                        new_chunks.append(part)
-            text_chunks = new_chunks
-
-        for chunk in text_chunks:
-            self.text_queue.put(chunk)
-
-        self.finished = False
+        chunks = self.split_text(text)
+        if chunks:
+            with self._pending_lock:
+                self._pending += len(chunks)
+                self.finished = False
+                self.finished_event.clear()
+            for chunk in chunks:
+                self.text_queue.put(chunk)
         if blocking:
             self.wait_finish()
 
     def wait_finish(self) -> None:
         """
-        音声合成が完了するまで待機するループ関数。
+        音声合成・再生が完了するまで待機する(ポーリングせずにイベントで待つ)。
 
         """
-        while not self.finished:
-            time.sleep(0.01)
+        self.finished_event.wait()
 
     def post_audio_query(
         self,
         text: str,
-        speaker:int=8,
+        speaker: int = None,
         speed_scale: float = 1.0,
     ) -> Any:
         """VoiceVoxサーバーに音声合成クエリを送信する。
 
         Args:
             text (str): 音声合成対象のテキスト。
-            speaker (int, optional): VoiceVoxの話者番号。デフォルトは8(春日部つむぎ)。
+            speaker (int, optional): VoiceVoxの話者番号。省略時はset_speaker_idで設定した話者。
             speed_scale (float, optional): 音声の再生速度スケール。デフォルトは1.0。
 
         Returns:
@@ -167,7 +194,7 @@ class TextToVoiceVox(object):
         """
         params = {
             "text": text,
-            "speaker": self.speaker_id,
+            "speaker": self.speaker_id if speaker is None else speaker,
             "speed_scale": speed_scale,
             "pre_phoneme_length": 0,
             "post_phoneme_length": 0,
@@ -180,17 +207,19 @@ class TextToVoiceVox(object):
     def post_synthesis(
         self,
         audio_query_response: dict,
+        speaker: int = None,
     ) -> bytes:
         """
         VoiceVoxサーバーに音声合成要求を送信し、合成された音声データを取得する。
 
         Args:
             audio_query_response (dict): 音声合成クエリの応答。
+            speaker (int, optional): VoiceVoxの話者番号。省略時はset_speaker_idで設定した話者。
 
         Returns:
             bytes: 合成された音声データ。
         """
-        params = {"speaker": self.speaker_id}
+        params = {"speaker": self.speaker_id if speaker is None else speaker}
         headers = {"content-type": "application/json"}
         audio_query_response_json = json.dumps(audio_query_response)
         address = "http://" + self.host + ":" + self.port + "/synthesis"
@@ -217,11 +246,18 @@ class TextToVoiceVox(object):
                 output=True,
             )
             chunk = 1024
+            rate = wr.getframerate()
+            channels = wr.getnchannels()
+            publish = wr.getsampwidth() == 2  # 参照信号はint16のときだけ
             data = wr.readframes(chunk)
             while data:
+                if not self.resume_event.is_set():
+                    self.resume_event.wait()  # 一時停止中(stop_and_clearでも起きる)
                 if self.play_flg is False:
                     logging.debug("speech interrupted")
                     break
+                if publish:
+                    self.echo_reference.publish(data, rate, channels)
                 stream.write(data)
                 data = wr.readframes(chunk)
             time.sleep(0.2)
@@ -240,6 +276,58 @@ class TextToVoiceVox(object):
         wav = self.post_synthesis(res)
         return wav
 
+    def split_text(self, text: str) -> list:
+        """
+        区切り文字に従ってテキストを分割する(区切り文字は前の断片に残す)。空の断片は除く。
+        """
+        text_chunks = [text]
+        for char in self.split_character:
+            new_chunks = []
+            for chunk in text_chunks:
+                parts = chunk.split(char)
+                for i, part in enumerate(parts):
+                    if i < len(parts) -1:
+                        new_chunks.append(part + char)
+                    else:
+                        new_chunks.append(part)
+            text_chunks = new_chunks
+        return [chunk for chunk in text_chunks if chunk]
+
+    def synthesize(self, text: str, speaker_id: int = None) -> list:
+        """
+        キューを通さずに、その場でテキストを音声合成する(再生はしない)。
+        話者を引数で渡すので、複数の話者の合成を別々のスレッドから同時に呼んでもよい。
+
+        Args:
+            text (str): 音声合成対象のテキスト。
+            speaker_id (int, optional): 話者ID。省略時はset_speaker_idで設定した話者。
+
+        Returns:
+            list: 区切り文字ごとに合成したwavデータのリスト。
+        """
+        speaker_id = self.speaker_id if speaker_id is None else speaker_id
+        return [self.post_synthesis(self.post_audio_query(chunk, speaker=speaker_id), speaker=speaker_id)
+                for chunk in self.split_text(text)]
+
+    def play(self, wavs: list, cancel_event=None) -> None:
+        """
+        synthesizeで合成したwavデータを順に再生する(再生し終わるまでブロック)。
+        stop_and_clearが呼ばれたら途中でやめる。
+
+        Args:
+            wavs (list): synthesizeの結果
+            cancel_event (threading.Event): この再生の中断用．フラグを戻した後に確かめるので，
+                直前のstop_and_clearがplay_flg = Trueで上書きされても再生しない
+        """
+        self.play_flg = True
+        if cancel_event is not None and cancel_event.is_set():
+            self.play_flg = False
+            return
+        for wav in wavs:
+            if not self.play_flg:
+                break
+            self.play_wav(wav)
+
 class TextToVoiceVox2(TextToVoiceVox):
     """
     1との違い
@@ -259,6 +347,12 @@ class TextToVoiceVox2(TextToVoiceVox):
         self.port = port
         self.play_flg = False
         self.finished = True
+        self.finished_event = Event()
+        self.finished_event.set()
+        self._pending = 0
+        self._pending_lock = Lock()
+        self.resume_event = Event()  # superを呼ばないのでここで作る(クリアされている間は再生を一時停止する)
+        self.resume_event.set()
         self.thread_exit = False
         
         self.wav2voice_thread=Thread(target=self.wav_to_voice_thread,name="wav2voice")
@@ -272,22 +366,19 @@ class TextToVoiceVox2(TextToVoiceVox):
 
     def wav_to_voice_thread(self):
         """
-        wav_queueの再生
+        wav_queueの再生(データが来るまでブロックして待つ。Noneが来たら終了)
         """
         while True:
-            if self.wav_queue.qsize() > 0:
-                wav = self.wav_queue.get()
-                text=self.text_queue.get()
-                logging.debug("w2v:"+text)
-                try:
-                    self.play_wav(wav)
-                except:
-                    logging.debug("fail:"+text)
-            if self.wav_queue.qsize()==0:
-                self.finished=True
-            if self.thread_exit:
+            wav = self.wav_queue.get()
+            if wav is None or self.thread_exit:
                 break
-            time.sleep(0.01)
+            text=self.text_queue.get()
+            logging.debug("w2v:"+text)
+            try:
+                self.play_wav(wav)
+            except:
+                logging.debug("fail:"+text)
+            self._done(1)
     
     def text_to_wav(self,text):
         res = self.post_audio_query(text)
@@ -307,9 +398,16 @@ class TextToVoiceVox2(TextToVoiceVox):
         """
         if play_now:
             self.play_flg = True
-        self.finished = False
+        with self._pending_lock:
+            self._pending += 1
+            self.finished = False
+            self.finished_event.clear()
         logging.debug("t2w:"+text)
-        self.text_to_wav(text)
+        try:
+            self.text_to_wav(text)
+        except Exception:
+            self._done(1)
+            raise
         if blocking:
             self.wait_finish()
 
@@ -318,9 +416,13 @@ class TextToVoiceVox2(TextToVoiceVox):
         キューをクリアし、音声の再生を直ちに取りやめる。
         """
         logging.debug(f"interrupted in {self.__class__.__name__}.stop_and_clear")
-        self.wav_queue.queue.clear()  # キューをクリア
-        self.text_queue.queue.clear()  # キューをクリア
+        with self.wav_queue.mutex, self.text_queue.mutex:
+            dropped = len(self.wav_queue.queue)
+            self.wav_queue.queue.clear()  # キューをクリア
+            self.text_queue.queue.clear()  # キューをクリア
+        self._done(dropped)
         self.play_flg = False  # 再生フラグをFalseに設定(再生中なら即ループ脱出)
+        self.resume_event.set()  # 一時停止中なら起こして抜けさせる
 
 
 
@@ -338,6 +440,8 @@ class TextToVoiceVoxWeb(TextToVoiceVox):
         self.queue: Queue[str] = Queue()
         self.apikey = apikey
         self.play_flg = False
+        self.resume_event = Event()  # superを呼ばないのでここで作る(クリアされている間は再生を一時停止する)
+        self.resume_event.set()
         self.voice_thread = Thread(target=self.text_to_voice_thread,name="speaker")
         self.voice_thread.start()
         self.speaker_id=speaker_id
@@ -345,7 +449,7 @@ class TextToVoiceVoxWeb(TextToVoiceVox):
     def post_web(
         self,
         text: str,
-        speaker: int = 8,
+        speaker: int = None,
         pitch: int = 0,
         intonation_scale: int = 1,
         speed: int = 1,
@@ -355,7 +459,7 @@ class TextToVoiceVoxWeb(TextToVoiceVox):
 
         Args:
             text (str): 音声合成対象のテキスト。
-            speaker (int, optional): VoiceVoxの話者番号。デフォルトは8(春日部つむぎ)。
+            speaker (int, optional): VoiceVoxの話者番号。省略時はspeaker_idで設定した話者。
             pitch (int, optional): ピッチ。デフォルトは0。
             intonation_scale (int, optional): イントネーションスケール。デフォルトは1。
             speed (int, optional): 音声の速度。デフォルトは1。
@@ -368,7 +472,7 @@ class TextToVoiceVoxWeb(TextToVoiceVox):
             "https://deprecatedapis.tts.quest/v2/voicevox/audio/?key="
             + self.apikey
             + "&speaker="
-            + str(self.speaker_id)
+            + str(self.speaker_id if speaker is None else speaker)
             + "&pitch="
             + str(pitch)
             + "&intonationScale="
@@ -398,6 +502,12 @@ class TextToVoiceVoxWeb(TextToVoiceVox):
             return
         self.play_wav(wav)
 
+    def synthesize(self, text: str, speaker_id: int = None) -> list:
+        """
+        キューを通さずに、その場でテキストを音声合成する(再生はしない)。web版は分割せず1回で合成する。
+        """
+        return [self.post_web(text=text, speaker=speaker_id)]
+
 
 class TextToAivisSpeech(TextToVoiceVox):
     """